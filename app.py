@@ -1,11 +1,27 @@
 import os
+import math
+import time
 import logging
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Blueprint, current_app, render_template, request, jsonify, session, send_file
 import json
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import DeclarativeBase
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
-from utils.openai_helper import generate_ai_response, stream_ai_response, get_available_models
+from utils.openai_helper import generate_ai_response, stream_ai_response, get_available_models, AZURE_OPENAI_DEPLOYMENT_NAME
+from utils.sse import SSE_COALESCE_MS, SSE_COALESCE_MAX_BYTES
+from utils.stream_buffer import get_stream_bus, follow_stream, parse_event_id
+from utils.generation import (StreamJob, generation_pool, async_generation_pool, snapshot_from_row,
+                              STATUS_QUEUED, STATUS_CANCELLED, ACTIVE_STATUSES)
+from utils.conversation_store import conversation_store
+from utils.context_window import apply_context_budget, count_message_tokens
+from utils.schema import upgrade_schema
+from utils.blob_store import get_blob_store, sniff_image_type
+from utils.scheduler import SchedulerOverloaded
+from utils.user_cache import user_cache
+from utils.message_reaper import message_reaper, visible_messages, clear_history, clear_status
+from utils.user_store import upsert_user, MAX_USERNAME_LENGTH
+from utils import metrics, log_config
 
 # Flag to indicate if the database is available
 database_status = {'available': True}
@@ -17,67 +33,182 @@ def is_database_available():
 def set_database_unavailable():
     """Mark the database as unavailable."""
     database_status['available'] = False
+    metrics.set_fallback_mode(True)
     logging.warning("Running without database support - using in-memory storage instead")
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
 # Setup database
 class Base(DeclarativeBase):
     pass
 
 db = SQLAlchemy(model_class=Base)
 
-# Create Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "default-secret-key-for-development")
-
-# Configure database
-database_url = os.environ.get("DATABASE_URL")
-# Ensure proper URL format for SQLAlchemy
-if database_url and database_url.startswith("postgres://"):
-    database_url = database_url.replace("postgres://", "postgresql://", 1)
-
-app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-    "connect_args": {
-        "connect_timeout": 10,
-        "application_name": "ai-chat-app"
+login_manager = LoginManager()
+login_manager.login_view = 'chat.index'
+
+# Routes, error handlers and CLI commands; registered on the app by create_app()
+bp = Blueprint('chat', __name__, cli_group=None)
+
+def create_app(config=None):
+    """Create and configure the Flask app.
+
+    Only builds the app: it doesn't connect to the database, create tables
+    or load the Azure OpenAI SDK, so it is cheap enough for tests and CLI
+    commands. Schema changes are applied by ``flask --app app:create_app migrate``
+    and connections are checked by warm_up().
+
+    Args:
+        config (dict, optional): Settings overriding the ones read from the environment
+
+    Returns:
+        Flask: The configured app
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "default-secret-key-for-development")
+
+    # Configure database
+    database_url = os.environ.get("DATABASE_URL")
+    # Ensure proper URL format for SQLAlchemy
+    if database_url and database_url.startswith("postgres://"):
+        database_url = database_url.replace("postgres://", "postgresql://", 1)
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    # How often a streaming response's partial text is written to the database
+    app.config["STREAM_FLUSH_INTERVAL_MS"] = int(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "500"))
+    app.config["STREAM_FLUSH_MAX_BYTES"] = int(os.environ.get("STREAM_FLUSH_MAX_BYTES", "4096"))
+    # How long streamed deltas are coalesced into one SSE frame (see utils.sse)
+    app.config["SSE_COALESCE_MS"] = SSE_COALESCE_MS
+    app.config["SSE_COALESCE_MAX_BYTES"] = SSE_COALESCE_MAX_BYTES
+    # Create missing tables during warm_up() instead of requiring `flask migrate` (local runs)
+    app.config["AUTO_MIGRATE"] = os.environ.get("AUTO_MIGRATE", "").lower() in ("1", "true", "yes")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True
     }
-}
+    # libpq-specific connection options; SQLite (used for local runs and benchmarks) rejects them
+    if database_url and database_url.startswith("postgresql"):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {
+            "connect_timeout": 10,
+            "application_name": "ai-chat-app"
+        }
+    app.config["LOG_LEVEL"] = log_config.LOG_LEVEL
+    if config:
+        app.config.update(config)
 
-# Initialize database
-db.init_app(app)
+    # Logging is queued and written by a background thread, tagged with request ids
+    log_config.configure_logging(app.config["LOG_LEVEL"])
+    log_config.init_app(app)
 
-# Initialize login manager
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'index'
+    # Initialize database; the engine connects on first use
+    db.init_app(app)
+    import models  # registers the tables on db.metadata
+    user_cache.watch(models.User)
 
-# Create all tables
-with app.app_context():
-    import models  # Import models here to avoid circular imports
-    try:
+    # Request latency and database commit metrics, served on /metrics
+    metrics.instrument_app(app)
+
+    # Initialize login manager
+    login_manager.init_app(app)
+    
+    # Deletes cleared messages in the background (started by each worker's first request)
+    message_reaper.init_app(app)
+
+    app.register_blueprint(bp)
+    return app
+
+def migrate_database(app):
+    """Create missing tables and apply additive schema upgrades.
+
+    Returns:
+        list: Descriptions of the changes that were applied
+    """
+    with app.app_context():
+        existing_tables = set(inspect(db.engine).get_table_names())
+        created = [f"created table {table.name}" for table in db.metadata.sorted_tables
+                   if table.name not in existing_tables]
         db.create_all()
-        logging.info("Database tables created successfully")
-    except Exception as e:
-        logging.error(f"Error creating database tables: {str(e)}")
-        # Mark database as unavailable
-        set_database_unavailable()
+        return created + upgrade_schema(db)
+
+def warm_up(app):
+    """Prepare a process to serve requests: load the SDKs and check the database.
+
+    Under ``gunicorn --preload`` this runs once in the master and the
+    workers fork warm. The connection pool is disposed of afterwards so no
+    connection is shared with forked workers. If the database can't be
+    reached, or its tables don't exist and AUTO_MIGRATE is off, the app
+    falls back to in-memory storage as before.
+    """
+    from utils import client_registry
+
+    started = time.perf_counter()
+    client_registry.load_sdk()
+    with app.app_context():
+        try:
+            # Listing the tables doubles as the connection check
+            existing_tables = set(inspect(db.engine).get_table_names())
+            missing = [table.name for table in db.metadata.sorted_tables if table.name not in existing_tables]
+            if missing and app.config["AUTO_MIGRATE"]:
+                for change in migrate_database(app):
+                    logging.info(f"Migration: {change}")
+            elif missing:
+                logging.error(f"Database tables missing ({', '.join(missing)}); run `flask --app app:create_app migrate`")
+                set_database_unavailable()
+        except Exception as e:
+            logging.error(f"Database check failed: {str(e)}")
+            set_database_unavailable()
+        finally:
+            db.engine.dispose()
+    logging.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+def __getattr__(name):
+    # Keeps `gunicorn app:app` and `from app import app` working; the app is built by wsgi.py
+    if name == "app":
+        from wsgi import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply additive schema upgrades."""
+    applied = migrate_database(current_app)
+    for change in applied:
+        print(change)
+    print(f"Applied {len(applied)} schema changes")
+
+@bp.cli.command('migrate-images')
+def migrate_images_command():
+    """Move inline Base64 images from the message table into the blob store."""
+    import base64
+    from models import Message
+    
+    migrated = 0
+    store = get_blob_store()
+    while True:
+        batch = Message.query.filter(
+            Message.image_data.isnot(None),
+            Message.image_ref.is_(None)
+        ).order_by(Message.id).limit(100).all()
+        if not batch:
+            break
+        for message in batch:
+            raw = base64.b64decode(message.image_data)
+            message.image_ref = store.put(raw, sniff_image_type(raw) or 'application/octet-stream')
+            message.image_data = None
+        db.session.commit()
+        migrated += len(batch)
+        logging.info(f"Migrated {migrated} inline images to the blob store")
+    print(f"Migrated {migrated} images")
 
 @login_manager.user_loader
 def load_user(id):
-    from models import User
-    return User.query.get(int(id))
+    """Return the session's user as a cached identity (id, username); see utils.user_cache."""
+    return user_cache.load(int(id))
 
-@app.route('/')
+@bp.route('/')
 def index():
     """Render the main chat interface."""
     return render_template('index.html')
 
-@app.route('/api/users', methods=['POST'])
+@bp.route('/api/users', methods=['POST'])
 def register_user():
     """Register a new user or login an existing user by username."""
     try:
@@ -89,22 +220,23 @@ def register_user():
                 'status': 'error',
                 'message': 'Username is required'
             }), 400
+        if len(username) > MAX_USERNAME_LENGTH:
+            return jsonify({
+                'status': 'error',
+                'message': f"Username must be at most {MAX_USERNAME_LENGTH} characters"
+            }), 400
         
         if is_database_available():
-            # Database storage path
-            from models import User
-            
-            # Check if user exists
-            user = User.query.filter_by(username=username).first()
-            
-            # If user doesn't exist, create a new one
-            if not user:
-                user = User(username=username)
-                db.session.add(user)
-                db.session.commit()
-                logging.debug(f"Created new user: {username}")
+            # Database storage path; known users are served from the identity cache
+            user = user_cache.get_by_username(username)
+            if user is None:
+                # Atomic insert-if-missing, so concurrent first logins can't collide
+                user_id, created = upsert_user(username)
+                if created:
+                    logging.debug(f"Created new user: {username}")
+                user = user_cache.put(user_id, username)
             
-            # Login the user
+            # Login the user; later requests load the identity from the cache
             login_user(user)
             
             return jsonify({
@@ -131,29 +263,116 @@ def register_user():
             'message': f"An error occurred: {str(e)}"
         }), 500
 
-@app.route('/api/chat/stream', methods=['GET'])
+@bp.route('/api/users/bulk', methods=['POST'])
+def provision_users():
+    """Create many users in one transaction (onboarding).
+    
+    Expects {"usernames": [...]}, at most USER_PROVISIONING_MAX_BATCH per call,
+    and an "Authorization: Bearer <USER_PROVISIONING_TOKEN>" header; the endpoint
+    is disabled while USER_PROVISIONING_TOKEN is unset. Existing users are
+    returned with their ids, so the call can be repeated safely.
+    """
+    import hmac
+    from utils.user_store import normalize_usernames, upsert_users
+    
+    token = os.environ.get("USER_PROVISIONING_TOKEN")
+    if not token:
+        return jsonify({
+            'status': 'error',
+            'message': 'User provisioning is disabled'
+        }), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return jsonify({
+            'status': 'error',
+            'message': 'Invalid provisioning token'
+        }), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        values = data.get('usernames')
+        if not isinstance(values, list) or not values:
+            return jsonify({
+                'status': 'error',
+                'message': 'usernames must be a non-empty list'
+            }), 400
+        max_batch = int(os.environ.get("USER_PROVISIONING_MAX_BATCH", "10000"))
+        if len(values) > max_batch:
+            return jsonify({
+                'status': 'error',
+                'message': f"At most {max_batch} usernames per call"
+            }), 400
+        try:
+            usernames = normalize_usernames(values)
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 400
+        
+        if is_database_available():
+            # Not cached: thousands of idle accounts would evict the active users
+            ids, created = upsert_users(usernames)
+        else:
+            from utils.db_fallback import register_users as fallback_register_users
+            
+            ids, created = fallback_register_users(usernames)
+        
+        return jsonify({
+            'status': 'success',
+            'created': created,
+            'users': [{'user_id': ids[username], 'username': username} for username in usernames]
+        })
+    except Exception as e:
+        logging.error(f"Error in provision_users endpoint: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }), 500
+
+def load_stream_message(stream_id):
+    """Return the MessageSnapshot of the assistant message produced by a stream, or None."""
+    from models import Message
+    
+    if not is_database_available():
+        return None
+    try:
+        row = db.session.query(
+            Message.content, Message.reasoning_summary, Message.is_streaming, Message.is_truncated, Message.status
+        ).filter(Message.stream_id == stream_id).first()
+        return snapshot_from_row(row) if row else None
+    finally:
+        # End the read transaction so the next poll sees new flushes
+        db.session.rollback()
+
+@bp.route('/api/chat/stream', methods=['GET'])
 def chat_stream():
-    """Stream AI responses using server-sent events."""
+    """Follow a /api/chat stream from the frame after Last-Event-ID (from its start without one)."""
     try:
-        from flask import Response
-        import json
+        from flask import Response, stream_with_context
         
-        # Get essential parameters
-        user_id = request.args.get('user_id')
+        stream_id = request.args.get('stream_id')
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        if not stream_id:
+            return jsonify({
+                'status': 'error',
+                'message': 'stream_id is required'
+            }), 400
+        try:
+            parse_event_id(last_event_id)
+        except ValueError:
+            return jsonify({
+                'status': 'error',
+                'message': 'Invalid Last-Event-ID'
+            }), 400
         
-        def generate():
-            # Start with an initial event to keep the connection alive
-            yield f"data: {json.dumps({'status': 'connected'})}\n\n"
-            
-            # For now, just keep the connection open but don't stream anything
-            # The actual streaming will happen via the regular POST endpoint
-            # This is just to maintain the connection
-            
-            # Close the connection after a timeout
-            yield f"data: {json.dumps({'status': 'timeout', 'message': 'Stream connection timed out'})}\n\n"
-            
-        # Return a streaming response with proper headers
-        response = Response(generate(), mimetype='text/event-stream')
+        if not get_stream_bus().has(stream_id) and load_stream_message(stream_id) is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'Stream not found'
+            }), 404
+        
+        frames = follow_stream(stream_id, last_event_id, lambda: load_stream_message(stream_id))
+        response = Response(stream_with_context(frames), mimetype='text/event-stream')
         response.headers['Cache-Control'] = 'no-cache'
         response.headers['X-Accel-Buffering'] = 'no'
         response.headers['Connection'] = 'keep-alive'
@@ -166,30 +385,127 @@ def chat_stream():
             'message': f"An error occurred: {str(e)}"
         }), 500
 
-@app.route('/api/chat', methods=['POST'])
+@bp.route('/api/chat/cancel', methods=['POST'])
+def cancel_chat():
+    """Stop generating a streamed answer, keeping what was produced so far."""
+    try:
+        from models import Message
+
+        data = request.get_json(silent=True) or {}
+        stream_id = data.get('stream_id')
+        message_id = data.get('message_id')
+        if not stream_id and not message_id:
+            return jsonify({
+                'status': 'error',
+                'message': 'stream_id or message_id is required'
+            }), 400
+
+        found = False
+        cancelled = False
+        if is_database_available():
+            # A message id alone isn't secret, so it must come with its owner
+            query = Message.query.filter_by(role='assistant')
+            if stream_id:
+                query = query.filter_by(stream_id=stream_id)
+            else:
+                query = query.filter_by(id=message_id, user_id=data.get('user_id'))
+            row = query.with_entities(Message.id, Message.stream_id).first()
+            if row is not None:
+                found = True
+                stream_id = row.stream_id
+                # Jobs in other processes notice the status when they next check the row
+                cancelled = Message.query.filter(
+                    Message.id == row.id,
+                    Message.status.in_(ACTIVE_STATUSES)
+                ).update({'status': STATUS_CANCELLED}, synchronize_session=False) > 0
+                db.session.commit()
+
+        if stream_id and get_stream_bus().has(stream_id):
+            found = True
+            cancelled = get_stream_bus().cancel(stream_id, 'user') or cancelled
+
+        if not found:
+            return jsonify({
+                'status': 'error',
+                'message': 'Stream not found'
+            }), 404
+
+        return jsonify({
+            'status': 'success',
+            'cancelled': cancelled
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error in chat cancel endpoint: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }), 500
+
+@bp.route('/api/chat', methods=['POST'])
 def chat():
     """Process chat messages and get AI responses."""
+    started = time.perf_counter()
     try:
         from utils.openai_helper import generate_ai_response, stream_ai_response
-        from flask import Response
+        from flask import Response, stream_with_context
         
         # In the new implementation we only handle POST requests
         data = request.json
         
         message_content = data.get('message', '')
-        conversation_history = data.get('conversation_history', [])
-        image_data = data.get('image_data')  # Base64 encoded image data
+        conversation_history = data.get('conversation_history')
+        conversation_id = data.get('conversation_id')  # Server-side history key (replaces conversation_history)
+        image_id = data.get('image_id')  # Blob store id returned by /api/upload-image
+        image_data = data.get('image_data')  # Legacy: Base64 encoded image data
         use_streaming = data.get('streaming', False)  # Whether to use streaming response
         reasoning_effort = data.get('reasoning_effort')  # Reasoning effort level (low, medium, high)
         developer_message = data.get('developer_message')  # Developer message (like system message)
         model = data.get('model')  # The deployment model to use
+        model_label = model or AZURE_OPENAI_DEPLOYMENT_NAME
+        use_cache = data.get('cache', True)  # Set to false to bypass the response cache
+        priority = data.get('priority')  # Scheduling class: interactive (default) or batch
         
         # Check if user is logged in via session
         user_id = data.get('user_id')
         username = data.get('username', 'User')
         
+        # Load an uploaded image from the blob store; the model still needs it inline
+        if image_id:
+            if not get_blob_store().exists(image_id):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Image not found'
+                }), 400
+            image_data = get_blob_store().read_base64(image_id)
+        
+        # Assemble history server-side when the client only sends the new turn
+        previous_response_id = previous_response_endpoint = None
+        if conversation_history is None:
+            conversation_history = []
+            if user_id and conversation_id:
+                conversation_history, previous_response_id, previous_response_endpoint = conversation_store.get_history(
+                    int(user_id), conversation_id
+                )
+        
+        # Fit the history into the model's token budget
+        summary_owner = int(user_id) if user_id and conversation_id and is_database_available() else None
+        conversation_history, context_report = apply_context_budget(
+            conversation_history,
+            model,
+            message_content,
+            image_data,
+            developer_message,
+            summary_owner,
+            conversation_id
+        )
+        if context_report['over_budget']:
+            # The upstream chain holds the untrimmed history, so send the trimmed one instead
+            previous_response_id = None
+        
         # Log the incoming request
-        logging.debug(f"Received message from {username}: {message_content}")
+        logging.debug(f"Received message from {username} ({len(message_content)} chars)")
         logging.debug(f"Conversation history length: {len(conversation_history)}")
         if image_data:
             logging.debug("Image data included with message")
@@ -198,133 +514,137 @@ def chat():
         if developer_message:
             logging.debug(f"Developer message provided")
         
-        # Store user message depending on database availability
-        if user_id:
+        def store_incoming_messages():
+            """Store the user (and developer) message depending on database availability."""
+            if not user_id:
+                return
+            
             if is_database_available():
                 # Database storage for user message
                 from models import Message
-                
+            
                 user_message = Message(
                     content=message_content,
                     role='user',
                     user_id=user_id,
-                    image_data=image_data
+                    image_data=None if image_id else image_data,
+                    image_ref=image_id,
+                    conversation_id=conversation_id,
+                    token_count=count_message_tokens(message_content, image_data)
                 )
                 db.session.add(user_message)
                 db.session.commit()
-                
+            
                 # Store developer message if provided
                 if developer_message:
                     dev_message = Message(
                         content=developer_message,
                         role='developer',
-                        user_id=user_id
+                        user_id=user_id,
+                        conversation_id=conversation_id,
+                        token_count=count_message_tokens(developer_message)
                     )
                     db.session.add(dev_message)
                     db.session.commit()
             else:
                 # Fallback storage for user message
                 from utils.db_fallback import add_message
-                
-                add_message(int(user_id), message_content, 'user')
-                
+            
+                add_message(
+                    int(user_id),
+                    message_content,
+                    'user',
+                    conversation_id,
+                    image_data=None if image_id else image_data,
+                    image_ref=image_id
+                )
+            
                 # Store developer message if provided
                 if developer_message:
-                    add_message(int(user_id), developer_message, 'developer')
+                    add_message(int(user_id), developer_message, 'developer', conversation_id)
         
         # Handle streaming or regular response
         if use_streaming:
-            def generate():
-                # Create an initial streaming message if database is available
-                ai_message = None
-                if user_id and is_database_available():
-                    from models import Message
-                    
-                    ai_message = Message(
-                        content="",
-                        role='assistant',
-                        user_id=user_id,
-                        is_streaming=True,
-                        reasoning_effort=reasoning_effort
-                    )
-                    db.session.add(ai_message)
-                    db.session.commit()
-                    message_id = ai_message.id
-                
-                # Start streaming the response
-                full_response = ""
-                reasoning_summary = None
-                
-                for chunk in stream_ai_response(
-                    message_content, 
-                    conversation_history, 
-                    image_data,
-                    reasoning_effort,
-                    developer_message,
-                    model
-                ):
-                    # Check if this chunk contains a reasoning summary
-                    if chunk.startswith("\n\n<reasoning-summary>") and chunk.endswith("</reasoning-summary>"):
-                        # Extract the reasoning summary
-                        reasoning_summary = chunk[24:-21]  # Remove the tags
-                        
-                        # Store the reasoning summary if using database
-                        if user_id and ai_message and is_database_available():
-                            ai_message.reasoning_summary = reasoning_summary
-                            db.session.commit()
-                            
-                        # Don't include the reasoning summary in the response text
-                        continue
-                    
-                    # Add the chunk to the full response
-                    full_response += chunk
-                    
-                    # Update the streaming message if using database
-                    if user_id and ai_message and is_database_available():
-                        ai_message.content = full_response
-                        db.session.commit()
-                    
-                    # Send the chunk to the client with proper formatting
-                    # Each SSE message needs to start with 'data: ' and end with two newlines
-                    yield f"data: {json.dumps({'chunk': chunk, 'is_final': False})}\n\n"
-                
-                # Finalize the message in the database if available
-                if user_id and ai_message and is_database_available():
-                    ai_message.is_streaming = False
-                    db.session.commit()
-                # Store the final message in fallback storage if needed
-                elif user_id and not is_database_available():
-                    from utils.db_fallback import add_message
-                    add_message(int(user_id), full_response, 'assistant')
-                
-                # Send the final chunk to the client
-                response_data = {
-                    'chunk': '', 
-                    'is_final': True, 
-                    'full_response': full_response
-                }
+            response_meta = {}
+            events = stream_ai_response(
+                message_content, 
+                conversation_history, 
+                image_data,
+                reasoning_effort,
+                developer_message,
+                model,
+                previous_response_id,
+                response_meta,
+                use_cache,
+                priority,
+                previous_response_endpoint
+            )
+            # The stream doesn't start until the job runs, so the scheduler admits it
+            # (and may shed it) only once a worker is free
+            store_incoming_messages()
+            
+            # Every frame is numbered and kept on the stream bus so clients can resume or watch it
+            stream = get_stream_bus().open()
+            
+            # Create the assistant message if database is available; the job fills it in
+            if user_id and is_database_available():
+                from models import Message
                 
-                # Include reasoning summary if available
-                if reasoning_summary:
-                    response_data['reasoning_summary'] = reasoning_summary
-                    
-                yield f"data: {json.dumps(response_data)}\n\n"
+                ai_message = Message(
+                    content="",
+                    role='assistant',
+                    user_id=user_id,
+                    is_streaming=True,
+                    status=STATUS_QUEUED,
+                    reasoning_effort=reasoning_effort,
+                    conversation_id=conversation_id,
+                    stream_id=stream.stream_id
+                )
+                db.session.add(ai_message)
+                db.session.commit()
+                stream.message_id = ai_message.id
+            stream.append({'stream_id': stream.stream_id, 'message_id': stream.message_id}, 'stream')
+            
+            # Generate on the worker pool; this request is just one subscriber of the stream
+            generation_pool.submit(StreamJob(
+                events,
+                stream,
+                stream.message_id,
+                user_id,
+                conversation_id,
+                reasoning_effort,
+                response_meta,
+                metrics.carry_request_db()
+            ), current_app._get_current_object())
+            stream_id = stream.stream_id
+            frames = follow_stream(stream_id, None, lambda: load_stream_message(stream_id), resumed=False)
             
-            response = Response(generate(), mimetype='text/event-stream')
+            # Keep the app context so a subscriber that falls behind can read the message row
+            response = Response(
+                stream_with_context(metrics.track_stream(frames, model_label, started)),
+                mimetype='text/event-stream'
+            )
             response.headers['Cache-Control'] = 'no-cache'
             response.headers['X-Accel-Buffering'] = 'no'  # For Nginx
             response.headers['Connection'] = 'keep-alive'
             return response
         else:
             # Generate regular AI response
+            response_meta = {}
             ai_response, reasoning_summary = generate_ai_response(
                 message_content, 
                 conversation_history, 
                 image_data,
                 reasoning_effort,
                 developer_message,
-                model
+                model,
+                previous_response_id,
+                response_meta,
+                use_cache,
+                priority,
+                previous_response_endpoint
             )
+            store_incoming_messages()
             
             # Store AI response based on database availability
             if user_id:
@@ -337,27 +657,45 @@ def chat():
                         role='assistant',
                         user_id=user_id,
                         reasoning_effort=reasoning_effort,
-                        reasoning_summary=reasoning_summary
+                        reasoning_summary=reasoning_summary,
+                        conversation_id=conversation_id,
+                        response_id=response_meta.get('response_id'),
+                        response_endpoint=response_meta.get('response_endpoint'),
+                        token_count=count_message_tokens(ai_response)
                     )
                     db.session.add(ai_message)
                     db.session.commit()
                 else:
                     # Fallback storage
                     from utils.db_fallback import add_message
-                    add_message(int(user_id), ai_response, 'assistant')
+                    add_message(int(user_id), ai_response, 'assistant', conversation_id,
+                                reasoning_effort=reasoning_effort, reasoning_summary=reasoning_summary)
             
             # Prepare response data
             response_data = {
                 'status': 'success',
                 'response': ai_response
             }
+            if response_meta.get('cached'):
+                response_data['cached'] = True
             
             # Include reasoning summary if available
             if reasoning_summary:
                 response_data['reasoning_summary'] = reasoning_summary
             
             # Return the response
+            metrics.observe_chat(model_label, started)
             return jsonify(response_data)
+    except SchedulerOverloaded as e:
+        logging.warning(f"Shedding chat request: {str(e)}")
+        response = jsonify({
+            'status': 'error',
+            'message': 'The model is busy right now, please try again shortly',
+            'retry_after': math.ceil(e.retry_after)
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
     except Exception as e:
         logging.error(f"Error in chat endpoint: {str(e)}")
         return jsonify({
@@ -365,7 +703,7 @@ def chat():
             'message': f"An error occurred: {str(e)}"
         }), 500
         
-@app.route('/api/models', methods=['GET'])
+@bp.route('/api/models', methods=['GET'])
 def get_available_models_api():
     """Get the list of available AI models."""
     try:
@@ -383,7 +721,56 @@ def get_available_models_api():
             'message': f"An error occurred: {str(e)}"
         }), 500
 
-@app.route('/api/upload-image', methods=['POST'])
+@bp.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Get cache, coalescing, stream, generation, context window and in-memory storage counters for this worker."""
+    from utils.response_cache import response_cache
+    from utils import single_flight, context_window, db_fallback
+    
+    return jsonify({
+        'status': 'success',
+        'cache': response_cache.stats(),
+        'single_flight': single_flight.get_stats(),
+        'users': user_cache.stats(),
+        'streams': get_stream_bus().get_stats(),
+        'generation': generation_pool.stats.get(),
+        'async_generation': async_generation_pool.stats.get(),
+        'context_window': context_window.get_stats(),
+        'fallback': db_fallback.get_stats()
+    })
+
+@bp.route('/api/endpoints/health', methods=['GET'])
+def get_endpoints_health():
+    """Get the rolling health of each Azure OpenAI endpoint, in current routing order."""
+    from utils.endpoint_router import router
+    
+    return jsonify({
+        'status': 'success',
+        'endpoints': router.health()
+    })
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Export metrics in the Prometheus text format."""
+    from flask import Response
+    
+    rendered = metrics.render()
+    if rendered is None:
+        return Response("prometheus_client is not installed\n", status=503, mimetype='text/plain')
+    body, content_type = rendered
+    return Response(body, content_type=content_type)
+
+@bp.route('/api/scheduler/stats', methods=['GET'])
+def get_scheduler_stats():
+    """Get per-deployment queue depth, wait time and admission counters for this worker."""
+    from utils import scheduler
+    
+    return jsonify({
+        'status': 'success',
+        'scheduler': scheduler.get_stats()
+    })
+
+@bp.route('/api/upload-image', methods=['POST'])
 def upload_image():
     """Handle image uploads for chat"""
     try:
@@ -401,14 +788,22 @@ def upload_image():
                 'message': 'No image selected'
             }), 400
             
-        # Read and encode the image as base64
+        # Store the raw bytes in the blob store, keyed by content hash
         image_data = image_file.read()
-        import base64
-        encoded_image = base64.b64encode(image_data).decode('utf-8')
+        content_type = sniff_image_type(image_data)
+        if not content_type:
+            return jsonify({
+                'status': 'error',
+                'message': 'Unsupported image type'
+            }), 400
+        
+        image_id = get_blob_store().put(image_data, content_type)
         
         return jsonify({
             'status': 'success',
-            'image_data': encoded_image
+            'image_id': image_id,
+            'image_url': f"/api/images/{image_id}",
+            'content_type': content_type
         })
         
     except Exception as e:
@@ -418,9 +813,51 @@ def upload_image():
             'message': f"An error occurred: {str(e)}"
         }), 500
         
-@app.route('/api/messages', methods=['GET'])
+@bp.route('/api/images/<image_id>', methods=['GET'])
+def get_image(image_id):
+    """Serve a stored image's raw bytes (supports ETag and Range requests)."""
+    try:
+        store = get_blob_store()
+        if not store.exists(image_id):
+            return jsonify({
+                'status': 'error',
+                'message': 'Image not found'
+            }), 404
+        
+        # Blob ids are content hashes, so the content never changes for a given URL
+        response = send_file(
+            store.path(image_id),
+            mimetype=store.metadata(image_id)['content_type'],
+            conditional=True,
+            etag=image_id,
+            max_age=31536000
+        )
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+    except Exception as e:
+        logging.error(f"Error in get_image endpoint: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }), 500
+        
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+@bp.route('/api/messages', methods=['GET'])
 def get_messages():
-    """Get conversation history for a user."""
+    """Get a page of conversation history for a user.
+    
+    Query parameters:
+        user_id: The user whose messages to return (required)
+        before: Return messages older than this message id
+        after: Return messages newer than this message id
+        limit: Page size (default 50, max 200)
+    
+    Without a cursor the newest page is returned. Messages are always in
+    chronological order; 'has_more' tells whether another page exists in
+    the requested direction.
+    """
     try:
         user_id = request.args.get('user_id')
         
@@ -430,12 +867,49 @@ def get_messages():
                 'message': 'User ID is required'
             }), 400
         
+        before = request.args.get('before', type=int)
+        after = request.args.get('after', type=int)
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        
         if is_database_available():
             # Database storage path
             from models import Message
+            from sqlalchemy import and_, or_
             
-            # Get messages for the user
-            messages = Message.query.filter_by(user_id=user_id).order_by(Message.timestamp).all()
+            # Messages up to the user's last clear are hidden until the reaper deletes them
+            query = visible_messages(Message.query.filter(Message.user_id == user_id), user_id)
+            cursor_id = after if after is not None else before
+            if cursor_id is not None:
+                # Resolve the cursor message to its (timestamp, id) position
+                cursor = visible_messages(Message.query.filter_by(id=cursor_id, user_id=user_id), user_id).first()
+                if not cursor:
+                    return jsonify({
+                        'status': 'error',
+                        'message': 'Cursor message not found'
+                    }), 400
+                if after is not None:
+                    query = query.filter(or_(
+                        Message.timestamp > cursor.timestamp,
+                        and_(Message.timestamp == cursor.timestamp, Message.id > cursor.id)
+                    ))
+                else:
+                    query = query.filter(or_(
+                        Message.timestamp < cursor.timestamp,
+                        and_(Message.timestamp == cursor.timestamp, Message.id < cursor.id)
+                    ))
+            
+            # Walk the (user_id, timestamp, id) index in the direction of the page
+            if after is not None:
+                query = query.order_by(Message.timestamp, Message.id)
+            else:
+                query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+            
+            # Fetch one extra row to learn whether another page exists
+            messages = query.limit(limit + 1).all()
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            if after is None:
+                messages.reverse()
             
             # Convert messages to dictionaries
             message_list = [msg.to_dict() for msg in messages]
@@ -443,8 +917,10 @@ def get_messages():
             # Fallback storage path
             from utils.db_fallback import get_messages_for_user
             
-            # Get messages from in-memory storage
-            raw_messages = get_messages_for_user(int(user_id))
+            # Get messages from in-memory storage (ids increase with time)
+            raw_messages = get_messages_for_user(int(user_id), before, after, limit + 1)
+            has_more = len(raw_messages) > limit
+            raw_messages = raw_messages[:limit] if after is not None else raw_messages[-limit:]
             
             # Convert to a format similar to the database message format
             message_list = [{
@@ -453,15 +929,18 @@ def get_messages():
                 'role': msg['role'],
                 'timestamp': msg['timestamp'] or '',
                 'user_id': msg['user_id'],
-                'has_image': False,  # Not supported in fallback
+                'has_image': bool(msg['image_ref'] or msg['image_data']),
+                'image_url': f"/api/images/{msg['image_ref']}" if msg['image_ref'] else None,
                 'is_streaming': False,
-                'reasoning_effort': None,
-                'reasoning_summary': None
+                'reasoning_effort': msg['reasoning_effort'],
+                'reasoning_summary': msg['reasoning_summary'],
+                'conversation_id': msg['conversation_id']
             } for msg in raw_messages]
         
         return jsonify({
             'status': 'success',
-            'messages': message_list
+            'messages': message_list,
+            'has_more': has_more
         })
     except Exception as e:
         logging.error(f"Error in get_messages endpoint: {str(e)}")
@@ -470,7 +949,7 @@ def get_messages():
             'message': f"An error occurred: {str(e)}"
         }), 500
         
-@app.route('/api/messages/<int:message_id>/image', methods=['GET'])
+@bp.route('/api/messages/<int:message_id>/image', methods=['GET'])
 def get_message_image(message_id):
     """Get image data for a specific message."""
     try:
@@ -487,7 +966,7 @@ def get_message_image(message_id):
             from models import Message
             
             # Get the message and verify it belongs to the user
-            message = Message.query.filter_by(id=message_id, user_id=user_id).first()
+            message = visible_messages(Message.query.filter_by(id=message_id, user_id=user_id), user_id).first()
             
             if not message:
                 return jsonify({
@@ -495,6 +974,14 @@ def get_message_image(message_id):
                     'message': 'Message not found or does not belong to this user'
                 }), 404
             
+            # Images in the blob store are served by /api/images/<id>
+            if message.image_ref:
+                return jsonify({
+                    'status': 'success',
+                    'image_url': f"/api/images/{message.image_ref}",
+                    'image_data': get_blob_store().read_base64(message.image_ref)
+                })
+            
             # Check if message has image data
             if not message.image_data:
                 return jsonify({
@@ -509,11 +996,25 @@ def get_message_image(message_id):
             })
         else:
             # Fallback storage path
-            # Note: In-memory storage doesn't support image data, so we'll return an error
+            from utils.db_fallback import get_message
+            
+            message = get_message(int(user_id), message_id)
+            if not message or not (message['image_ref'] or message['image_data']):
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Message not found or does not have an image'
+                }), 404
+            
+            if message['image_ref']:
+                return jsonify({
+                    'status': 'success',
+                    'image_url': f"/api/images/{message['image_ref']}",
+                    'image_data': get_blob_store().read_base64(message['image_ref'])
+                })
             return jsonify({
-                'status': 'error',
-                'message': 'Image retrieval is not available in fallback mode'
-            }), 503  # Service Unavailable
+                'status': 'success',
+                'image_data': message['image_data']
+            })
             
     except Exception as e:
         logging.error(f"Error in get_message_image endpoint: {str(e)}")
@@ -522,12 +1023,19 @@ def get_message_image(message_id):
             'message': f"An error occurred: {str(e)}"
         }), 500
         
-@app.route('/api/messages/clear', methods=['POST'])
-def clear_messages():
-    """Clear all messages for a user."""
+@bp.route('/api/messages/images', methods=['POST'])
+def get_message_images():
+    """Get thumbnails for many messages' images in one request.
+    
+    Expects JSON {'user_id': ..., 'message_ids': [...]}. Returns, per message
+    id with an image, the URL of the full-size image and a small JPEG
+    thumbnail as a data URI (null when thumbnails are unavailable).
+    Legacy inline images are moved into the blob store on the way.
+    """
     try:
         data = request.json
         user_id = data.get('user_id')
+        message_ids = data.get('message_ids') or []
         
         if not user_id:
             return jsonify({
@@ -535,13 +1043,94 @@ def clear_messages():
                 'message': 'User ID is required'
             }), 400
         
+        if len(message_ids) > MAX_PAGE_SIZE:
+            return jsonify({
+                'status': 'error',
+                'message': f"At most {MAX_PAGE_SIZE} message ids can be requested at once"
+            }), 400
+        
+        import base64
+        from utils.thumbnails import get_thumbnail
+        
+        store = get_blob_store()
+        images = {}
+        
+        def add_image(message_id, image_ref):
+            thumbnail = get_thumbnail(store, image_ref)
+            images[str(message_id)] = {
+                'image_url': f"/api/images/{image_ref}",
+                'thumbnail': f"data:image/jpeg;base64,{base64.b64encode(thumbnail).decode('utf-8')}" if thumbnail else None
+            }
+        
+        def store_legacy_image(image_data):
+            raw = base64.b64decode(image_data)
+            return store.put(raw, sniff_image_type(raw) or 'application/octet-stream')
+        
         if is_database_available():
             # Database storage path
+            from sqlalchemy import or_
             from models import Message
             
-            # Delete all messages for the user
-            Message.query.filter_by(user_id=user_id).delete()
-            db.session.commit()
+            # One query for the whole page, restricted to the user's own messages
+            messages = visible_messages(Message.query.filter(
+                Message.user_id == user_id,
+                Message.id.in_([int(message_id) for message_id in message_ids]),
+                or_(Message.image_ref.isnot(None), Message.image_data.isnot(None))
+            ), user_id).all()
+            
+            migrated = False
+            for message in messages:
+                if not message.image_ref:
+                    message.image_ref = store_legacy_image(message.image_data)
+                    message.image_data = None
+                    migrated = True
+                add_image(message.id, message.image_ref)
+            
+            if migrated:
+                db.session.commit()
+        else:
+            # Fallback storage path
+            from utils.db_fallback import get_message
+            
+            for message_id in message_ids:
+                message = get_message(int(user_id), int(message_id))
+                if not message:
+                    continue
+                if message['image_ref']:
+                    add_image(message['id'], message['image_ref'])
+                elif message['image_data']:
+                    add_image(message['id'], store_legacy_image(message['image_data']))
+        
+        return jsonify({
+            'status': 'success',
+            'images': images
+        })
+    except Exception as e:
+        if is_database_available():
+            db.session.rollback()
+        logging.error(f"Error in get_message_images endpoint: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }), 500
+        
+@bp.route('/api/messages/clear', methods=['POST'])
+def clear_messages():
+    """Clear all messages for a user; the rows are deleted in the background."""
+    try:
+        data = request.json
+        user_id = data.get('user_id')
+        
+        if not user_id:
+            return jsonify({
+                'status': 'error',
+                'message': 'User ID is required'
+            }), 400
+        
+        if is_database_available():
+            # Database storage path: hide the messages now, delete them in the background
+            clear_history(int(user_id))
+            conversation_store.invalidate(int(user_id))
             
             logging.debug(f"Cleared database messages for user ID: {user_id}")
         else:
@@ -564,12 +1153,49 @@ def clear_messages():
             'message': f"An error occurred: {str(e)}"
         }), 500
 
+@bp.route('/api/messages/clear/status', methods=['GET'])
+def get_clear_status():
+    """Get the progress of deleting a user's cleared messages in the background."""
+    try:
+        user_id = request.args.get('user_id', type=int)
+        
+        if not user_id:
+            return jsonify({
+                'status': 'error',
+                'message': 'User ID is required'
+            }), 400
+        
+        if not is_database_available():
+            # In-memory clears are immediate
+            return jsonify({
+                'status': 'success',
+                'clear': {'pending_messages': 0, 'complete': True}
+            })
+        
+        status = clear_status(user_id)
+        if status is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'User not found'
+            }), 404
+        return jsonify({
+            'status': 'success',
+            'clear': status,
+            'reaper': message_reaper.get_stats()
+        })
+    except Exception as e:
+        logging.error(f"Error in get_clear_status endpoint: {str(e)}")
+        return jsonify({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }), 500
+
 # Error handlers
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(e):
     return render_template('index.html'), 404
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def server_error(e):
     return jsonify({
         'status': 'error',
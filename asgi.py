@@ -0,0 +1,349 @@
+"""
+ASGI entry point serving the chat endpoints asynchronously.
+
+``/api/chat`` and ``/api/chat/stream`` run on the event loop with
+``AsyncAzureOpenAI`` and an async database session, so a long streaming
+response no longer pins a worker; one process can multiplex hundreds of
+concurrent streams. Every other route is served by the regular Flask app
+through a WSGI adapter.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+or under gunicorn:
+    gunicorn -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:5000 asgi:app
+"""
+import math
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # pragma: no cover - starlette's adapter is deprecated but still works
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+from app import is_database_available
+from wsgi import app as flask_app
+from utils import client_registry
+from utils.async_db import get_session_factory, dispose
+from utils.blob_store import get_blob_store
+from utils.conversation_store import conversation_store
+from utils.context_window import apply_context_budget, count_message_tokens
+from utils.openai_helper import async_generate_ai_response, async_stream_ai_response, AZURE_OPENAI_DEPLOYMENT_NAME
+from utils.stream_buffer import get_stream_bus, async_follow_stream, parse_event_id
+from utils.generation import StreamJob, async_generation_pool, snapshot_from_row, STATUS_QUEUED
+from utils.scheduler import SchedulerOverloaded
+from utils import metrics
+from utils.log_config import RequestIdMiddleware
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # For Nginx
+    'Connection': 'keep-alive'
+}
+
+def _prepare_history(conversation_history, user_id, conversation_id, model, message_content, image_data,
+                     developer_message):
+    """Assemble and budget the prompt history (runs in a thread with a Flask app context).
+
+    Returns:
+        tuple: (conversation_history, previous_response_id, previous_response_endpoint)
+    """
+    with flask_app.app_context():
+        previous_response_id = previous_response_endpoint = None
+        if conversation_history is None:
+            conversation_history = []
+            if user_id and conversation_id:
+                conversation_history, previous_response_id, previous_response_endpoint = conversation_store.get_history(
+                    user_id, conversation_id
+                )
+
+        summary_owner = user_id if conversation_id and is_database_available() else None
+        conversation_history, context_report = apply_context_budget(
+            conversation_history,
+            model,
+            message_content,
+            image_data,
+            developer_message,
+            summary_owner,
+            conversation_id
+        )
+        if context_report['over_budget']:
+            previous_response_id = None
+        return conversation_history, previous_response_id, previous_response_endpoint
+
+async def _store_incoming_messages(session, user_id, message_content, image_data, image_id, developer_message,
+                                   conversation_id):
+    """Persist the user's message (and developer message) before calling the model."""
+    if is_database_available():
+        from models import Message
+
+        session.add(Message(
+            content=message_content,
+            role='user',
+            user_id=user_id,
+            image_data=None if image_id else image_data,
+            image_ref=image_id,
+            conversation_id=conversation_id,
+            token_count=count_message_tokens(message_content, image_data)
+        ))
+        if developer_message:
+            session.add(Message(
+                content=developer_message,
+                role='developer',
+                user_id=user_id,
+                conversation_id=conversation_id,
+                token_count=count_message_tokens(developer_message)
+            ))
+        await session.commit()
+    else:
+        from utils.db_fallback import add_message
+
+        add_message(user_id, message_content, 'user', conversation_id,
+                    image_data=None if image_id else image_data, image_ref=image_id)
+        if developer_message:
+            add_message(user_id, developer_message, 'developer', conversation_id)
+
+async def chat(request):
+    """Process chat messages and get AI responses (async)."""
+    started = time.perf_counter()
+    try:
+        data = await request.json()
+
+        message_content = data.get('message', '')
+        conversation_history = data.get('conversation_history')
+        conversation_id = data.get('conversation_id')
+        image_id = data.get('image_id')
+        image_data = data.get('image_data')
+        use_streaming = data.get('streaming', False)
+        reasoning_effort = data.get('reasoning_effort')
+        developer_message = data.get('developer_message')
+        model = data.get('model')
+        model_label = model or AZURE_OPENAI_DEPLOYMENT_NAME
+        use_cache = data.get('cache', True)
+        priority = data.get('priority')
+        user_id = int(data['user_id']) if data.get('user_id') else None
+
+        if image_id:
+            store = get_blob_store()
+            if not store.exists(image_id):
+                return JSONResponse({
+                    'status': 'error',
+                    'message': 'Image not found'
+                }, status_code=400)
+            image_data = await asyncio.to_thread(store.read_base64, image_id)
+
+        conversation_history, previous_response_id, previous_response_endpoint = await asyncio.to_thread(
+            _prepare_history,
+            conversation_history,
+            user_id,
+            conversation_id,
+            model,
+            message_content,
+            image_data,
+            developer_message
+        )
+
+        logging.debug(f"Conversation history length: {len(conversation_history)}")
+
+        session_factory = get_session_factory() if is_database_available() else None
+
+        async def store_incoming_messages():
+            if not user_id:
+                return
+            if session_factory:
+                async with session_factory() as session:
+                    await _store_incoming_messages(session, user_id, message_content, image_data, image_id,
+                                                   developer_message, conversation_id)
+            else:
+                await _store_incoming_messages(None, user_id, message_content, image_data, image_id,
+                                               developer_message, conversation_id)
+
+        if use_streaming:
+            response_meta = {}
+            events = async_stream_ai_response(
+                message_content,
+                conversation_history,
+                image_data,
+                reasoning_effort,
+                developer_message,
+                model,
+                previous_response_id,
+                response_meta,
+                use_cache,
+                priority,
+                previous_response_endpoint
+            )
+            # The stream doesn't start until the job runs, so the scheduler admits it
+            # (and may shed it) only once a job slot is free
+            await store_incoming_messages()
+
+            # Every frame is numbered and kept on the stream bus so clients can resume or watch it
+            stream = get_stream_bus().open()
+            if user_id and session_factory:
+                from models import Message
+
+                async with session_factory() as session:
+                    ai_message = Message(
+                        content="",
+                        role='assistant',
+                        user_id=user_id,
+                        is_streaming=True,
+                        status=STATUS_QUEUED,
+                        reasoning_effort=reasoning_effort,
+                        conversation_id=conversation_id,
+                        stream_id=stream.stream_id
+                    )
+                    session.add(ai_message)
+                    await session.commit()
+                    stream.message_id = ai_message.id
+            stream.append({'stream_id': stream.stream_id, 'message_id': stream.message_id}, 'stream')
+
+            # Generate in a background task; this request is just one subscriber of the stream
+            async_generation_pool.submit(StreamJob(
+                events,
+                stream,
+                stream.message_id,
+                user_id,
+                conversation_id,
+                reasoning_effort,
+                response_meta
+            ), flask_app)
+            stream_id = stream.stream_id
+            frames = async_follow_stream(stream_id, None, lambda: _load_stream_message(stream_id), resumed=False)
+
+            return StreamingResponse(metrics.track_stream_async(frames, model_label, started),
+                                     media_type='text/event-stream', headers=SSE_HEADERS)
+
+        response_meta = {}
+        ai_response, reasoning_summary = await async_generate_ai_response(
+            message_content,
+            conversation_history,
+            image_data,
+            reasoning_effort,
+            developer_message,
+            model,
+            previous_response_id,
+            response_meta,
+            use_cache,
+            priority,
+            previous_response_endpoint
+        )
+        await store_incoming_messages()
+
+        if user_id:
+            if session_factory:
+                from models import Message
+
+                async with session_factory() as session:
+                    session.add(Message(
+                        content=ai_response,
+                        role='assistant',
+                        user_id=user_id,
+                        reasoning_effort=reasoning_effort,
+                        reasoning_summary=reasoning_summary,
+                        conversation_id=conversation_id,
+                        response_id=response_meta.get('response_id'),
+                        response_endpoint=response_meta.get('response_endpoint'),
+                        token_count=count_message_tokens(ai_response)
+                    ))
+                    await session.commit()
+            else:
+                from utils.db_fallback import add_message
+                add_message(user_id, ai_response, 'assistant', conversation_id,
+                            reasoning_effort=reasoning_effort, reasoning_summary=reasoning_summary)
+
+        response_data = {
+            'status': 'success',
+            'response': ai_response
+        }
+        if response_meta.get('cached'):
+            response_data['cached'] = True
+        if reasoning_summary:
+            response_data['reasoning_summary'] = reasoning_summary
+
+        metrics.observe_chat(model_label, started)
+        return JSONResponse(response_data)
+    except SchedulerOverloaded as e:
+        logging.warning(f"Shedding async chat request: {str(e)}")
+        return JSONResponse({
+            'status': 'error',
+            'message': 'The model is busy right now, please try again shortly',
+            'retry_after': math.ceil(e.retry_after)
+        }, status_code=503, headers={'Retry-After': str(math.ceil(e.retry_after))})
+    except Exception as e:
+        logging.error(f"Error in async chat endpoint: {str(e)}")
+        return JSONResponse({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }, status_code=500)
+
+async def _load_stream_message(stream_id):
+    """Return the MessageSnapshot of the assistant message produced by a stream, or None."""
+    if not is_database_available():
+        return None
+    from sqlalchemy import select
+    from models import Message
+
+    async with get_session_factory()() as session:
+        row = (await session.execute(
+            select(Message.content, Message.reasoning_summary, Message.is_streaming, Message.is_truncated,
+                   Message.status)
+            .where(Message.stream_id == stream_id)
+        )).first()
+    return snapshot_from_row(row) if row else None
+
+async def chat_stream(request):
+    """Follow a /api/chat stream from the frame after Last-Event-ID (async)."""
+    try:
+        stream_id = request.query_params.get('stream_id')
+        last_event_id = request.headers.get('last-event-id') or request.query_params.get('last_event_id')
+        if not stream_id:
+            return JSONResponse({
+                'status': 'error',
+                'message': 'stream_id is required'
+            }, status_code=400)
+        try:
+            parse_event_id(last_event_id)
+        except ValueError:
+            return JSONResponse({
+                'status': 'error',
+                'message': 'Invalid Last-Event-ID'
+            }, status_code=400)
+
+        if not get_stream_bus().has(stream_id) and await _load_stream_message(stream_id) is None:
+            return JSONResponse({
+                'status': 'error',
+                'message': 'Stream not found'
+            }, status_code=404)
+
+        frames = async_follow_stream(stream_id, last_event_id, lambda: _load_stream_message(stream_id))
+        return StreamingResponse(frames, media_type='text/event-stream', headers=SSE_HEADERS)
+    except Exception as e:
+        logging.error(f"Error in async chat stream endpoint: {str(e)}")
+        return JSONResponse({
+            'status': 'error',
+            'message': f"An error occurred: {str(e)}"
+        }, status_code=500)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await client_registry.aclose_all()
+    await dispose()
+
+app = Starlette(
+    routes=[
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/stream', chat_stream, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    middleware=[Middleware(RequestIdMiddleware)],
+    lifespan=lifespan
+)
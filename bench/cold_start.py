@@ -0,0 +1,102 @@
+"""
+Cold-start benchmark: time from launching a server until it answers.
+
+Measures, over several runs each:
+
+- ``import``: ``import app`` in a fresh interpreter (no database access)
+- ``create_app``: import plus create_app()
+- ``gunicorn``: launching gunicorn until /api/models answers, every worker
+  warming itself up
+- ``gunicorn --preload``: the same with the warm-up done once in the master
+
+The database is a fresh SQLite file, migrated before the runs. The last
+lines of gunicorn's log include each worker's fork-to-ready time.
+
+Usage:
+    python bench/cold_start.py --runs 5 --workers 4
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import http.client
+
+from harness import ROOT, free_port, migrate, percentile
+
+def time_python(code, env):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def wait_for_response(port, path, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+            conn.request("GET", path)
+            status = conn.getresponse().status
+            conn.close()
+            if status == 200:
+                return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError(f"Server on port {port} did not answer {path}")
+
+def time_gunicorn(env, workers, preload, log_path):
+    port = free_port()
+    cmd = ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "wsgi:app"]
+    if preload:
+        cmd.insert(1, "--preload")
+    with open(log_path, "a") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=log)
+        try:
+            wait_for_response(port, "/api/models")
+            elapsed = time.perf_counter() - started
+        finally:
+            process.terminate()
+            process.wait()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="cold-start-")
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+        "AZURE_OPENAI_ENDPOINT": "http://127.0.0.1:9",
+        "AZURE_OPENAI_API_KEY": "bench",
+        "BLOB_STORE_DIR": os.path.join(work_dir, "blobs"),
+    })
+    migrate(env)
+    log_path = os.path.join(work_dir, "gunicorn.log")
+
+    scenarios = [
+        ("import", lambda: time_python("import app", env)),
+        ("create_app", lambda: time_python("import app; app.create_app()", env)),
+        ("gunicorn", lambda: time_gunicorn(env, args.workers, False, log_path)),
+        ("gunicorn --preload", lambda: time_gunicorn(env, args.workers, True, log_path)),
+    ]
+    print(f"{args.runs} runs each, {args.workers} gunicorn workers")
+    print(f"{'scenario':<20} {'p50':>9} {'max':>9}")
+    for name, run in scenarios:
+        timings = [run() for _ in range(args.runs)]
+        print(f"{name:<20} {percentile(timings, 50):>8.3f}s {max(timings):>8.3f}s")
+
+    with open(log_path) as f:
+        boots = [line.strip() for line in f if "after fork" in line]
+    if boots:
+        print("Worker boot times (latest run):")
+        for line in boots[-args.workers:]:
+            print(f"  {line}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
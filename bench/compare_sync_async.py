@@ -0,0 +1,105 @@
+"""
+Side-by-side benchmark of the sync (gunicorn) and async (uvicorn) chat paths.
+
+Starts the mock Azure OpenAI upstream (bench/mock_azure.py) streaming at a fixed pace,
+launches the app once under each server, fires the same number of
+concurrent streaming ``/api/chat`` requests at both and prints time to
+first byte, total stream time and completed streams per second.
+
+Usage:
+    python bench/compare_sync_async.py --concurrency 100 --tokens 50 --token-delay 0.05
+
+The mock means no Azure quota is used. Pass ``--database-url`` to include
+message persistence (defaults to a throwaway SQLite file).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+import http.client
+
+from harness import free_port, start_server, percentile
+from mock_azure import MockConfig, start_mock_server
+
+def one_stream(port, results):
+    body = json.dumps({"message": "hello", "streaming": True, "model": "gpt-4o"})
+    start = time.perf_counter()
+    first_byte = None
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+        conn.request("POST", "/api/chat", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        while True:
+            data = response.read1(65536) if hasattr(response, "read1") else response.read(1)
+            if not data:
+                break
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+        conn.close()
+        results.append((first_byte, time.perf_counter() - start, True))
+    except Exception:
+        results.append((first_byte, time.perf_counter() - start, False))
+
+def run_load(port, concurrency):
+    results = []
+    threads = [threading.Thread(target=one_stream, args=(port, results)) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def report(name, results, elapsed):
+    ok = [r for r in results if r[2]]
+    ttfb = [r[0] for r in ok if r[0] is not None]
+    total = [r[1] for r in ok]
+    print(f"{name:>6}: {len(ok)}/{len(results)} ok  "
+          f"ttfb p50={percentile(ttfb, 50):.3f}s p99={percentile(ttfb, 99):.3f}s  "
+          f"total p50={percentile(total, 50):.3f}s p99={percentile(total, 99):.3f}s  "
+          f"streams/s={len(ok) / elapsed:.1f}  mean={statistics.mean(total) if total else float('nan'):.3f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--token-delay", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes for both servers")
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+
+    stub, stub_port = start_mock_server(MockConfig(
+        ttft=args.token_delay,
+        tokens_per_second=1.0 / args.token_delay if args.token_delay else 0.0,
+        output_tokens=args.tokens
+    ))
+
+    db_dir = tempfile.mkdtemp(prefix="bench-")
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{stub_port}",
+        "AZURE_OPENAI_API_KEY": "bench",
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(db_dir, 'bench.db')}",
+    })
+
+    print(f"{args.concurrency} concurrent streams, {args.tokens} tokens every {args.token_delay}s, "
+          f"{args.workers} worker(s) per server")
+    for kind in ("sync", "async"):
+        port = free_port()
+        process = start_server(kind, port, env, args.workers)
+        try:
+            results, elapsed = run_load(port, args.concurrency)
+            report(kind, results, elapsed)
+        finally:
+            process.terminate()
+            process.wait()
+
+    stub.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
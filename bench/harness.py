@@ -0,0 +1,119 @@
+"""
+Helpers shared by the benchmark scripts: ports, app server processes,
+percentiles, memory sampling and /metrics scraping.
+"""
+import os
+import re
+import time
+import socket
+import threading
+import subprocess
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+def migrate(env):
+    """Create the schema of the database in env's DATABASE_URL."""
+    subprocess.run(["flask", "--app", "app:create_app", "migrate"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def start_server(kind, port, env, workers, preload=False):
+    """Migrate, then start the app under gunicorn ("sync") or uvicorn ("async") and wait until it listens."""
+    migrate(env)
+    if kind == "sync":
+        cmd = ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "wsgi:app"]
+        if preload:
+            cmd.insert(1, "--preload")
+    else:
+        cmd = ["uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    process = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+class RssSampler:
+    """Samples the resident memory of a process tree (Linux /proc) and keeps the peak."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            pids = [self.pid]
+            for pid in pids:
+                pids.extend(_children(pid))
+            self.peak = max(self.peak, sum(_rss_bytes(pid) for pid in pids))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.exists(f"/proc/{self.pid}"):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+METRIC_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$")
+
+def scrape_metrics(host, port):
+    """Return {name: value} of the app's /metrics (label sets summed), or None if unavailable."""
+    try:
+        conn = http.client.HTTPConnection(host, port, timeout=10)
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        body = response.read().decode()
+        conn.close()
+    except OSError:
+        return None
+    if response.status != 200:
+        return None
+    values = {}
+    for line in body.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            values[match.group(1)] = values.get(match.group(1), 0.0) + float(match.group(3))
+    return values
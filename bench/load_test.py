@@ -0,0 +1,262 @@
+"""
+Load test of the chat app against the mock Azure OpenAI server.
+
+Simulates users who register, hold conversations of realistic length
+(some turns with an uploaded image, most of them streamed) and then page
+through their history:
+
+- POST /api/users
+- POST /api/upload-image for image turns
+- POST /api/chat as JSON or SSE, with a conversation_id so history is
+  assembled server-side
+- GET /api/messages
+
+The report gives request counts, errors and p50/p99 latency per operation,
+SSE time to first token, requests per second, database statements and
+commits per request and the peak RSS of the server processes. The database
+figures come from /metrics, so install the "metrics" extra; they cover the
+Flask request path only.
+
+Usage:
+    python bench/load_test.py --users 50 --concurrency 20 --turns 6
+    python bench/load_test.py --server async --database-url postgresql://localhost/chat_bench
+    python bench/load_test.py --target 127.0.0.1:5000    # an app that is already running
+
+Runs are seeded (--seed) and default to a throwaway SQLite database. With
+--json the report is also written as JSON, to compare runs between commits.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import argparse
+import tempfile
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+from harness import free_port, start_server, percentile, RssSampler, scrape_metrics
+from mock_azure import WORDS, add_arguments, config_from_args, start_mock_server
+
+# Words per message and their relative frequency: mostly short turns, some long pastes
+MESSAGE_LENGTHS = ((6, 30), (20, 35), (60, 20), (200, 10), (600, 5))
+IMAGE_SIZES = ((320, 240), (640, 480), (1024, 768))
+OPERATIONS = ("users", "upload", "chat_json", "chat_sse", "messages")
+
+def make_png(rng, width, height):
+    """Return a noise PNG; noise doesn't compress, so the size is like a photo's."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 1))
+            + chunk(b"IEND", b""))
+
+def make_message(rng):
+    words = rng.choices([length for length, _ in MESSAGE_LENGTHS], [weight for _, weight in MESSAGE_LENGTHS])[0]
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+class Client:
+    """Issues requests to the app and records their latency."""
+
+    def __init__(self, host, port, records):
+        self.host = host
+        self.port = port
+        self.records = records
+
+    def _send(self, operation, method, path, body=None, headers=None, stream=False):
+        started = time.perf_counter()
+        ttft = None
+        try:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            if stream:
+                data, ttft = self._read_stream(response, started)
+            else:
+                data = response.read()
+            conn.close()
+            ok = response.status < 400
+        except OSError:
+            data, ok = b"", False
+        self.records.append((operation, time.perf_counter() - started, ok, ttft))
+        return data if ok else None
+
+    def _read_stream(self, response, started):
+        """Read an SSE body; return (body, seconds until the first streamed text)."""
+        ttft = None
+        body = b""
+        while True:
+            data = response.read1(65536)
+            if not data:
+                return body, ttft
+            body += data
+            if ttft is None and (b'{"chunk":' in body or b"event: reasoning_summary" in body):
+                ttft = time.perf_counter() - started
+
+    def post_json(self, operation, path, payload, stream=False):
+        data = self._send(operation, "POST", path, json.dumps(payload), {"Content-Type": "application/json"}, stream)
+        if data is None or stream:
+            return data
+        return json.loads(data)
+
+    def get_json(self, operation, path):
+        data = self._send(operation, "GET", path)
+        return json.loads(data) if data is not None else None
+
+    def upload_image(self, image):
+        boundary = "bench-boundary"
+        body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"image.png\"\r\n"
+                f"Content-Type: image/png\r\n\r\n").encode() + image + f"\r\n--{boundary}--\r\n".encode()
+        data = self._send("upload", "POST", "/api/upload-image", body,
+                          {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        return json.loads(data).get("image_id") if data is not None else None
+
+def run_user(index, args, client):
+    """One simulated user: register, chat for a few turns, then load the history."""
+    rng = random.Random(args.seed * 100003 + index)
+    registered = client.post_json("users", "/api/users", {"username": f"bench-{args.seed}-{index}"})
+    if not registered or not registered.get("user_id"):
+        return
+    user_id = registered["user_id"]
+    conversation_id = f"bench-{args.seed}-{index}"
+
+    turns = rng.randint(max(1, args.turns // 2), max(1, args.turns * 3 // 2))
+    for _ in range(turns):
+        payload = {
+            "message": make_message(rng),
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "model": args.model
+        }
+        if rng.random() < args.image_rate:
+            image_id = client.upload_image(make_png(rng, *rng.choice(IMAGE_SIZES)))
+            if image_id:
+                payload["image_id"] = image_id
+        if rng.random() < args.stream_rate:
+            payload["streaming"] = True
+            client.post_json("chat_sse", "/api/chat", payload, stream=True)
+        else:
+            client.post_json("chat_json", "/api/chat", payload)
+
+    client.get_json("messages", f"/api/messages?user_id={user_id}&limit=50")
+
+def _per_request(before, after, name):
+    if before is None or after is None:
+        return None
+    count = after.get(f"{name}_count", 0) - before.get(f"{name}_count", 0)
+    total = after.get(f"{name}_sum", 0) - before.get(f"{name}_sum", 0)
+    return total / count if count else None
+
+def build_report(records, elapsed, metrics_before, metrics_after, peak_rss, mock_stats):
+    operations = {}
+    for operation in OPERATIONS:
+        latencies = [latency for op, latency, ok, _ in records if op == operation and ok]
+        errors = sum(1 for op, _, ok, _ in records if op == operation and not ok)
+        if latencies or errors:
+            operations[operation] = {
+                'requests': len(latencies) + errors,
+                'errors': errors,
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99)
+            }
+    ttft = [ttft for op, _, ok, ttft in records if op == "chat_sse" and ok and ttft is not None]
+    return {
+        'operations': operations,
+        'sse_ttft': {'p50': percentile(ttft, 50), 'p99': percentile(ttft, 99)},
+        'requests': len(records),
+        'elapsed': elapsed,
+        'requests_per_second': len(records) / elapsed if elapsed else 0.0,
+        'db_statements_per_request': _per_request(metrics_before, metrics_after, "db_statements_per_request"),
+        'db_commits_per_request': _per_request(metrics_before, metrics_after, "db_commits_per_request"),
+        'peak_rss_bytes': peak_rss,
+        'upstream': mock_stats
+    }
+
+def print_report(report):
+    print(f"{'operation':<10} {'requests':>8} {'errors':>6} {'p50':>9} {'p99':>9}")
+    for operation, stats in report['operations'].items():
+        print(f"{operation:<10} {stats['requests']:>8} {stats['errors']:>6} "
+              f"{stats['p50']:>8.3f}s {stats['p99']:>8.3f}s")
+    print(f"SSE time to first token: p50={report['sse_ttft']['p50']:.3f}s p99={report['sse_ttft']['p99']:.3f}s")
+    print(f"Throughput: {report['requests_per_second']:.1f} requests/s "
+          f"({report['requests']} requests in {report['elapsed']:.1f}s)")
+    for key, label in (('db_statements_per_request', "DB statements/request"),
+                       ('db_commits_per_request', "DB commits/request")):
+        value = report[key]
+        print(f"{label}: {value:.2f}" if value is not None else f"{label}: n/a (needs prometheus_client)")
+    if report['peak_rss_bytes']:
+        print(f"Peak server RSS: {report['peak_rss_bytes'] / (1024 * 1024):.1f} MB")
+    if report['upstream']:
+        print(f"Mock upstream: {report['upstream']['requests']} requests, "
+              f"{report['upstream']['errors']} injected errors")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Simulated users in total")
+    parser.add_argument("--concurrency", type=int, default=10, help="Users active at the same time")
+    parser.add_argument("--turns", type=int, default=6, help="Mean chat turns per user")
+    parser.add_argument("--stream-rate", type=float, default=0.8, help="Fraction of turns streamed over SSE")
+    parser.add_argument("--image-rate", type=float, default=0.1, help="Fraction of turns with an image")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server", choices=("sync", "async"), default="sync")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--database-url", default=None, help="Defaults to a throwaway SQLite file")
+    parser.add_argument("--target", default=None, help="host:port of a running app; no servers are started")
+    parser.add_argument("--json", default=None, help="Also write the report to this file")
+    add_arguments(parser, prefix="mock-")
+    args = parser.parse_args()
+
+    mock_config = None
+    process = None
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+        port = int(port)
+    else:
+        mock_config = config_from_args(args, prefix="mock-", seed=args.seed)
+        mock, mock_port = start_mock_server(mock_config)
+        work_dir = tempfile.mkdtemp(prefix="load-test-")
+        env = dict(os.environ)
+        env.update({
+            "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{mock_port}",
+            "AZURE_OPENAI_API_KEY": "bench",
+            "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+            "BLOB_STORE_DIR": os.path.join(work_dir, "blobs"),
+            "PROMETHEUS_MULTIPROC_DIR": os.path.join(work_dir, "metrics"),
+        })
+        os.makedirs(env["PROMETHEUS_MULTIPROC_DIR"])
+        host, port = "127.0.0.1", free_port()
+        process = start_server(args.server, port, env, args.workers)
+
+    print(f"{args.users} users ({args.concurrency} concurrent), ~{args.turns} turns each, "
+          f"{args.stream_rate:.0%} streamed, {args.image_rate:.0%} with images")
+    records = []
+    client = Client(host, port, records)
+    try:
+        metrics_before = scrape_metrics(host, port)
+        with RssSampler(process.pid if process else -1) as sampler:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(lambda index: run_user(index, args, client), range(args.users)))
+            elapsed = time.perf_counter() - started
+        metrics_after = scrape_metrics(host, port)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = build_report(records, elapsed, metrics_before, metrics_after, sampler.peak,
+                          dict(mock_config.stats) if mock_config else None)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
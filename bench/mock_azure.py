@@ -0,0 +1,255 @@
+"""
+Local mock of the Azure OpenAI Chat Completions and Responses APIs.
+
+Answers both APIs, streaming and non-streaming, at a configurable pace so
+the app's throughput can be measured without spending Azure quota:
+responses start after ``--ttft`` seconds and then produce
+``--tokens-per-second`` tokens until ``--output-tokens`` have been sent.
+``--error-rate`` fails that fraction of requests with ``--error-status``
+(429 by default, with Retry-After headers). Responses API requests that ask
+for a reasoning summary get one streamed before the text. Randomness is
+seeded, so a run with the same settings and request order is reproducible.
+
+Usage:
+    python bench/mock_azure.py --port 8001 --ttft 0.4 --tokens-per-second 50 --error-rate 0.02
+
+and point the app at it:
+    AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8001 AZURE_OPENAI_API_KEY=mock python main.py
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "the model answers with a plausible sentence about latency throughput streaming tokens "
+    "database requests users images history context budget deployment region cache"
+).split()
+
+class MockConfig:
+    """Pacing and error injection of the mock server."""
+
+    def __init__(self, ttft=0.3, tokens_per_second=50.0, output_tokens=60, error_rate=0.0,
+                 error_status=429, retry_after=1.0, seed=0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'streams': 0}
+
+    def next_request(self, stream):
+        """Count a request; return (fail, tokens) with tokens as a list of words."""
+        with self._lock:
+            self.stats['requests'] += 1
+            if stream:
+                self.stats['streams'] += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return True, None
+            return False, [self._random.choice(WORDS) + " " for _ in range(self.output_tokens)]
+
+    @property
+    def token_delay(self):
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+def make_handler(config):
+    """Return a request handler class serving the mock APIs with the given config."""
+
+    class MockAzureHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            path = self.path.split("?", 1)[0]
+            if path.endswith("/chat/completions"):
+                api = "chat"
+            elif path.endswith("/responses"):
+                api = "responses"
+            else:
+                self._send_json(404, {"error": {"code": "404", "message": f"Unknown path {path}"}})
+                return
+
+            stream = bool(body.get("stream"))
+            fail, tokens = config.next_request(stream)
+            if fail:
+                self._send_error()
+                return
+
+            time.sleep(config.ttft)
+            if api == "chat":
+                self._stream_chat(body, tokens) if stream else self._complete_chat(body, tokens)
+            else:
+                self._stream_responses(body, tokens) if stream else self._complete_responses(body, tokens)
+
+        def _send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_error(self):
+            headers = {}
+            if config.error_status == 429:
+                headers = {
+                    "retry-after-ms": str(int(config.retry_after * 1000)),
+                    "retry-after": str(max(1, round(config.retry_after)))
+                }
+            self._send_json(config.error_status, {
+                "error": {"code": str(config.error_status), "message": "Injected error from mock server"}
+            }, headers)
+
+        def _start_stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+        def _send_event(self, payload, event=None):
+            prefix = f"event: {event}\n" if event else ""
+            self.wfile.write(f"{prefix}data: {json.dumps(payload)}\n\n".encode())
+            self.wfile.flush()
+
+        def _pace(self, tokens):
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(config.token_delay)
+                yield token
+
+        def _usage(self, body, tokens):
+            prompt_tokens = len(json.dumps(body.get("messages") or body.get("input") or "")) // 4
+            return prompt_tokens, len(tokens)
+
+        def _complete_chat(self, body, tokens):
+            time.sleep(config.token_delay * max(0, len(tokens) - 1))
+            prompt_tokens, completion_tokens = self._usage(body, tokens)
+            self._send_json(200, {
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}
+            })
+
+        def _stream_chat(self, body, tokens):
+            self._start_stream()
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model")}
+            for token in self._pace(tokens):
+                self._send_event(dict(chunk, choices=[{"index": 0, "delta": {"content": token}, "finish_reason": None}]))
+            self._send_event(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                prompt_tokens, completion_tokens = self._usage(body, tokens)
+                self._send_event(dict(chunk, choices=[], usage={
+                    "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens
+                }))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def _summary_tokens(self, body, tokens):
+            if not (body.get("reasoning") or {}).get("summary"):
+                return []
+            return ["Considering "] + tokens[:max(1, len(tokens) // 4)]
+
+        def _response(self, body, status, text="", summary=""):
+            output = []
+            if summary:
+                output.append({"id": "rs_mock", "type": "reasoning",
+                               "summary": [{"type": "summary_text", "text": summary}]})
+            if text:
+                output.append({"id": "msg_mock", "type": "message", "role": "assistant", "status": "completed",
+                               "content": [{"type": "output_text", "text": text, "annotations": []}]})
+            return {"id": "resp_mock", "object": "response", "created_at": int(time.time()), "status": status,
+                    "model": body.get("model"), "output": output}
+
+        def _complete_responses(self, body, tokens):
+            summary = self._summary_tokens(body, tokens)
+            time.sleep(config.token_delay * max(0, len(tokens) + len(summary) - 1))
+            self._send_json(200, self._response(body, "completed", "".join(tokens), "".join(summary)))
+
+        def _stream_responses(self, body, tokens):
+            self._start_stream()
+            sequence = iter(range(1 << 30))
+            self._send_event({"type": "response.created", "sequence_number": next(sequence),
+                              "response": self._response(body, "in_progress")}, "response.created")
+            summary = self._summary_tokens(body, tokens)
+            for token in self._pace(summary):
+                self._send_event({"type": "response.reasoning_summary_text.delta", "sequence_number": next(sequence),
+                                  "item_id": "rs_mock", "output_index": 0, "summary_index": 0, "delta": token},
+                                 "response.reasoning_summary_text.delta")
+            output_index = 1 if summary else 0
+            for token in self._pace(tokens):
+                self._send_event({"type": "response.output_text.delta", "sequence_number": next(sequence),
+                                  "item_id": "msg_mock", "output_index": output_index, "content_index": 0,
+                                  "delta": token}, "response.output_text.delta")
+            self._send_event({"type": "response.completed", "sequence_number": next(sequence),
+                              "response": self._response(body, "completed", "".join(tokens), "".join(summary))},
+                             "response.completed")
+
+    return MockAzureHandler
+
+def start_mock_server(config=None, port=0):
+    """Serve the mock APIs from a background thread; return (server, port)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config or MockConfig()))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-azure").start()
+    return server, server.server_address[1]
+
+def add_arguments(parser, prefix=""):
+    """Add the mock server's pacing and error options to an argument parser."""
+    parser.add_argument(f"--{prefix}ttft", type=float, default=0.3, help="Seconds before the first token")
+    parser.add_argument(f"--{prefix}tokens-per-second", type=float, default=50.0)
+    parser.add_argument(f"--{prefix}output-tokens", type=int, default=60, help="Tokens per response")
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument(f"--{prefix}error-status", type=int, default=429)
+    parser.add_argument(f"--{prefix}retry-after", type=float, default=1.0, help="Retry-After of injected 429s")
+
+def config_from_args(args, prefix="", seed=0):
+    prefix = prefix.replace("-", "_")
+    return MockConfig(
+        ttft=getattr(args, f"{prefix}ttft"),
+        tokens_per_second=getattr(args, f"{prefix}tokens_per_second"),
+        output_tokens=getattr(args, f"{prefix}output_tokens"),
+        error_rate=getattr(args, f"{prefix}error_rate"),
+        error_status=getattr(args, f"{prefix}error_status"),
+        retry_after=getattr(args, f"{prefix}retry_after"),
+        seed=seed
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--seed", type=int, default=0)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    config = config_from_args(args, seed=args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(config))
+    server.daemon_threads = True
+    print(f"Mock Azure OpenAI on http://127.0.0.1:{args.port} (ttft {config.ttft}s, "
+          f"{config.tokens_per_second} tokens/s, error rate {config.error_rate})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Served {config.stats['requests']} requests ({config.stats['errors']} injected errors)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
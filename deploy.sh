@@ -6,6 +6,17 @@
 echo "Building Tailwind CSS..."
 npx tailwindcss -i ./static/css/tailwind-input.css -o ./static/css/styles.css --minify
 
-# Step 2: Start the Gunicorn server
-echo "Starting Gunicorn server..."
-gunicorn --bind 0.0.0.0:5000 --reuse-port app:app
+# Step 2: Create or upgrade the database schema
+echo "Migrating database..."
+flask --app app:create_app migrate
+
+# Step 3: Start the Gunicorn server
+# --preload warms the app up once in the master; workers fork ready to serve
+# SERVER_MODE=async serves the chat endpoints from the ASGI app (requires the "asgi" extra)
+if [ "$SERVER_MODE" = "async" ]; then
+    echo "Starting Gunicorn server with async workers..."
+    gunicorn --preload --bind 0.0.0.0:5000 --reuse-port -k uvicorn.workers.UvicornWorker asgi:app
+else
+    echo "Starting Gunicorn server..."
+    gunicorn --preload --bind 0.0.0.0:5000 --reuse-port wsgi:app
+fi
@@ -0,0 +1,37 @@
+"""
+Gunicorn server hooks, loaded automatically from the working directory.
+
+Only hooks live here; bind address and worker settings stay on the command
+line (deploy.sh, .replit). With PROMETHEUS_MULTIPROC_DIR set, every worker
+writes its metrics to that directory and /metrics aggregates them; stale
+files from previous runs are removed on startup and a worker's live gauges
+are dropped when it exits.
+
+Worker boot times (fork to ready to accept requests) are logged, to compare
+``--preload``, where workers fork after the app is warm, with per-worker
+warm-up.
+"""
+import os
+import glob
+import time
+
+def on_starting(server):
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, "*.db")):
+            os.remove(path)
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        try:
+            from prometheus_client import multiprocess
+        except ImportError:
+            return
+        multiprocess.mark_process_dead(worker.pid)
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+def post_worker_init(worker):
+    worker.log.info(f"Worker {worker.pid} ready {(time.perf_counter() - worker.forked_at) * 1000:.0f}ms after fork")
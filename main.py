@@ -1,7 +1,12 @@
 import os
-from app import app  # noqa: F401
+from app import create_app, migrate_database, warm_up
+
+app = create_app()
 
 if __name__ == "__main__":
+    # Local runs create the schema themselves; deployments run `flask --app app:create_app migrate`
+    migrate_database(app)
+    warm_up(app)
     # Use environment variable for port if available, otherwise try port 8080
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=True)
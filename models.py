@@ -10,6 +10,11 @@ class User(UserMixin, db.Model):
     # ensure password hash field has length of at least 256
     password_hash = db.Column(db.String(256), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Messages with ids up to this one were cleared; reads skip them until the reaper deletes them
+    cleared_through_message_id = db.Column(db.Integer, nullable=True)
+    cleared_at = db.Column(db.DateTime, nullable=True)
+    # Cleared messages up to this id have been deleted (see utils.message_reaper)
+    purged_through_message_id = db.Column(db.Integer, nullable=True)
     messages = db.relationship('Message', backref='user', lazy='dynamic')
 
 class Message(db.Model):
@@ -19,14 +24,36 @@ class Message(db.Model):
     role = db.Column(db.String(20), nullable=False)  # 'user', 'assistant' or 'developer'
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    # Add image data field (storing as Base64 string)
+    # Legacy inline image data (Base64 string); new uploads use image_ref
     image_data = db.Column(db.Text, nullable=True)
+    # Content hash of the image in the blob store
+    image_ref = db.Column(db.String(64), nullable=True)
     # Is this message being streamed?
     is_streaming = db.Column(db.Boolean, default=False)
     # Reasoning effort level (low, medium, high)
     reasoning_effort = db.Column(db.String(10), nullable=True)
     # Reasoning summary for o3 and o4-mini models
     reasoning_summary = db.Column(db.Text, nullable=True)
+    # Client-generated id grouping the messages of one conversation
+    conversation_id = db.Column(db.String(64), nullable=True)
+    # Responses API response id, used to chain the next turn via previous_response_id
+    response_id = db.Column(db.String(100), nullable=True)
+    # Endpoint (see utils.endpoint_router) holding response_id; only it can continue the chain
+    response_endpoint = db.Column(db.String(64), nullable=True)
+    # Cached prompt token count (text plus image estimate), filled on write or first read
+    token_count = db.Column(db.Integer, nullable=True)
+    # Id of the SSE stream that produced this message, for resuming it (see utils.stream_buffer)
+    stream_id = db.Column(db.String(32), nullable=True, index=True)
+    # Generation job state: queued, running, done, failed or cancelled (see utils.generation)
+    status = db.Column(db.String(16), default='done')
+    # Set when generation was cancelled and the content is only the part produced before
+    is_truncated = db.Column(db.Boolean, default=False)
+    
+    __table_args__ = (
+        db.Index('ix_message_user_conversation', 'user_id', 'conversation_id', 'id'),
+        # Keyset pagination of a user's history
+        db.Index('ix_message_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
     
     def to_dict(self):
         """Convert message to dictionary format for API responses."""
@@ -37,15 +64,36 @@ class Message(db.Model):
             'timestamp': self.timestamp.isoformat(),
             'user_id': self.user_id,
             'is_streaming': self.is_streaming,
+            'status': self.status,
+            'is_truncated': bool(self.is_truncated),
             'reasoning_effort': self.reasoning_effort,
-            'reasoning_summary': self.reasoning_summary
+            'reasoning_summary': self.reasoning_summary,
+            'conversation_id': self.conversation_id
         }
         
         # Include image data if present
-        if self.image_data:
+        if self.image_ref:
+            message_dict['has_image'] = True
+            message_dict['image_url'] = f"/api/images/{self.image_ref}"
+        elif self.image_data:
             message_dict['has_image'] = True
             # Note: We don't include the actual image data in the dict to keep response size small
         else:
             message_dict['has_image'] = False
             
-        return message_dict
\ No newline at end of file
+        return message_dict
+
+class ConversationSummary(db.Model):
+    """Rolling summary of the older turns of a conversation that no longer fit the context budget."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    conversation_id = db.Column(db.String(64), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    # Id of the newest message folded into the summary
+    through_message_id = db.Column(db.Integer, nullable=False)
+    token_count = db.Column(db.Integer, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'conversation_id', name='uq_summary_user_conversation'),
+    )
@@ -112,9 +112,16 @@ document.addEventListener('DOMContentLoaded', function() {
     let username = localStorage.getItem('username');
     let conversation = JSON.parse(localStorage.getItem('conversation') || '[]');
     let isWaitingForResponse = false;
-    let imageData = null; // For storing base64 encoded image data
+    let imageId = null; // Blob store id of the uploaded image
+    let imageUrl = null; // URL serving the uploaded image
     let showAdvancedOptions = false; // Track if advanced options panel is visible
     let availableModels = []; // Store available model deployments
+    let oldestMessageId = null; // Id of the oldest message shown (pagination cursor)
+    let hasOlderMessages = false; // Whether older history exists on the server
+    let isLoadingOlderMessages = false;
+    const HISTORY_PAGE_SIZE = 50;
+    const MAX_STREAM_RESUMES = 5; // Reconnects to /api/chat/stream after a dropped stream
+    const STREAM_RESUME_DELAY_MS = 500;
     
     // Theme preference
     const prefersDarkMode = window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches;
@@ -143,6 +150,13 @@ document.addEventListener('DOMContentLoaded', function() {
     // Advanced options toggle
     toggleAdvancedOptionsBtn.addEventListener('click', toggleAdvancedOptions);
     
+    // Lazy-load older history when scrolled near the top
+    conversationContainer.addEventListener('scroll', function() {
+        if (conversationContainer.scrollTop < 200) {
+            loadOlderMessages();
+        }
+    });
+    
     /**
      * Fetch available models from the API
      */
@@ -276,7 +290,9 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         const message = messageInput.value.trim();
-        const hasImage = imageData ? true : false;
+        const hasImage = imageId ? true : false;
+        const messageImageId = imageId;
+        const messageImageUrl = imageUrl;
         
         // Get advanced options values
         const reasoningEffort = getSelectedReasoningEffort();
@@ -285,7 +301,7 @@ document.addEventListener('DOMContentLoaded', function() {
         
         if (message || hasImage) {
             // Add user message to UI (with image if present)
-            addMessageToUI('user', message, hasImage ? imageData : null);
+            addMessageToUI('user', message, hasImage ? messageImageUrl : null);
             
             // Clear input and image preview
             messageInput.value = '';
@@ -294,14 +310,14 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             
             // Add to conversation history
-            addToConversation('user', message, hasImage ? imageData : null);
+            addToConversation('user', message, hasImage ? messageImageUrl : null);
             
             // Show typing indicator
             showTypingIndicator();
             
             // Get AI response with streaming option
             const useStreaming = true; // Enable streaming for better UX
-            getAIResponse(message, imageData, useStreaming, reasoningEffort, developerMessage, selectedModel);
+            getAIResponse(message, messageImageId, useStreaming, reasoningEffort, developerMessage, selectedModel);
         }
     }
     
@@ -309,10 +325,36 @@ document.addEventListener('DOMContentLoaded', function() {
      * Add a message to the UI
      * @param {string} role - 'user' or 'assistant'
      * @param {string} content - Message text content
-     * @param {string|null} imageData - Base64 encoded image data (optional)
+     * @param {string|null} imageSrc - Image URL (optional)
      * @param {boolean} isStreaming - Whether this message is streaming (optional)
      */
-    function addMessageToUI(role, content, imageData = null, isStreaming = false) {
+    function addMessageToUI(role, content, imageSrc = null, isStreaming = false) {
+        const messageDiv = createMessageElement(role, content, imageSrc, isStreaming);
+        
+        // For streaming messages, replace existing streaming message if it exists
+        if (isStreaming) {
+            const existingStreamingMessage = document.getElementById('streaming-message');
+            if (existingStreamingMessage) {
+                conversationContainer.replaceChild(messageDiv, existingStreamingMessage);
+            } else {
+                conversationContainer.appendChild(messageDiv);
+            }
+        } else {
+            conversationContainer.appendChild(messageDiv);
+        }
+        
+        scrollToBottom();
+        return messageDiv;
+    }
+    
+    /**
+     * Build the DOM element for a message
+     * @param {string} role - 'user' or 'assistant'
+     * @param {string} content - Message text content
+     * @param {string|null} imageSrc - Image URL (optional)
+     * @param {boolean} isStreaming - Whether this message is streaming (optional)
+     */
+    function createMessageElement(role, content, imageSrc = null, isStreaming = false) {
         const messageDiv = document.createElement('div');
         const timestamp = new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
         
@@ -325,10 +367,10 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Prepare image HTML if image is present
         let imageHtml = '';
-        if (imageData) {
+        if (imageSrc) {
             imageHtml = `
                 <div class="message-image mb-2">
-                    <img src="data:image/jpeg;base64,${imageData}" alt="User uploaded image" 
+                    <img src="${imageSrc}" alt="User uploaded image" 
                          class="rounded-md max-w-full max-h-60 object-cover">
                 </div>
             `;
@@ -353,19 +395,22 @@ document.addEventListener('DOMContentLoaded', function() {
             </div>
         `;
         
-        // For streaming messages, replace existing streaming message if it exists
-        if (isStreaming) {
-            const existingStreamingMessage = document.getElementById('streaming-message');
-            if (existingStreamingMessage) {
-                conversationContainer.replaceChild(messageDiv, existingStreamingMessage);
-            } else {
-                conversationContainer.appendChild(messageDiv);
-            }
-        } else {
-            conversationContainer.appendChild(messageDiv);
-        }
-        
-        scrollToBottom();
+        return messageDiv;
+    }
+    
+    /**
+     * Set the image of a rendered message
+     * @param {HTMLElement} messageDiv - Element returned by createMessageElement
+     * @param {string} imageSrc - Image URL (or thumbnail data URI)
+     * @param {string|null} fullImageUrl - Full-size image opened on click (optional)
+     */
+    function setMessageImage(messageDiv, imageSrc, fullImageUrl = null) {
+        const bubble = messageDiv.querySelector('.message');
+        const imageDiv = document.createElement('div');
+        imageDiv.className = 'message-image mb-2';
+        const img = `<img src="${imageSrc}" alt="User uploaded image" class="rounded-md max-w-full max-h-60 object-cover">`;
+        imageDiv.innerHTML = fullImageUrl ? `<a href="${fullImageUrl}" target="_blank" rel="noopener">${img}</a>` : img;
+        bubble.insertBefore(imageDiv, bubble.firstChild);
     }
     
     /**
@@ -527,24 +572,39 @@ document.addEventListener('DOMContentLoaded', function() {
      * Add a message to the conversation history
      * @param {string} role - 'user' or 'assistant'
      * @param {string} content - Message text content
-     * @param {string|null} imageData - Base64 encoded image data (optional)
+     * @param {string|null} imageSrc - Image URL (optional)
      */
-    function addToConversation(role, content, imageData = null) {
+    function addToConversation(role, content, imageSrc = null) {
         const messageObj = { 
             role, 
             content, 
             timestamp: new Date().toISOString() 
         };
         
-        // Only add image data if it exists (to save space in localStorage)
-        if (imageData) {
-            messageObj.image_data = imageData;
+        // Only add the image URL if it exists
+        if (imageSrc) {
+            messageObj.image_url = imageSrc;
         }
         
         conversation.push(messageObj);
         saveConversation();
     }
     
+    /**
+     * Get the id of the current server-side conversation, creating one if needed.
+     * The server assembles history from this id, so only the new turn is sent.
+     */
+    function getConversationId() {
+        let conversationId = localStorage.getItem('conversation_id');
+        if (!conversationId) {
+            conversationId = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : Date.now().toString(36) + Math.random().toString(36).slice(2);
+            localStorage.setItem('conversation_id', conversationId);
+        }
+        return conversationId;
+    }
+    
     /**
      * Save conversation to localStorage
      */
@@ -553,21 +613,22 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     /**
-     * Load messages from the database for the current user
+     * Load the newest page of messages from the database for the current user
      */
     function loadMessagesFromDatabase() {
         const userId = localStorage.getItem('user_id');
-        
         if (!userId) {
             return; // No user ID, can't load messages
         }
         
-        fetch(`/api/messages?user_id=${userId}`)
+        fetch(`/api/messages?user_id=${userId}&limit=${HISTORY_PAGE_SIZE}`)
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
                     // Clear container
                     conversationContainer.innerHTML = ''; 
+                    oldestMessageId = null;
+                    hasOlderMessages = data.has_more;
                     
                     // Process messages
                     if (data.messages && data.messages.length > 0) {
@@ -580,61 +641,14 @@ document.addEventListener('DOMContentLoaded', function() {
                         // Clear local conversation and rebuild from database
                         conversation = [];
                         
-                        // Add messages to UI and update local conversation
-                        data.messages.forEach(msg => {
-                            // Check if message has image data from the database
-                            const hasImage = msg.has_image || false;
-                            
-                            // If message has image, we need to fetch it separately
-                            if (hasImage) {
-                                // We'll fetch the image data and then display the message
-                                fetch(`/api/messages/${msg.id}/image?user_id=${userId}`)
-                                    .then(response => response.json())
-                                    .then(imageData => {
-                                        if (imageData.status === 'success') {
-                                            // Add message with image to UI
-                                            addMessageToUI(msg.role, msg.content, imageData.image_data);
-                                            
-                                            // Add to conversation history with image
-                                            conversation.push({
-                                                role: msg.role,
-                                                content: msg.content,
-                                                image_data: imageData.image_data,
-                                                timestamp: msg.timestamp
-                                            });
-                                            
-                                            // Save updated conversation
-                                            saveConversation();
-                                        } else {
-                                            // If image fetch fails, just show the message without image
-                                            addMessageToUI(msg.role, msg.content);
-                                            conversation.push({
-                                                role: msg.role,
-                                                content: msg.content,
-                                                timestamp: msg.timestamp
-                                            });
-                                        }
-                                    })
-                                    .catch(error => {
-                                        console.error('Error fetching image data:', error);
-                                        // Still show message without image
-                                        addMessageToUI(msg.role, msg.content);
-                                        conversation.push({
-                                            role: msg.role,
-                                            content: msg.content,
-                                            timestamp: msg.timestamp
-                                        });
-                                    });
-                            } else {
-                                // Regular message without image
-                                addMessageToUI(msg.role, msg.content);
-                                conversation.push({
-                                    role: msg.role,
-                                    content: msg.content,
-                                    timestamp: msg.timestamp
-                                });
-                            }
-                        });
+                        // Continue the most recent server-side conversation
+                        const lastMessage = data.messages[data.messages.length - 1];
+                        if (lastMessage.conversation_id) {
+                            localStorage.setItem('conversation_id', lastMessage.conversation_id);
+                        }
+                        
+                        renderHistoryMessages(data.messages, false);
+                        scrollToBottom();
                         
                         // Save to localStorage as backup
                         saveConversation();
@@ -651,6 +665,124 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
     
+    /**
+     * Load the page of messages before the oldest one shown, keeping the scroll position
+     */
+    function loadOlderMessages() {
+        const userId = localStorage.getItem('user_id');
+        if (!userId || !hasOlderMessages || isLoadingOlderMessages || oldestMessageId === null) {
+            return;
+        }
+        
+        isLoadingOlderMessages = true;
+        fetch(`/api/messages?user_id=${userId}&before=${oldestMessageId}&limit=${HISTORY_PAGE_SIZE}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status === 'success') {
+                    hasOlderMessages = data.has_more;
+                    
+                    // Keep the currently visible messages in place while prepending
+                    const previousHeight = conversationContainer.scrollHeight;
+                    renderHistoryMessages(data.messages, true);
+                    conversationContainer.scrollTop += conversationContainer.scrollHeight - previousHeight;
+                } else {
+                    console.error('Error loading older messages:', data.message);
+                }
+            })
+            .catch(error => {
+                console.error('Error fetching older messages:', error);
+            })
+            .finally(() => {
+                isLoadingOlderMessages = false;
+            });
+    }
+    
+    /**
+     * Render a page of history messages and add them to the local conversation
+     * @param {Array} messages - Messages in chronological order
+     * @param {boolean} prepend - Insert before the messages already shown
+     */
+    function renderHistoryMessages(messages, prepend) {
+        const fragment = document.createDocumentFragment();
+        const entries = [];
+        const imageMessages = {};
+        
+        messages.forEach(msg => {
+            // Images are filled in from one batch thumbnail request below
+            const messageDiv = createMessageElement(msg.role, msg.content);
+            fragment.appendChild(messageDiv);
+            
+            const entry = {
+                role: msg.role,
+                content: msg.content,
+                timestamp: msg.timestamp
+            };
+            if (msg.image_url) {
+                entry.image_url = msg.image_url;
+            }
+            if (msg.has_image) {
+                imageMessages[msg.id] = { element: messageDiv, entry: entry };
+            }
+            entries.push(entry);
+        });
+        
+        if (messages.length > 0) {
+            oldestMessageId = oldestMessageId === null || prepend ? messages[0].id : oldestMessageId;
+        }
+        
+        if (prepend) {
+            conversationContainer.insertBefore(fragment, conversationContainer.firstChild);
+            conversation = entries.concat(conversation);
+        } else {
+            conversationContainer.appendChild(fragment);
+            conversation = conversation.concat(entries);
+        }
+        
+        loadHistoryImages(imageMessages);
+    }
+    
+    /**
+     * Fetch thumbnails for a page of history messages in one request
+     * @param {Object} imageMessages - Map of message id to {element, entry}
+     */
+    function loadHistoryImages(imageMessages) {
+        const userId = localStorage.getItem('user_id');
+        const messageIds = Object.keys(imageMessages);
+        if (!userId || messageIds.length === 0) {
+            return;
+        }
+        
+        fetch('/api/messages/images', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                user_id: userId,
+                message_ids: messageIds.map(Number)
+            })
+        })
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'success') {
+                    console.error('Error loading images:', data.message);
+                    return;
+                }
+                Object.entries(data.images).forEach(([messageId, image]) => {
+                    const target = imageMessages[messageId];
+                    if (!target) {
+                        return;
+                    }
+                    setMessageImage(target.element, image.thumbnail || image.image_url, image.image_url);
+                    target.entry.image_url = image.image_url;
+                });
+                saveConversation();
+            })
+            .catch(error => {
+                console.error('Error fetching images:', error);
+            });
+    }
+    
     /**
      * Load conversation history from localStorage (fallback)
      */
@@ -670,20 +802,20 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Add messages to UI
         conversation.forEach(msg => {
-            addMessageToUI(msg.role, msg.content);
+            addMessageToUI(msg.role, msg.content, msg.image_url || null);
         });
     }
     
     /**
      * Get AI response from the backend
      * @param {string} message - The user's message text
-     * @param {string|null} imageData - Optional base64 encoded image data
+     * @param {string|null} imageId - Optional blob store id of an uploaded image
      * @param {boolean} useStreaming - Whether to use streaming for the response
      * @param {string|null} reasoningEffort - Optional reasoning effort level (low, medium, high)
      * @param {string|null} developerMessage - Optional developer message (like system message)
      * @param {string|null} model - Optional model deployment ID to use
      */
-    function getAIResponse(message, imageData = null, useStreaming = false, reasoningEffort = null, developerMessage = null, model = null) {
+    function getAIResponse(message, imageId = null, useStreaming = false, reasoningEffort = null, developerMessage = null, model = null) {
         const userId = localStorage.getItem('user_id');
         
         // Hide any existing typing indicators
@@ -696,50 +828,54 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         if (useStreaming) {
-            // For streaming, we use server-sent events
+            // The POST response body is a server-sent event stream
             // Add an empty assistant message with streaming indicator
             addMessageToUI('assistant', '', null, true);
             
-            // Instead of passing everything in the URL, let's create a dedicated streaming endpoint
-            const eventSource = new EventSource(`/api/chat/stream?user_id=${userId || ''}`);
-            
-            // For streaming, we still need to post the message data to the server
-            // Let's keep the original approach for actually sending the message
-            fetch('/api/chat', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    message: message,
-                    username: username || '',
-                    user_id: userId || '',
-                    image_data: imageData,
-                    conversation_history: conversation,
-                    streaming: true,
-                    reasoning_effort: reasoningEffort,
-                    developer_message: developerMessage,
-                    model: model
-                }),
-            }).catch(error => {
-                console.error('Error sending streaming message:', error);
-                eventSource.close();
-                hideTypingIndicator();
-                showError('Error starting streaming response: ' + error.message);
-                isWaitingForResponse = false;
-            });
-            
-            // Handle connection open
-            eventSource.onopen = function() {
-                console.log('EventSource connection established');
-            };
-            
+            const streamingMessageElement = document.getElementById('streaming-message');
             let fullResponse = '';
-            let streamingMessageElement = document.getElementById('streaming-message');
+            let reasoningSummary = '';
+            let summaryElement = null;
+            let receivedFinal = false;
+            // Set by the first event; used to resume the stream if the connection drops
+            let streamId = null;
+            let lastEventId = null;
+            let resumeAttempts = 0;
+            // Set when the server ends the stream with an error, e.g. when the model is busy
+            let streamError = null;
             
-            // Handle incoming message chunks
-            eventSource.onmessage = function(event) {
-                const data = JSON.parse(event.data);
+            function handleEvent(eventType, data, eventId) {
+                if (eventId) {
+                    lastEventId = eventId;
+                }
+                if (eventType === 'stream') {
+                    streamId = data.stream_id;
+                    window.addEventListener('pagehide', cancelStream);
+                    return;
+                }
+                
+                // Reasoning summary deltas arrive as their own event type, before the answer
+                if (eventType === 'reasoning_summary') {
+                    reasoningSummary += data.delta;
+                    if (!summaryElement) {
+                        summaryElement = addReasoningSummary('', streamingMessageElement);
+                    }
+                    summaryElement.querySelector('.reasoning-summary-content').textContent = reasoningSummary;
+                    return;
+                }
+                
+                // A resumed stream that can't be completed
+                if (data.status === 'interrupted' || data.status === 'timeout') {
+                    streamId = null;
+                    return;
+                }
+                
+                // The generation failed; resuming would only replay the failure
+                if (data.status === 'error') {
+                    streamId = null;
+                    streamError = data.message;
+                    return;
+                }
                 
                 if (data.chunk) {
                     fullResponse += data.chunk;
@@ -756,8 +892,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 
                 // Check if this is the final message
                 if (data.is_final) {
-                    eventSource.close();
+                    receivedFinal = true;
                     isWaitingForResponse = false;
+                    window.removeEventListener('pagehide', cancelStream);
                     
                     // Replace the streaming message with a final one
                     if (streamingMessageElement) {
@@ -766,43 +903,83 @@ document.addEventListener('DOMContentLoaded', function() {
                         if (typingIndicator) {
                             typingIndicator.remove();
                         }
+                        // The generation was cancelled part way through
+                        if (data.is_truncated) {
+                            const note = document.createElement('div');
+                            note.className = 'text-xs text-gray-500 mt-1';
+                            note.textContent = 'Response stopped before it was finished.';
+                            streamingMessageElement.querySelector('.message-content').appendChild(note);
+                        }
                     }
                     
                     // Add to conversation history
                     addToConversation('assistant', fullResponse);
                     
-                    // Handle reasoning summary if available
-                    if (data.reasoning_summary) {
-                        // Display reasoning summary in a special format
+                    // Show the reasoning summary if it was not streamed
+                    if (data.reasoning_summary && !summaryElement) {
                         addReasoningSummary(data.reasoning_summary);
                     }
                 }
-            };
+            }
             
-            // Handle errors with more detailed messaging and retry logic
-            eventSource.onerror = function(error) {
-                console.error('EventSource error:', error);
-                
-                // Always close the connection on error
-                eventSource.close();
-                hideTypingIndicator();
-                
-                // Check if Azure OpenAI credentials are missing
-                if (error && error.target && error.target.readyState === EventSource.CLOSED) {
-                    showError('Connection closed: The server could not process your request. This may be due to missing or invalid API credentials.');
-                } else {
-                    showError('Connection error: Unable to stream the response. Switching to non-streaming mode...');
-                    
-                    // Fall back to non-streaming mode after a short delay
-                    setTimeout(() => {
-                        if (isWaitingForResponse) {
-                            getAIResponse(message, imageData, false, reasoningEffort, developerMessage, model);
-                        }
-                    }, 1000);
+            // Stop the generation when the page goes away mid-answer rather than
+            // leaving the server to notice the closed connection
+            function cancelStream() {
+                if (streamId && !receivedFinal) {
+                    const body = new Blob([JSON.stringify({ stream_id: streamId })], { type: 'application/json' });
+                    navigator.sendBeacon('/api/chat/cancel', body);
                 }
-                
+            }
+            
+            function readResponse(response) {
+                if (!response.ok || !response.body) {
+                    throw new Error(`Server returned ${response.status}`);
+                }
+                return readEventStream(response.body, handleEvent);
+            }
+            
+            // Pick the stream up after the last event received, without asking the model again
+            function resumeOrFail(error) {
+                if (receivedFinal) {
+                    return;
+                }
+                if (!streamId || resumeAttempts >= MAX_STREAM_RESUMES) {
+                    throw error || new Error(streamError || 'The response stream ended unexpectedly');
+                }
+                resumeAttempts++;
+                const headers = lastEventId ? { 'Last-Event-ID': lastEventId } : {};
+                return new Promise(resolve => setTimeout(resolve, STREAM_RESUME_DELAY_MS * resumeAttempts))
+                    .then(() => fetch(`/api/chat/stream?stream_id=${encodeURIComponent(streamId)}`, { headers: headers }))
+                    .then(readResponse)
+                    .then(() => resumeOrFail(), resumeOrFail);
+            }
+            
+            fetch('/api/chat', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({
+                    message: message,
+                    username: username || '',
+                    user_id: userId || '',
+                    image_id: imageId,
+                    conversation_id: getConversationId(),
+                    streaming: true,
+                    reasoning_effort: reasoningEffort,
+                    developer_message: developerMessage,
+                    model: model
+                }),
+            })
+            .then(readResponse)
+            .then(() => resumeOrFail(), resumeOrFail)
+            .catch(error => {
+                window.removeEventListener('pagehide', cancelStream);
+                console.error('Error streaming response:', error);
+                hideTypingIndicator();
+                showError('Error streaming the response: ' + error.message);
                 isWaitingForResponse = false;
-            };
+            });
         } else {
             // For non-streaming responses, use regular fetch
             fetch('/api/chat', {
@@ -814,8 +991,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     message: message,
                     username: username,
                     user_id: userId,
-                    image_data: imageData,
-                    conversation_history: conversation,
+                    image_id: imageId,
+                    conversation_id: getConversationId(),
                     streaming: false,
                     reasoning_effort: reasoningEffort,
                     developer_message: developerMessage,
@@ -856,8 +1033,11 @@ document.addEventListener('DOMContentLoaded', function() {
     
     /**
      * Display a reasoning summary in the conversation
+     * @param {string} summary - The summary text
+     * @param {HTMLElement|null} beforeElement - Insert the summary before this element (optional)
+     * @returns {HTMLElement} The summary element
      */
-    function addReasoningSummary(summary) {
+    function addReasoningSummary(summary, beforeElement = null) {
         const summaryDiv = document.createElement('div');
         summaryDiv.className = 'bg-primary-900/30 text-primary-100 border border-primary-700 rounded-md p-3 my-2 mx-4';
         
@@ -868,7 +1048,7 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Create content
         const content = document.createElement('div');
-        content.className = 'text-sm opacity-90';
+        content.className = 'reasoning-summary-content text-sm opacity-90';
         content.textContent = summary;
         
         // Add elements to the summary div
@@ -876,8 +1056,63 @@ document.addEventListener('DOMContentLoaded', function() {
         summaryDiv.appendChild(content);
         
         // Add to conversation container
-        conversationContainer.appendChild(summaryDiv);
+        if (beforeElement) {
+            conversationContainer.insertBefore(summaryDiv, beforeElement);
+        } else {
+            conversationContainer.appendChild(summaryDiv);
+        }
         scrollToBottom();
+        return summaryDiv;
+    }
+    
+    /**
+     * Read a server-sent event stream from a fetch response body
+     * @param {ReadableStream} body - The response body
+     * @param {Function} onEvent - Called with (eventType, data, eventId) for each event
+     * @returns {Promise} Resolves when the stream ends
+     */
+    function readEventStream(body, onEvent) {
+        const reader = body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        function dispatch(frame) {
+            let eventType = 'message';
+            let eventId = null;
+            const dataLines = [];
+            frame.split('\n').forEach(line => {
+                if (line.startsWith('id:')) {
+                    eventId = line.slice(3).trim();
+                } else if (line.startsWith('event:')) {
+                    eventType = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trimStart());
+                }
+            });
+            if (dataLines.length > 0) {
+                onEvent(eventType, JSON.parse(dataLines.join('\n')), eventId);
+            }
+        }
+        
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    dispatch(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                }
+                if (done) {
+                    if (buffer.trim()) {
+                        dispatch(buffer);
+                    }
+                    return;
+                }
+                return pump();
+            });
+        }
+        
+        return pump();
     }
     
     /**
@@ -1005,8 +1240,9 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(data => {
             if (data.status === 'success') {
                 // Store image data and show preview
-                imageData = data.image_data;
-                imagePreview.src = `data:image/jpeg;base64,${imageData}`;
+                imageId = data.image_id;
+                imageUrl = data.image_url;
+                imagePreview.src = imageUrl;
                 imagePreview.alt = 'Image Preview';
                 imagePreviewContainer.style.display = 'flex';
             } else {
@@ -1026,7 +1262,8 @@ document.addEventListener('DOMContentLoaded', function() {
      * Clear image upload and preview
      */
     function clearImageUpload() {
-        imageData = null;
+        imageId = null;
+        imageUrl = null;
         imageUploadInput.value = '';
         imagePreviewContainer.style.display = 'none';
         imagePreview.src = '#';
@@ -1068,9 +1305,10 @@ document.addEventListener('DOMContentLoaded', function() {
         .then(response => response.json())
         .then(data => {
             if (data.status === 'success') {
-                // Clear local conversation
+                // Clear local conversation and start a new server-side one
                 conversation = [];
                 localStorage.removeItem('conversation');
+                localStorage.removeItem('conversation_id');
                 
                 // Clear UI
                 conversationContainer.innerHTML = '';
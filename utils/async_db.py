@@ -0,0 +1,54 @@
+"""
+Async database access for the ASGI serving mode.
+
+Reuses the models defined in ``models.py`` (they are plain SQLAlchemy
+declarative classes underneath Flask-SQLAlchemy) with an ``AsyncEngine``
+built from the same ``DATABASE_URL``.
+"""
+import os
+import logging
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+_engine = None
+_session_factory = None
+
+def to_async_url(database_url):
+    """Map a sync database URL onto the matching async driver."""
+    if database_url.startswith("postgres://"):
+        database_url = database_url.replace("postgres://", "postgresql://", 1)
+    if database_url.startswith("postgresql://"):
+        return database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if database_url.startswith("sqlite://"):
+        return database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return database_url
+
+def get_session_factory():
+    """Return the process-wide async session factory, creating it on first use."""
+    global _engine, _session_factory
+    if _session_factory is None:
+        database_url = os.environ.get("DATABASE_URL")
+        if not database_url:
+            raise RuntimeError("DATABASE_URL is not set")
+
+        async_url = to_async_url(database_url)
+        engine_options = {"pool_recycle": 300, "pool_pre_ping": True}
+        if async_url.startswith("postgresql+asyncpg"):
+            engine_options["connect_args"] = {
+                "timeout": 10,
+                "server_settings": {"application_name": "ai-chat-app"}
+            }
+
+        _engine = create_async_engine(async_url, **engine_options)
+        # Keep attributes loaded after commit; lazy refreshes are not possible in async code
+        _session_factory = async_sessionmaker(_engine, expire_on_commit=False)
+        logging.info(f"Created async database engine ({_engine.dialect.name})")
+    return _session_factory
+
+async def dispose():
+    """Close the async engine's connection pool."""
+    global _engine, _session_factory
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = None
+    _session_factory = None
@@ -0,0 +1,136 @@
+"""
+Content-addressed binary storage for uploaded images.
+
+Blobs are stored once per unique content under their SHA-256 digest, so
+identical uploads are deduplicated and a blob id never changes meaning.
+Messages keep only the blob id; the bytes are served directly by the
+``/api/images/<id>`` endpoint and loaded on demand when an image has to be
+sent to the model.
+
+The local filesystem backend lays files out as ``<root>/ab/cd/<digest>``
+with a small JSON sidecar holding the content type; derived variants such
+as thumbnails sit next to the original as ``<digest>.<variant>``. The root
+directory is set with BLOB_STORE_DIR (default ``data/blobs`` next to the
+app).
+"""
+import os
+import re
+import json
+import base64
+import hashlib
+import logging
+import tempfile
+
+DEFAULT_BLOB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "blobs")
+
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Leading bytes of the image formats we accept
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+def sniff_image_type(data):
+    """Return the MIME type of image bytes, or None if the format is not supported."""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+class LocalBlobStore:
+    """Filesystem-backed content-addressed blob store."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, blob_id):
+        if not BLOB_ID_PATTERN.match(blob_id or ""):
+            raise ValueError("Invalid blob id")
+        return os.path.join(self.root, blob_id[:2], blob_id[2:4], blob_id)
+
+    def _write_atomic(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def put(self, data, content_type):
+        """Store bytes and return their blob id; identical content is stored once.
+
+        Args:
+            data (bytes): The blob contents
+            content_type (str): MIME type served with the blob
+
+        Returns:
+            str: The SHA-256 hex digest identifying the blob
+        """
+        blob_id = hashlib.sha256(data).hexdigest()
+        path = self._path(blob_id)
+        if os.path.exists(path):
+            logging.debug(f"Blob {blob_id} already stored; skipping write")
+            return blob_id
+
+        # Metadata first, so a readable blob always has its content type
+        metadata = json.dumps({"content_type": content_type, "size": len(data)}).encode("utf-8")
+        self._write_atomic(path + ".json", metadata)
+        self._write_atomic(path, data)
+        logging.info(f"Stored blob {blob_id} ({len(data)} bytes, {content_type})")
+        return blob_id
+
+    def exists(self, blob_id):
+        try:
+            return os.path.exists(self._path(blob_id))
+        except ValueError:
+            return False
+
+    def path(self, blob_id):
+        """Return the filesystem path of a blob (for streaming responses)."""
+        return self._path(blob_id)
+
+    def metadata(self, blob_id):
+        """Return the blob's metadata dict ('content_type', 'size')."""
+        with open(self._path(blob_id) + ".json", "rb") as metadata_file:
+            return json.loads(metadata_file.read())
+
+    def read(self, blob_id):
+        """Return the blob's bytes."""
+        with open(self._path(blob_id), "rb") as blob_file:
+            return blob_file.read()
+
+    def read_base64(self, blob_id):
+        """Return the blob's contents base64-encoded, as the OpenAI API expects for inline images."""
+        return base64.b64encode(self.read(blob_id)).decode("utf-8")
+
+    def read_variant(self, blob_id, variant):
+        """Return the bytes of a derived variant of a blob (e.g. a thumbnail), or None if not generated yet."""
+        try:
+            with open(f"{self._path(blob_id)}.{variant}", "rb") as variant_file:
+                return variant_file.read()
+        except FileNotFoundError:
+            return None
+
+    def put_variant(self, blob_id, variant, data):
+        """Store a derived variant of a blob next to the original."""
+        self._write_atomic(f"{self._path(blob_id)}.{variant}", data)
+
+_store = None
+
+def get_blob_store():
+    """Return the process-wide blob store."""
+    global _store
+    if _store is None:
+        _store = LocalBlobStore(os.environ.get("BLOB_STORE_DIR", DEFAULT_BLOB_DIR))
+    return _store
@@ -0,0 +1,161 @@
+"""
+Process-wide registry of pooled Azure OpenAI clients.
+
+Building an ``AzureOpenAI`` client creates a fresh httpx connection pool, so
+constructing one per request means every chat turn pays a new TCP + TLS
+handshake to the endpoint. This registry hands out one shared client per
+(endpoint, API version, credential) for the lifetime of a worker process.
+
+Connection pool behaviour is configured through environment variables:
+
+    AZURE_OPENAI_MAX_CONNECTIONS     Maximum open connections per client (default 100)
+    AZURE_OPENAI_MAX_KEEPALIVE       Maximum idle keep-alive connections (default 20)
+    AZURE_OPENAI_KEEPALIVE_EXPIRY    Seconds an idle connection is kept open (default 30)
+    AZURE_OPENAI_HTTP2               Enable HTTP/2 when the ``h2`` package is installed (default off)
+    AZURE_OPENAI_TIMEOUT             Request timeout in seconds (default 600)
+
+Clients don't retry on their own; throttled and failed calls are retried
+by the per-deployment scheduler (see utils.scheduler).
+
+The registry is fork-safe: clients created before a fork (for example in a
+gunicorn master with ``--preload``) are never shared with the children.
+The openai SDK and httpx are imported on first use, or by load_sdk() during
+warm-up, since importing them takes a good part of a second.
+"""
+import os
+import logging
+import hashlib
+import threading
+import importlib.util
+
+MAX_CONNECTIONS = int(os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("AZURE_OPENAI_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.environ.get("AZURE_OPENAI_HTTP2", "").lower() in ("1", "true", "yes")
+REQUEST_TIMEOUT = float(os.environ.get("AZURE_OPENAI_TIMEOUT", "600"))
+
+_clients = {}
+_lock = threading.Lock()
+_owner_pid = os.getpid()
+
+def _http2_available():
+    """Return True if HTTP/2 was requested and the h2 package is installed."""
+    if not HTTP2_ENABLED:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logging.warning("AZURE_OPENAI_HTTP2 is set but the 'h2' package is not installed - using HTTP/1.1")
+        return False
+    return True
+
+def load_sdk():
+    """Import the openai SDK and httpx ahead of the first call (e.g. before workers fork)."""
+    import httpx  # noqa: F401
+    import openai  # noqa: F401
+
+def _credential_fingerprint(api_key):
+    """Hash the credential so raw keys never end up in registry keys or logs."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+def _build_http_client(async_client=False):
+    """Create an httpx client with the configured pool limits."""
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY
+    )
+    client_class = httpx.AsyncClient if async_client else httpx.Client
+    return client_class(
+        limits=limits,
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0),
+        http2=_http2_available()
+    )
+
+def _reset_after_fork():
+    """Drop clients inherited from the parent process.
+
+    The inherited sockets belong to the parent, so we only forget the
+    references here; closing them would tear down the parent's connections.
+    """
+    global _clients, _lock, _owner_pid
+    _clients = {}
+    _lock = threading.Lock()
+    _owner_pid = os.getpid()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _get_or_create(endpoint, api_version, api_key, async_client):
+    # Guard against platforms without register_at_fork
+    if os.getpid() != _owner_pid:
+        _reset_after_fork()
+
+    key = (endpoint, api_version, _credential_fingerprint(api_key), async_client)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import AzureOpenAI, AsyncAzureOpenAI
+
+            client_class = AsyncAzureOpenAI if async_client else AzureOpenAI
+            client = client_class(
+                api_key=api_key,
+                api_version=api_version,
+                azure_endpoint=endpoint,
+                http_client=_build_http_client(async_client),
+                # Retries are left to utils.scheduler, which backs off per deployment
+                max_retries=0
+            )
+            _clients[key] = client
+            kind = "async " if async_client else ""
+            logging.info(f"Created pooled {kind}Azure OpenAI client for {endpoint} (API version {api_version})")
+    return client
+
+def get_client(endpoint, api_version, api_key):
+    """Return the shared Azure OpenAI client for an endpoint/version/credential.
+
+    Args:
+        endpoint (str): Azure OpenAI endpoint URL
+        api_version (str): API version to use
+        api_key (str): API key for the endpoint
+
+    Returns:
+        AzureOpenAI: A client backed by a pooled, keep-alive HTTP connection pool
+    """
+    return _get_or_create(endpoint, api_version, api_key, False)
+
+def get_async_client(endpoint, api_version, api_key):
+    """Return the shared AsyncAzureOpenAI client for an endpoint/version/credential.
+
+    Async clients are bound to the event loop of the worker that first uses
+    them; each ASGI worker process runs a single loop, so one client per
+    process is safe.
+    """
+    return _get_or_create(endpoint, api_version, api_key, True)
+
+def close_all():
+    """Close every pooled synchronous client owned by this process."""
+    with _lock:
+        for key, client in list(_clients.items()):
+            if key[3]:
+                continue
+            try:
+                client.close()
+            except Exception as e:
+                logging.warning(f"Error closing Azure OpenAI client: {str(e)}")
+            del _clients[key]
+
+async def aclose_all():
+    """Close every pooled async client owned by this process."""
+    for key, client in list(_clients.items()):
+        if not key[3]:
+            continue
+        try:
+            await client.close()
+        except Exception as e:
+            logging.warning(f"Error closing async Azure OpenAI client: {str(e)}")
+        _clients.pop(key, None)
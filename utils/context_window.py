@@ -0,0 +1,292 @@
+"""
+Token-budgeted context window management.
+
+Fits conversation history into the per-model ``context_budget`` from the
+model catalog before it is sent upstream:
+
+- token counts are computed once per message and cached (on the
+  ``Message`` row for server-side history, in-process otherwise)
+- developer messages are pinned; identical repeats are collapsed
+- the oldest turns are dropped first
+- optionally (CONTEXT_SUMMARIZE=true) dropped turns are rolled into a
+  stored ``ConversationSummary`` that is sent in their place. The summary
+  is written by a background thread, so the turn that drops the messages
+  doesn't wait for a model call; it is sent from the next turn on.
+
+Every request reports how many history tokens it saved; running totals
+are available from ``get_stats()`` (on /api/cache/stats) and as the
+``context_budget_requests_total`` and ``context_tokens_saved_total``
+metrics.
+"""
+import os
+import logging
+import functools
+import threading
+
+from utils import metrics
+
+# Rough prompt cost of one image at default detail
+IMAGE_TOKEN_ESTIMATE = 765
+# Per-message framing tokens (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Optional global cap applied on top of the per-model budgets
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "0")) or None
+SUMMARIZE_ENABLED = os.environ.get("CONTEXT_SUMMARIZE", "").lower() in ("1", "true", "yes")
+SUMMARY_MODEL = os.environ.get("CONTEXT_SUMMARY_MODEL")
+# Refresh the stored summary once this many unsummarized messages have been dropped
+SUMMARY_MIN_NEW_MESSAGES = int(os.environ.get("CONTEXT_SUMMARY_MIN_MESSAGES", "6"))
+SUMMARY_MAX_INPUT_CHARS = 48000
+
+_encoding = None
+_stats = {'requests': 0, 'trimmed_requests': 0, 'tokens_saved': 0, 'summaries': 0, 'summary_errors': 0}
+_stats_lock = threading.Lock()
+# (user_id, conversation_id) of summaries being written
+_summarizing = set()
+
+def _get_encoding():
+    """Return a tiktoken encoding, or False if tiktoken is unavailable."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            logging.info(f"tiktoken unavailable ({str(e)}); estimating token counts from text length")
+            _encoding = False
+    return _encoding
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text):
+    """Count the tokens in a piece of text."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    # About four characters per token for English text
+    return len(text) // 4 + 1
+
+def count_message_tokens(content, image=None):
+    """Count the prompt tokens of one message, including an attached image."""
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_tokens(content or "")
+    if image:
+        tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def _entry_tokens(entry):
+    """Token count of a history entry, cached on the entry."""
+    if entry.get('tokens') is None:
+        entry['tokens'] = count_message_tokens(entry.get('content'), entry.get('image') or entry.get('image_ref'))
+    return entry['tokens']
+
+def _summary_entry(summary):
+    return {
+        'role': 'developer',
+        'content': f"Summary of the earlier conversation:\n{summary}"
+    }
+
+def fit_history(history, budget, reserved_tokens=0, summary=None):
+    """Select the newest history that fits in a token budget.
+
+    Args:
+        history (list): History entries, oldest first
+        budget (int): Total prompt token budget
+        reserved_tokens (int): Tokens already committed to the new turn
+        summary (str, optional): Summary of earlier turns to send in front of the history
+
+    Returns:
+        tuple: (kept, dropped) lists of history entries, oldest first
+    """
+    # Pin developer messages, keeping only the latest copy of repeated ones
+    latest_developer = {}
+    for index, entry in enumerate(history):
+        if entry['role'] == 'developer':
+            latest_developer[entry['content']] = index
+    pinned = set(latest_developer.values())
+
+    remaining = budget - reserved_tokens - sum(_entry_tokens(history[i]) for i in pinned)
+    if summary:
+        remaining -= count_message_tokens(_summary_entry(summary)['content'])
+
+    # Walk back from the newest turn until the budget runs out
+    kept_indexes = set()
+    for index in range(len(history) - 1, -1, -1):
+        entry = history[index]
+        if entry['role'] == 'developer':
+            continue
+        tokens = _entry_tokens(entry)
+        if tokens > remaining:
+            break
+        kept_indexes.add(index)
+        remaining -= tokens
+
+    # Don't open the window on an assistant reply whose question was dropped
+    ordered = sorted(kept_indexes)
+    while ordered and history[ordered[0]]['role'] == 'assistant' and ordered[0] > 0:
+        kept_indexes.discard(ordered.pop(0))
+
+    kept = [entry for index, entry in enumerate(history) if index in kept_indexes or index in pinned]
+    dropped = [entry for index, entry in enumerate(history)
+               if index not in kept_indexes and entry['role'] != 'developer']
+    if summary:
+        kept.insert(0, _summary_entry(summary))
+    return kept, dropped
+
+def _load_summary(user_id, conversation_id):
+    from models import ConversationSummary
+
+    return ConversationSummary.query.filter_by(user_id=user_id, conversation_id=conversation_id).first()
+
+def _summarize(previous_summary, dropped, deployment_name):
+    """Ask the model to fold dropped turns into the running summary."""
+    from utils.openai_helper import create_chat_completion
+
+    transcript = "\n".join(f"{entry['role']}: {entry['content']}" for entry in dropped if entry.get('content'))
+    transcript = transcript[-SUMMARY_MAX_INPUT_CHARS:]
+    prompt = (
+        "Update the running summary of this conversation with the new turns below. "
+        "Keep facts, decisions, names and open questions; be concise.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"
+    )
+    response = create_chat_completion({
+        "model": SUMMARY_MODEL or deployment_name,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_completion_tokens": 600
+    })
+    return response.choices[0].message.content
+
+def _update_summary(user_id, conversation_id, dropped, deployment_name):
+    """Roll dropped turns into the stored summary; return the new summary text or None."""
+    from app import db
+    from models import ConversationSummary
+
+    try:
+        summary_row = _load_summary(user_id, conversation_id)
+        if summary_row is not None:
+            # Another worker may have summarized some of these turns already
+            dropped = [entry for entry in dropped if entry['id'] > summary_row.through_message_id]
+            if not dropped:
+                return None
+        content = _summarize(summary_row.content if summary_row else None, dropped, deployment_name)
+        if not content:
+            return None
+        through_id = max(entry['id'] for entry in dropped)
+        if summary_row is None:
+            summary_row = ConversationSummary(user_id=user_id, conversation_id=conversation_id)
+            db.session.add(summary_row)
+        summary_row.content = content
+        summary_row.through_message_id = through_id
+        summary_row.token_count = count_tokens(content)
+        db.session.commit()
+        with _stats_lock:
+            _stats['summaries'] += 1
+        logging.info(f"Updated summary for conversation {conversation_id} through message {through_id}")
+        return content
+    except Exception as e:
+        db.session.rollback()
+        with _stats_lock:
+            _stats['summary_errors'] += 1
+        logging.error(f"Error updating conversation summary: {str(e)}")
+        return None
+
+def _schedule_summary(user_id, conversation_id, dropped, deployment_name):
+    """Update the stored summary on a background thread, unless an update is already running."""
+    from flask import current_app
+
+    key = (user_id, conversation_id)
+    with _stats_lock:
+        if key in _summarizing:
+            return
+        _summarizing.add(key)
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            with app.app_context():
+                _update_summary(user_id, conversation_id, dropped, deployment_name)
+        finally:
+            with _stats_lock:
+                _summarizing.discard(key)
+
+    threading.Thread(target=run, daemon=True, name=f"summary-{conversation_id}").start()
+
+def apply_context_budget(history, deployment_name, message, image_data=None, developer_message=None,
+                         user_id=None, conversation_id=None):
+    """Fit a conversation's history into the model's context budget.
+
+    Args:
+        history (list): History entries, oldest first
+        deployment_name (str): Deployment the request is sent to
+        message (str): The new user message
+        image_data (str, optional): Image attached to the new message
+        developer_message (str, optional): Developer message sent with the new turn
+        user_id (int, optional): Owner of a server-side conversation (enables summaries)
+        conversation_id (str, optional): Server-side conversation id (enables summaries)
+
+    Returns:
+        tuple: (history, report) where report is a dict with 'budget',
+        'history_tokens', 'sent_tokens', 'dropped_messages', 'tokens_saved',
+        'trimmed' and 'over_budget' (the untrimmed history would not have fit)
+    """
+    from utils.openai_helper import get_context_budget, AZURE_OPENAI_DEPLOYMENT_NAME
+
+    deployment_name = deployment_name or AZURE_OPENAI_DEPLOYMENT_NAME
+    budget = get_context_budget(deployment_name)
+    if CONTEXT_TOKEN_BUDGET:
+        budget = min(budget, CONTEXT_TOKEN_BUDGET)
+
+    reserved = count_message_tokens(message, image_data)
+    if developer_message:
+        reserved += count_message_tokens(developer_message)
+    history_tokens = sum(_entry_tokens(entry) for entry in history)
+
+    use_summary = SUMMARIZE_ENABLED and user_id and conversation_id
+    summary_row = _load_summary(user_id, conversation_id) if use_summary else None
+    summary = None
+    candidates = history
+    if summary_row is not None:
+        summary = summary_row.content
+        candidates = [entry for entry in history
+                      if entry.get('id') is None or entry['id'] > summary_row.through_message_id
+                      or entry['role'] == 'developer']
+
+    kept, dropped = fit_history(candidates, budget, reserved, summary)
+
+    summarizable = [dict(entry) for entry in dropped if entry.get('id') is not None]
+    if use_summary and summarizable and (summary_row is None or len(summarizable) >= SUMMARY_MIN_NEW_MESSAGES):
+        # This turn goes out with the current summary and plain trimming
+        _schedule_summary(user_id, conversation_id, summarizable, deployment_name)
+
+    sent_tokens = sum(_entry_tokens(entry) for entry in kept)
+    kept_ids = {id(entry) for entry in kept}
+    dropped_messages = sum(1 for entry in history if id(entry) not in kept_ids)
+    report = {
+        'budget': budget,
+        'history_tokens': history_tokens,
+        'sent_tokens': sent_tokens,
+        'dropped_messages': dropped_messages,
+        'tokens_saved': max(0, history_tokens - sent_tokens),
+        'trimmed': dropped_messages > 0 or summary is not None,
+        'over_budget': history_tokens + reserved > budget
+    }
+
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['tokens_saved'] += report['tokens_saved']
+        if report['trimmed']:
+            _stats['trimmed_requests'] += 1
+    metrics.CONTEXT_REQUESTS.labels('true' if report['trimmed'] else 'false').inc()
+    metrics.CONTEXT_TOKENS_SAVED.inc(report['tokens_saved'])
+
+    if report['trimmed']:
+        logging.info(
+            f"Context budget {budget} for {deployment_name}: sent {sent_tokens} of {history_tokens} history tokens, "
+            f"dropped {report['dropped_messages']} messages, saved {report['tokens_saved']} tokens"
+        )
+    return kept, report
+
+def get_stats():
+    """Return running totals of requests, trimmed requests, tokens saved and summary updates."""
+    with _stats_lock:
+        return dict(_stats, summarizing=len(_summarizing))
@@ -0,0 +1,187 @@
+"""
+Server-side conversation history.
+
+Clients identify a conversation by a ``conversation_id`` and send only the
+new turn; the server assembles the prompt history from the ``Message``
+table. Each worker keeps a bounded LRU cache of recently used
+conversations and, on every turn, only reads the rows added since it last
+looked, so history assembly stays cheap and correct across workers.
+Messages up to the user's clear watermark (see utils.message_reaper) are
+never returned, even if another worker cached them before the clear.
+
+An assistant message that is still being generated ends the history until
+it is finished. A message whose job died (worker killed, job crashed) keeps
+``is_streaming`` set forever, so one that is no longer queued or running,
+or was created more than STREAMING_STALE_AFTER seconds ago, is read as
+final with whatever text it has.
+
+Settings:
+
+    STREAMING_STALE_AFTER   Seconds after which a streaming message counts as abandoned (default 600)
+"""
+import os
+import logging
+import itertools
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+MAX_CACHED_CONVERSATIONS = 1000
+STREAMING_STALE_AFTER = float(os.environ.get("STREAMING_STALE_AFTER", "600"))
+
+def _is_generating(row, stale_before):
+    """Return True if an assistant row is still being written by a live generation job."""
+    from utils.generation import ACTIVE_STATUSES
+
+    if not row.is_streaming or row.status not in ACTIVE_STATUSES:
+        return False
+    return row.timestamp is None or row.timestamp >= stale_before
+
+def generating_clause():
+    """SQL counterpart of _is_generating() for Message queries, e.g. to leave live rows alone."""
+    from sqlalchemy import and_, or_, func
+    from models import Message
+    from utils.generation import ACTIVE_STATUSES
+
+    stale_before = datetime.utcnow() - timedelta(seconds=STREAMING_STALE_AFTER)
+    return and_(
+        Message.is_streaming.is_(True),
+        func.coalesce(Message.status, '').in_(ACTIVE_STATUSES),
+        or_(Message.timestamp.is_(None), Message.timestamp >= stale_before)
+    )
+
+class _CachedConversation:
+    """History entries for one conversation plus the last row id that was read."""
+
+    def __init__(self):
+        self.entries = []
+        self.last_id = 0
+        self.last_response_id = None
+        self.last_response_endpoint = None
+
+class ConversationStore:
+    """Bounded cache of conversation histories backed by the Message table."""
+
+    def __init__(self, max_conversations=MAX_CACHED_CONVERSATIONS):
+        self.max_conversations = max_conversations
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_history(self, user_id, conversation_id):
+        """Return the history of a conversation.
+
+        Must be called inside a Flask application context.
+
+        Args:
+            user_id (int): Owner of the conversation
+            conversation_id (str): Client-supplied conversation id
+
+        Returns:
+            tuple: (history, previous_response_id, previous_response_endpoint)
+            where history is a list of {'id', 'role', 'content', 'image',
+            'image_ref', 'tokens'} dicts in the format expected by
+            format_conversation_history(), previous_response_id is the
+            Responses API id of the last assistant turn (or None) and
+            previous_response_endpoint the endpoint that stored it
+        """
+        from app import is_database_available
+
+        if not is_database_available():
+            from utils.db_fallback import get_messages_for_conversation
+            history = [{
+                'id': msg['id'],
+                'role': msg['role'],
+                'content': msg['content'],
+                'image': msg['image_data'],
+                'image_ref': msg['image_ref'],
+                'tokens': None
+            } for msg in get_messages_for_conversation(user_id, conversation_id)]
+            return history, None, None
+
+        from utils.message_reaper import cleared_through
+
+        # Messages up to the user's last clear (possibly made by another worker) are skipped
+        watermark = cleared_through(user_id)
+        key = (user_id, conversation_id)
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if cached is None or cached.last_id < watermark or (cached.entries and cached.entries[0]['id'] <= watermark):
+                cached = _CachedConversation()
+                cached.last_id = watermark
+            self._cache[key] = cached
+            while len(self._cache) > self.max_conversations:
+                self._cache.popitem(last=False)
+
+        new_rows = self._load_rows(user_id, conversation_id, cached.last_id)
+        # Don't read past a response that is still being generated; pick it up next turn
+        stale_before = datetime.utcnow() - timedelta(seconds=STREAMING_STALE_AFTER)
+        new_rows = list(itertools.takewhile(lambda row: not _is_generating(row, stale_before), new_rows))
+        counted = self._count_missing_tokens(new_rows)
+
+        with self._lock:
+            for row in new_rows:
+                if row.id <= cached.last_id:
+                    continue
+                if row.content or row.image_data or row.image_ref:
+                    cached.entries.append({
+                        'id': row.id,
+                        'role': row.role,
+                        'content': row.content,
+                        'image': row.image_data,
+                        'image_ref': row.image_ref,
+                        'tokens': row.token_count
+                    })
+                if row.role == 'assistant':
+                    cached.last_response_id = row.response_id
+                    cached.last_response_endpoint = row.response_endpoint
+                elif row.role == 'user':
+                    cached.last_response_id = None
+                    cached.last_response_endpoint = None
+                cached.last_id = row.id
+            history = list(cached.entries), cached.last_response_id, cached.last_response_endpoint
+
+        if counted:
+            self._store_token_counts()
+        return history
+
+    def _load_rows(self, user_id, conversation_id, after_id):
+        from models import Message
+
+        return Message.query.filter(
+            Message.user_id == user_id,
+            Message.conversation_id == conversation_id,
+            Message.id > after_id
+        ).order_by(Message.id).all()
+
+    def _count_missing_tokens(self, rows):
+        """Count tokens for rows written before counts were cached; return True if any were set."""
+        from utils.context_window import count_message_tokens
+
+        counted = False
+        for row in rows:
+            if row.token_count is None:
+                row.token_count = count_message_tokens(row.content, row.image_data or row.image_ref)
+                counted = True
+        return counted
+
+    def _store_token_counts(self):
+        """Persist token counts filled in by _count_missing_tokens()."""
+        from app import db
+
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.warning(f"Could not store token counts: {str(e)}")
+
+    def invalidate(self, user_id, conversation_id=None):
+        """Drop cached history for one conversation, or for all of a user's conversations."""
+        with self._lock:
+            if conversation_id is not None:
+                self._cache.pop((user_id, conversation_id), None)
+                return
+            for key in [key for key in self._cache if key[0] == user_id]:
+                del self._cache[key]
+        logging.debug(f"Invalidated cached conversations for user ID: {user_id}")
+
+conversation_store = ConversationStore()
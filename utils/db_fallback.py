@@ -1,47 +1,208 @@
 """
 Fallback storage module for when the database is not available.
 This allows the application to function without database access.
+
+Messages are indexed per user (and per conversation within a user), so
+appends are O(1) and reads only touch the requesting user's messages.
+Message ids come from a process-wide counter and are never reused. Total
+memory is capped (FALLBACK_MAX_BYTES, default 256 MB); when it is
+exceeded, the messages of the least recently used users are evicted.
+All access is serialized by one lock.
 """
+import os
+import bisect
 import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+FALLBACK_MAX_BYTES = int(os.environ.get("FALLBACK_MAX_BYTES", str(256 * 1024 * 1024)))
+# Approximate fixed cost of one message dict beyond its strings
+MESSAGE_OVERHEAD_BYTES = 400
+
+_lock = threading.Lock()
 
-# In-memory user storage
+# In-memory user storage, by username and by id
 users = {}
-messages = []
+_users_by_id = {}
+_next_user_id = 1
 
-def register_user(username):
-    """Register a new user or get an existing user."""
+class _UserMessages:
+    """One user's messages in id order, indexed by conversation."""
+
+    def __init__(self):
+        self.messages = []
+        self.ids = []
+        self.conversations = {}
+        self.size = 0
+
+# user_id -> _UserMessages, least recently used first
+_messages = OrderedDict()
+_next_message_id = 1
+_total_size = 0
+
+def _message_size(message):
+    size = MESSAGE_OVERHEAD_BYTES
+    for field in ('content', 'image_data', 'reasoning_summary'):
+        if message.get(field):
+            size += len(message[field])
+    return size
+
+def _touch(user_id, create=False):
+    """Return a user's messages and mark them most recently used."""
+    user_messages = _messages.get(user_id)
+    if user_messages is None:
+        if not create:
+            return None
+        user_messages = _messages[user_id] = _UserMessages()
+    _messages.move_to_end(user_id)
+    return user_messages
+
+def _evict(keep_user_id):
+    """Drop the least recently used users' messages until under the memory cap."""
+    global _total_size
+    while _total_size > FALLBACK_MAX_BYTES and len(_messages) > 1:
+        user_id = next(iter(_messages))
+        if user_id == keep_user_id:
+            break
+        evicted = _messages.pop(user_id)
+        _total_size -= evicted.size
+        logging.warning(f"In-memory storage over {FALLBACK_MAX_BYTES} bytes; evicted "
+                        f"{len(evicted.messages)} messages of idle user ID: {user_id}")
+
+def _register(username):
+    """Return (user, created) for a username; the lock must be held."""
+    global _next_user_id
     if username in users:
-        return users[username]
-    
+        return users[username], False
+
     # Create a simple user dict with an incrementing ID
-    user_id = len(users) + 1
-    users[username] = {
+    user_id = _next_user_id
+    _next_user_id += 1
+    users[username] = _users_by_id[user_id] = {
         'id': user_id,
         'username': username
     }
-    logging.info(f"Created in-memory user: {username} (ID: {user_id})")
-    return users[username]
+    return users[username], True
 
-def add_message(user_id, content, role):
+def register_user(username):
+    """Register a new user or get an existing user."""
+    with _lock:
+        user, created = _register(username)
+    if created:
+        logging.info(f"Created in-memory user: {username} (ID: {user['id']})")
+    return user
+
+def register_users(usernames):
+    """Register many users at once.
+
+    Returns:
+        tuple: (ids, created) where ids maps each username to its user id and
+        created is the number of users that didn't exist yet
+    """
+    ids = {}
+    created = 0
+    with _lock:
+        for username in usernames:
+            user, new = _register(username)
+            ids[username] = user['id']
+            created += new
+    logging.info(f"Registered {len(ids)} in-memory users ({created} new)")
+    return ids, created
+
+def get_user(user_id):
+    """Get an in-memory user by id, or None."""
+    with _lock:
+        return _users_by_id.get(user_id)
+
+def add_message(user_id, content, role, conversation_id=None, image_data=None, image_ref=None,
+                reasoning_effort=None, reasoning_summary=None):
     """Add a message to the in-memory storage."""
-    message_id = len(messages) + 1
-    message = {
-        'id': message_id,
-        'user_id': user_id,
-        'content': content,
-        'role': role,
-        'timestamp': None  # No timestamp in memory
-    }
-    messages.append(message)
+    global _next_message_id, _total_size
+    with _lock:
+        message = {
+            'id': _next_message_id,
+            'user_id': user_id,
+            'content': content,
+            'role': role,
+            'conversation_id': conversation_id,
+            'image_data': image_data,
+            'image_ref': image_ref,
+            'reasoning_effort': reasoning_effort,
+            'reasoning_summary': reasoning_summary,
+            'timestamp': datetime.utcnow().isoformat()
+        }
+        _next_message_id += 1
+
+        user_messages = _touch(user_id, create=True)
+        user_messages.messages.append(message)
+        user_messages.ids.append(message['id'])
+        user_messages.conversations.setdefault(conversation_id, []).append(message)
+        size = _message_size(message)
+        user_messages.size += size
+        _total_size += size
+        _evict(user_id)
     return message
 
-def get_messages_for_user(user_id):
-    """Get all messages for a specific user."""
-    return [msg for msg in messages if msg['user_id'] == user_id]
+def get_messages_for_user(user_id, before=None, after=None, limit=None):
+    """Get a user's messages in id order.
+
+    Args:
+        user_id (int): The user whose messages to return
+        before (int, optional): Only messages with a smaller id
+        after (int, optional): Only messages with a larger id
+        limit (int, optional): Maximum number of messages to return; the oldest
+            ones are kept with 'after', the newest ones otherwise
+    """
+    with _lock:
+        user_messages = _touch(user_id)
+        if user_messages is None:
+            return []
+        start = bisect.bisect_right(user_messages.ids, after) if after is not None else 0
+        end = bisect.bisect_left(user_messages.ids, before) if before is not None else len(user_messages.ids)
+        if limit is not None:
+            if after is not None:
+                end = min(end, start + limit)
+            else:
+                start = max(start, end - limit)
+        return user_messages.messages[start:end]
+
+def get_message(user_id, message_id):
+    """Get one of a user's messages by id, or None."""
+    with _lock:
+        user_messages = _touch(user_id)
+        if user_messages is None:
+            return None
+        index = bisect.bisect_left(user_messages.ids, message_id)
+        if index < len(user_messages.ids) and user_messages.ids[index] == message_id:
+            return user_messages.messages[index]
+        return None
+
+def get_messages_for_conversation(user_id, conversation_id):
+    """Get the messages of one conversation for a specific user."""
+    with _lock:
+        user_messages = _touch(user_id)
+        if user_messages is None:
+            return []
+        return list(user_messages.conversations.get(conversation_id, []))
 
 def clear_messages_for_user(user_id):
     """Clear all messages for a specific user."""
-    global messages
-    messages = [msg for msg in messages if msg['user_id'] != user_id]
+    global _total_size
+    with _lock:
+        user_messages = _messages.pop(user_id, None)
+        if user_messages is not None:
+            _total_size -= user_messages.size
     logging.info(f"Cleared in-memory messages for user ID: {user_id}")
-    return True
\ No newline at end of file
+    return True
+
+def get_stats():
+    """Return the number of users, users with messages, messages and approximate bytes held in memory."""
+    with _lock:
+        return {
+            'users': len(_users_by_id),
+            'users_with_messages': len(_messages),
+            'messages': sum(len(user_messages.messages) for user_messages in _messages.values()),
+            'bytes': _total_size,
+            'max_bytes': FALLBACK_MAX_BYTES
+        }
@@ -0,0 +1,322 @@
+"""
+Latency-aware routing of Azure OpenAI calls across endpoints.
+
+The app can be served by several Azure OpenAI resources, typically one per
+region, each with its own deployments and credentials. Every call goes to
+the healthiest endpoint that serves the requested model and fails over to
+the next one when an endpoint errors before producing output, so a
+regional outage or exhausted quota doesn't take the app down. Streams fail
+over only until their first event, which callers make the first output
+delta; after that the client has seen output.
+
+Health is tracked per endpoint (and per worker process) as exponentially
+weighted moving averages of time to first token, call latency and error
+rate. Endpoints are ranked by latency plus an error penalty, divided by
+their weight; endpoints without samples yet are tried first so they get
+measured. After ROUTER_FAILURE_THRESHOLD consecutive failures an endpoint
+is skipped for ROUTER_COOLDOWN seconds, then probed again.
+
+A call can prefer an endpoint, which is then tried first while it is
+available; Responses API calls chained to a stored response prefer the
+endpoint holding it.
+
+Endpoints are configured as JSON in AZURE_OPENAI_ENDPOINTS:
+
+    [{"name": "eastus", "endpoint": "https://contoso-eastus.openai.azure.com",
+      "api_key_env": "AZURE_OPENAI_KEY_EASTUS", "deployments": {"gpt-4o": "gpt-4o-eastus"}, "weight": 2},
+     {"name": "swedencentral", "endpoint": "https://contoso-sweden.openai.azure.com",
+      "api_key_env": "AZURE_OPENAI_KEY_SWEDEN", "deployments": ["gpt-4o", "o3"]}]
+
+``deployments`` maps model ids to deployment names; a list means the
+deployments are named after the models, and leaving it out serves every
+model that way. ``api_key`` may be given inline instead of ``api_key_env``,
+and ``api_version`` overrides AZURE_OPENAI_API_VERSION. Without
+AZURE_OPENAI_ENDPOINTS the single AZURE_OPENAI_ENDPOINT/AZURE_OPENAI_API_KEY
+pair is used. Endpoints can be plain http URLs, so routing can be
+exercised against local stub servers.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+
+from utils import client_registry
+from utils.scheduler import SchedulerOverloaded
+
+AZURE_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "2025-04-01-preview")
+EWMA_ALPHA = float(os.environ.get("ROUTER_EWMA_ALPHA", "0.2"))
+FAILURE_THRESHOLD = int(os.environ.get("ROUTER_FAILURE_THRESHOLD", "3"))
+COOLDOWN_SECONDS = float(os.environ.get("ROUTER_COOLDOWN", "30"))
+# Seconds of latency an endpoint is charged for an error rate of 100%
+ERROR_PENALTY_SECONDS = 10.0
+# Statuses that say something about the endpoint rather than the request
+ENDPOINT_ERROR_STATUSES = (401, 403, 404, 408, 429)
+
+def is_endpoint_error(error):
+    """Return True if an error is worth failing over to another endpoint for."""
+    if isinstance(error, SchedulerOverloaded):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+    return status in ENDPOINT_ERROR_STATUSES or status >= 500
+
+def _ewma(current, sample):
+    return sample if current is None else current + EWMA_ALPHA * (sample - current)
+
+class Endpoint:
+    """One Azure OpenAI resource and its rolling health."""
+
+    def __init__(self, name, endpoint, api_key, api_version=AZURE_OPENAI_API_VERSION, deployments=None, weight=1.0):
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.api_version = api_version
+        if isinstance(deployments, list):
+            deployments = {model: model for model in deployments}
+        self.deployments = deployments
+        self.weight = float(weight) if weight and float(weight) > 0 else 1.0
+
+        self._lock = threading.Lock()
+        self.ttft = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.stats = {'requests': 0, 'failures': 0, 'failovers': 0}
+
+    def deployment_for(self, model):
+        """Return the deployment serving a model here, or None if this endpoint doesn't serve it."""
+        if self.deployments is None:
+            return model
+        return self.deployments.get(model)
+
+    def get_client(self, async_client=False):
+        if async_client:
+            return client_registry.get_async_client(self.endpoint, self.api_version, self.api_key)
+        return client_registry.get_client(self.endpoint, self.api_version, self.api_key)
+
+    def is_open(self, now):
+        """Return True while the endpoint is skipped after repeated failures."""
+        return now < self.open_until
+
+    def score(self):
+        """Routing cost of this endpoint; lower is better."""
+        latency = self.ttft if self.ttft is not None else self.latency
+        return ((latency or 0.0) + ERROR_PENALTY_SECONDS * self.error_rate) / self.weight
+
+    def record_success(self, latency=None, ttft=None):
+        with self._lock:
+            self.stats['requests'] += 1
+            if latency is not None:
+                self.latency = _ewma(self.latency, latency)
+            if ttft is not None:
+                self.ttft = _ewma(self.ttft, ttft)
+            self.error_rate = _ewma(self.error_rate, 0.0)
+            self.consecutive_failures = 0
+
+    def record_failure(self, error):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['failures'] += 1
+            self.error_rate = _ewma(self.error_rate, 1.0)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= FAILURE_THRESHOLD:
+                self.open_until = time.monotonic() + COOLDOWN_SECONDS
+                logging.warning(f"Endpoint {self.name} failed {self.consecutive_failures} times in a row; "
+                                f"skipping it for {COOLDOWN_SECONDS:.0f}s ({str(error)})")
+
+    def record_failover(self):
+        with self._lock:
+            self.stats['failovers'] += 1
+
+    def health(self):
+        """Return the endpoint's health state (without credentials)."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'name': self.name,
+                'endpoint': self.endpoint,
+                'weight': self.weight,
+                'deployments': self.deployments,
+                'ttft_ms': round(self.ttft * 1000) if self.ttft is not None else None,
+                'latency_ms': round(self.latency * 1000) if self.latency is not None else None,
+                'error_rate': round(self.error_rate, 4),
+                'consecutive_failures': self.consecutive_failures,
+                'available': not self.is_open(now),
+                'retry_in': max(0.0, round(self.open_until - now, 1)),
+                **self.stats
+            }
+
+class Route:
+    """One attempt of a call: an endpoint, its client and the deployment serving the model."""
+
+    def __init__(self, endpoint, client, deployment, is_last):
+        self.endpoint = endpoint
+        self.client = client
+        self.deployment = deployment
+        self.is_last = is_last
+
+    @property
+    def scheduler_key(self):
+        """Key of the deployment's admission queue in utils.scheduler."""
+        return f"{self.endpoint.name}/{self.deployment}"
+
+    @property
+    def max_retries(self):
+        """Scheduler retries for this attempt; only the last endpoint retries, the others fail over."""
+        return None if self.is_last else 0
+
+def _load_endpoints():
+    raw = os.environ.get("AZURE_OPENAI_ENDPOINTS")
+    if not raw:
+        endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
+        api_key = os.environ.get("AZURE_OPENAI_API_KEY")
+        if not endpoint or not api_key:
+            return []
+        return [Endpoint("default", endpoint, api_key)]
+
+    endpoints = []
+    for config in json.loads(raw):
+        api_key = config.get("api_key") or os.environ.get(config.get("api_key_env", ""))
+        if not config.get("endpoint") or not api_key:
+            logging.error(f"Skipping Azure OpenAI endpoint without URL or API key: {config.get('name')}")
+            continue
+        endpoints.append(Endpoint(
+            config.get("name") or urlparse(config["endpoint"]).hostname,
+            config["endpoint"],
+            api_key,
+            config.get("api_version", AZURE_OPENAI_API_VERSION),
+            config.get("deployments"),
+            config.get("weight", 1.0)
+        ))
+    return endpoints
+
+class EndpointRouter:
+    """Routes calls to the healthiest endpoint serving a model, with failover."""
+
+    def __init__(self, endpoints=None):
+        self._endpoints = endpoints
+        self._lock = threading.Lock()
+
+    @property
+    def endpoints(self):
+        if self._endpoints is None:
+            with self._lock:
+                if self._endpoints is None:
+                    self._endpoints = _load_endpoints()
+                    logging.info(f"Routing Azure OpenAI calls across {len(self._endpoints)} endpoint(s): "
+                                 f"{', '.join(endpoint.name for endpoint in self._endpoints)}")
+        return self._endpoints
+
+    def routes(self, model, async_client=False, prefer=None):
+        """Return the attempts for a call to a model, best endpoint first.
+
+        prefer names an endpoint to try first while it is available, e.g. the
+        one holding a stored response the call continues.
+
+        Raises:
+            ValueError: If no configured endpoint serves the model
+        """
+        if not self.endpoints:
+            raise ValueError("Azure OpenAI API key or endpoint is missing")
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.deployment_for(model)]
+        if not candidates:
+            raise ValueError(f"No Azure OpenAI endpoint serves model {model}")
+
+        now = time.monotonic()
+        # Skipped endpoints go last rather than away, so a call is attempted even if all are failing
+        candidates.sort(key=lambda endpoint: (endpoint.is_open(now), endpoint.name != prefer, endpoint.score()))
+        return [
+            Route(endpoint, endpoint.get_client(async_client), endpoint.deployment_for(model), i == len(candidates) - 1)
+            for i, endpoint in enumerate(candidates)
+        ]
+
+    def _fail_over(self, route, error):
+        """Record a failed attempt; return True if the call should move on to the next endpoint."""
+        if not isinstance(error, SchedulerOverloaded) and is_endpoint_error(error):
+            route.endpoint.record_failure(error)
+        if route.is_last or not is_endpoint_error(error):
+            return False
+        route.endpoint.record_failover()
+        logging.warning(f"Endpoint {route.endpoint.name} failed for {route.deployment} ({str(error)}); failing over")
+        return True
+
+    def call(self, model, fn, prefer=None):
+        """Return fn(route) from the best endpoint serving model, failing over on endpoint errors."""
+        for route in self.routes(model, prefer=prefer):
+            started = time.monotonic()
+            try:
+                result = fn(route)
+            except Exception as e:
+                if self._fail_over(route, e):
+                    continue
+                raise
+            route.endpoint.record_success(latency=time.monotonic() - started)
+            return result
+
+    def stream(self, model, start, prefer=None):
+        """Iterate start(route)'s events from the best endpoint, failing over until the first event."""
+        for route in self.routes(model, prefer=prefer):
+            started = time.monotonic()
+            first = True
+            try:
+                for event in start(route):
+                    if first:
+                        route.endpoint.record_success(ttft=time.monotonic() - started)
+                        first = False
+                    yield event
+            except Exception as e:
+                if not first:
+                    # Output was already sent; the stream can't move to another endpoint
+                    if is_endpoint_error(e):
+                        route.endpoint.record_failure(e)
+                    raise
+                if self._fail_over(route, e):
+                    continue
+                raise
+            return
+
+    async def call_async(self, model, fn, prefer=None):
+        """Async counterpart of call(); fn(route) returns an awaitable."""
+        for route in self.routes(model, async_client=True, prefer=prefer):
+            started = time.monotonic()
+            try:
+                result = await fn(route)
+            except Exception as e:
+                if self._fail_over(route, e):
+                    continue
+                raise
+            route.endpoint.record_success(latency=time.monotonic() - started)
+            return result
+
+    async def stream_async(self, model, start, prefer=None):
+        """Async counterpart of stream(); start(route) returns an async iterator."""
+        for route in self.routes(model, async_client=True, prefer=prefer):
+            started = time.monotonic()
+            first = True
+            try:
+                async for event in start(route):
+                    if first:
+                        route.endpoint.record_success(ttft=time.monotonic() - started)
+                        first = False
+                    yield event
+            except Exception as e:
+                if not first:
+                    if is_endpoint_error(e):
+                        route.endpoint.record_failure(e)
+                    raise
+                if self._fail_over(route, e):
+                    continue
+                raise
+            return
+
+    def health(self):
+        """Return the health of every endpoint in current routing order."""
+        now = time.monotonic()
+        ordered = sorted(self.endpoints, key=lambda endpoint: (endpoint.is_open(now), endpoint.score()))
+        return [endpoint.health() for endpoint in ordered]
+
+router = EndpointRouter()
@@ -0,0 +1,429 @@
+"""
+Generation jobs decoupled from the requests that start them.
+
+A streaming /api/chat request no longer consumes the upstream stream
+itself. The handler stores the user's message, creates the assistant
+``Message`` with status ``queued`` and hands the not yet started upstream
+stream to a ``StreamJob``. The job runs on a worker pool, publishes the SSE
+frames to the stream bus (see utils.stream_buffer) and persists the message
+as it goes, moving its status to ``running`` and finally to ``done`` or
+``failed``. The handler only subscribes to the bus.
+
+The deployment's scheduler admits the upstream call when the job starts
+iterating the stream, so jobs waiting for a worker hold no concurrency or
+tokens-per-minute budget. A job the scheduler sheds fails with a "busy"
+error on its stream instead of the 503 a non-streaming request gets.
+
+The sync app's database commits and statements of a streaming request are
+counted across the handler and its job (see utils.metrics).
+
+The answer no longer depends on the client that asked for it: a slow
+reader can't hold back the upstream stream, a dropped connection doesn't
+stop the generation, and any number of subscribers (a resumed connection,
+a second tab) can follow the same job through /api/chat/stream.
+
+The sync app runs jobs on a pool of GENERATION_WORKERS threads per
+process; the async app runs them as tasks on the event loop, at most
+GENERATION_WORKERS at a time. The pool is sized independently of the web
+server's workers and threads.
+
+A job stops early when it is cancelled:
+
+- through ``POST /api/chat/cancel``, which sets the stream's cancel event
+  when the job runs in the same process and marks the message ``cancelled``
+  for a job in another process (checked every CANCEL_POLL_INTERVAL seconds)
+- when nobody has been subscribed to its stream for CANCEL_GRACE_PERIOD
+  seconds, i.e. the client went away and didn't resume
+
+Cancellation is checked between upstream events. The job closes the
+upstream stream, which ends the HTTP response from Azure OpenAI and frees
+the scheduler slot. It then keeps the text produced so far, with status
+``cancelled`` and ``is_truncated`` set on the message.
+
+Settings:
+
+    GENERATION_WORKERS     Generation jobs run concurrently per process (default 32)
+    CANCEL_GRACE_PERIOD    Seconds a job runs on without subscribers (default 20; 0 never cancels)
+    CANCEL_POLL_INTERVAL   Seconds between checks of the message for a cancel from another process (default 1)
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import metrics
+from utils.openai_helper import REASONING_SUMMARY_EVENT
+from utils.scheduler import SchedulerOverloaded
+from utils.sse import SSEWriter, chat_final
+from utils.stream_buffer import MessageSnapshot
+from utils.stream_persistence import StreamingMessageWriter, AsyncStreamingMessageWriter
+
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "32"))
+CANCEL_GRACE_PERIOD = float(os.environ.get("CANCEL_GRACE_PERIOD", "20"))
+CANCEL_POLL_INTERVAL = float(os.environ.get("CANCEL_POLL_INTERVAL", "1"))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+FAILED_MESSAGE = "The response could not be completed"
+BUSY_MESSAGE = "The model is busy right now, please try again shortly"
+
+def snapshot_from_row(row):
+    """Return the MessageSnapshot of a row with content, reasoning_summary, is_streaming, is_truncated and status."""
+    error = FAILED_MESSAGE if row.status == STATUS_FAILED else None
+    return MessageSnapshot(row.content, row.reasoning_summary, bool(row.is_streaming), bool(row.is_truncated), error)
+
+class StreamJob:
+    """Consumes one upstream stream, publishing its frames and persisting the assistant message."""
+
+    def __init__(self, events, stream, message_id=None, user_id=None, conversation_id=None,
+                 reasoning_effort=None, response_meta=None, db_counts=None):
+        """
+        Args:
+            events (iterator): The upstream stream of (event_type, delta) pairs, admitted by the
+                scheduler once the job iterates it (an async iterator for ``run_async``)
+            stream (StreamBuffer): Where the frames are published
+            message_id (int, optional): The queued assistant message, or None when it isn't stored
+                in the database
+            user_id (int, optional): Owner of the message, for the in-memory fallback store
+            conversation_id (str, optional): Conversation of the message
+            reasoning_effort (str, optional): Reasoning effort of the request
+            response_meta (dict, optional): Filled with the upstream response id while streaming
+            db_counts (tuple, optional): The request's database counts from
+                metrics.carry_request_db(); the job adds its own and records them when it ends
+        """
+        self.events = events
+        self.stream = stream
+        self.message_id = message_id
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.reasoning_effort = reasoning_effort
+        self.response_meta = response_meta if response_meta is not None else {}
+        self.db_counts = db_counts
+        self.submitted_at = time.perf_counter()
+        self._row_checked_at = time.monotonic()
+
+    def _cancel_reason(self):
+        """Return why the job should stop now, or None; checks that need the database are left to the caller."""
+        if self.stream.cancel_event.is_set():
+            return self.stream.cancel_reason
+        if CANCEL_GRACE_PERIOD > 0 and self.stream.unwatched_for() >= CANCEL_GRACE_PERIOD:
+            return 'disconnected'
+        return None
+
+    def _row_check_due(self):
+        if not self.message_id or time.monotonic() - self._row_checked_at < CANCEL_POLL_INTERVAL:
+            return False
+        self._row_checked_at = time.monotonic()
+        return True
+
+    def _close_events(self):
+        close = getattr(self.events, 'close', None)
+        if close is not None:
+            close()
+
+    async def _aclose_events(self):
+        aclose = getattr(self.events, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+    def _failed(self, error):
+        """Log why the job failed; return the error shown to its subscribers."""
+        if isinstance(error, SchedulerOverloaded):
+            logging.warning(f"Shedding generation of stream {self.stream.stream_id}: {str(error)}")
+            return BUSY_MESSAGE
+        logging.error(f"Generation job of stream {self.stream.stream_id} failed: {str(error)}")
+        return FAILED_MESSAGE
+
+    def _sse_writer(self, config):
+        return SSEWriter(
+            coalesce_ms=config["SSE_COALESCE_MS"],
+            max_bytes=config["SSE_COALESCE_MAX_BYTES"],
+            buffer=self.stream
+        )
+
+    def _store_fallback(self, full_response, reasoning_summary):
+        if self.user_id and self.message_id is None:
+            from app import is_database_available
+            from utils.db_fallback import add_message
+
+            if not is_database_available():
+                add_message(int(self.user_id), full_response, 'assistant', self.conversation_id,
+                            reasoning_effort=self.reasoning_effort, reasoning_summary=reasoning_summary)
+
+    def run(self, app):
+        """Run the job on the current thread; return its final status."""
+        from app import db
+        from models import Message
+        from utils.context_window import count_message_tokens
+
+        with app.app_context():
+            metrics.adopt_request_db(self.db_counts)
+            try:
+                message = db.session.get(Message, self.message_id) if self.message_id else None
+                writer = StreamingMessageWriter(
+                    message,
+                    db.session,
+                    flush_interval_ms=app.config["STREAM_FLUSH_INTERVAL_MS"],
+                    flush_max_bytes=app.config["STREAM_FLUSH_MAX_BYTES"]
+                )
+                sse = self._sse_writer(app.config)
+                # The job may have been cancelled while it was queued
+                cancelled = self._cancel_reason()
+                if message is not None:
+                    if message.status == STATUS_CANCELLED:
+                        cancelled = 'cancel request'
+                    else:
+                        message.status = STATUS_RUNNING
+                    db.session.commit()
+
+                if cancelled is None:
+                    for event_type, delta in self.events:
+                        if event_type == REASONING_SUMMARY_EVENT:
+                            writer.append_reasoning_summary(delta)
+                        else:
+                            writer.append(delta)
+                        sse.add(event_type, delta)
+                        cancelled = self._cancel_reason()
+                        if cancelled is None and self._row_check_due():
+                            with db.session.no_autoflush:
+                                row_status = db.session.query(Message.status).filter_by(id=self.message_id).scalar()
+                            if row_status == STATUS_CANCELLED:
+                                cancelled = 'cancel request'
+                        if cancelled is not None:
+                            break
+                if cancelled is not None:
+                    # Ends the upstream HTTP stream and frees the scheduler slot
+                    self._close_events()
+                    logging.info(f"Cancelled generation of stream {self.stream.stream_id} ({cancelled})")
+                sse.flush()
+
+                status = STATUS_CANCELLED if cancelled is not None else STATUS_DONE
+                if message is not None:
+                    message.response_id = self.response_meta.get('response_id')
+                    message.response_endpoint = self.response_meta.get('response_endpoint')
+                    message.token_count = count_message_tokens(writer.text)
+                    message.status = status
+                    message.is_truncated = cancelled is not None
+                full_response = writer.finish()
+                reasoning_summary = writer.reasoning_summary
+                self._store_fallback(full_response, reasoning_summary)
+
+                sse.frame(chat_final(full_response, reasoning_summary, cancelled is not None))
+                sse.close()
+                return status
+            except Exception as e:
+                error = self._failed(e)
+                db.session.rollback()
+                if self.message_id:
+                    try:
+                        Message.query.filter_by(id=self.message_id).update(
+                            {'status': STATUS_FAILED, 'is_streaming': False}, synchronize_session=False
+                        )
+                        db.session.commit()
+                    except Exception as update_error:
+                        db.session.rollback()
+                        logging.error(f"Could not mark message {self.message_id} as failed: {str(update_error)}")
+                self.stream.finish(error=error)
+                return STATUS_FAILED
+            finally:
+                self.stream.finish(interrupted=True)
+                self._close_events()
+                if self.db_counts is not None:
+                    metrics.observe_request_db()
+
+    async def run_async(self, app):
+        """Run the job on the event loop; return its final status."""
+        from sqlalchemy import select, update
+        from models import Message
+        from utils.async_db import get_session_factory
+        from utils.context_window import count_message_tokens
+
+        session = get_session_factory()() if self.message_id else None
+        try:
+            message = await session.get(Message, self.message_id) if session is not None else None
+            writer = AsyncStreamingMessageWriter(
+                message,
+                session,
+                flush_interval_ms=app.config["STREAM_FLUSH_INTERVAL_MS"],
+                flush_max_bytes=app.config["STREAM_FLUSH_MAX_BYTES"]
+            )
+            sse = self._sse_writer(app.config)
+            # The job may have been cancelled while it was queued
+            cancelled = self._cancel_reason()
+            if message is not None:
+                if message.status == STATUS_CANCELLED:
+                    cancelled = 'cancel request'
+                else:
+                    message.status = STATUS_RUNNING
+                await session.commit()
+
+            if cancelled is None:
+                paced = sse.paced(self.events)
+                try:
+                    # None means buffered deltas are due even though upstream is quiet
+                    async for event in paced:
+                        if event is None:
+                            sse.flush()
+                            continue
+                        event_type, delta = event
+                        if event_type == REASONING_SUMMARY_EVENT:
+                            await writer.append_reasoning_summary(delta)
+                        else:
+                            await writer.append(delta)
+                        sse.add(event_type, delta)
+                        cancelled = self._cancel_reason()
+                        if cancelled is None and self._row_check_due():
+                            with session.no_autoflush:
+                                row_status = (await session.execute(
+                                    select(Message.status).where(Message.id == self.message_id)
+                                )).scalar()
+                            if row_status == STATUS_CANCELLED:
+                                cancelled = 'cancel request'
+                        if cancelled is not None:
+                            break
+                finally:
+                    await paced.aclose()
+            if cancelled is not None:
+                # Ends the upstream HTTP stream and frees the scheduler slot
+                await self._aclose_events()
+                logging.info(f"Cancelled generation of stream {self.stream.stream_id} ({cancelled})")
+            sse.flush()
+
+            status = STATUS_CANCELLED if cancelled is not None else STATUS_DONE
+            if message is not None:
+                message.response_id = self.response_meta.get('response_id')
+                message.response_endpoint = self.response_meta.get('response_endpoint')
+                message.token_count = count_message_tokens(writer.text)
+                message.status = status
+                message.is_truncated = cancelled is not None
+            full_response = await writer.finish()
+            reasoning_summary = writer.reasoning_summary
+            self._store_fallback(full_response, reasoning_summary)
+
+            sse.frame(chat_final(full_response, reasoning_summary, cancelled is not None))
+            sse.close()
+            return status
+        except Exception as e:
+            error = self._failed(e)
+            if session is not None:
+                try:
+                    await session.rollback()
+                    await session.execute(
+                        update(Message).where(Message.id == self.message_id)
+                        .values(status=STATUS_FAILED, is_streaming=False)
+                    )
+                    await session.commit()
+                except Exception as update_error:
+                    logging.error(f"Could not mark message {self.message_id} as failed: {str(update_error)}")
+            self.stream.finish(error=error)
+            return STATUS_FAILED
+        finally:
+            self.stream.finish(interrupted=True)
+            if session is not None:
+                await session.close()
+            await self._aclose_events()
+
+class _PoolStats:
+    def __init__(self, max_workers):
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+        self.counts = {'submitted': 0, 'queued': 0, 'running': 0, STATUS_DONE: 0, STATUS_FAILED: 0,
+                       STATUS_CANCELLED: 0}
+
+    def submitted(self):
+        with self._lock:
+            self.counts['submitted'] += 1
+            self.counts['queued'] += 1
+
+    def started(self, job):
+        metrics.GENERATION_QUEUE_WAIT.observe(time.perf_counter() - job.submitted_at)
+        metrics.GENERATION_JOBS_RUNNING.inc()
+        with self._lock:
+            self.counts['queued'] -= 1
+            self.counts['running'] += 1
+
+    def finished(self, status):
+        metrics.GENERATION_JOBS_RUNNING.dec()
+        metrics.GENERATION_JOBS.labels(status).inc()
+        with self._lock:
+            self.counts['running'] -= 1
+            self.counts[status] += 1
+
+    def get(self):
+        with self._lock:
+            return dict(self.counts, max_workers=self.max_workers)
+
+class GenerationPool:
+    """Runs StreamJobs on worker threads."""
+
+    def __init__(self, max_workers=GENERATION_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = _PoolStats(max_workers)
+
+    def _get_executor(self):
+        # Threads don't survive a fork; each worker process gets its own pool
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix="generation")
+        return self._executor
+
+    def submit(self, job, app):
+        """Queue a job; it runs inside an application context of ``app``."""
+        self.stats.submitted()
+        self._get_executor().submit(self._run, job, app)
+
+    def _run(self, job, app):
+        self.stats.started(job)
+        status = STATUS_FAILED
+        try:
+            status = job.run(app)
+        except Exception as e:
+            logging.error(f"Generation job crashed: {str(e)}")
+        finally:
+            self.stats.finished(status)
+
+class AsyncGenerationPool:
+    """Runs StreamJobs as tasks on the event loop, a bounded number at a time."""
+
+    def __init__(self, max_workers=GENERATION_WORKERS):
+        self.max_workers = max_workers
+        self._semaphore = None
+        # Strong references, so running jobs aren't garbage collected
+        self._tasks = set()
+        self.stats = _PoolStats(max_workers)
+
+    def submit(self, job, app):
+        """Queue a job; must be called on the event loop."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        self.stats.submitted()
+        task = asyncio.get_running_loop().create_task(self._run(job, app))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job, app):
+        async with self._semaphore:
+            self.stats.started(job)
+            status = STATUS_FAILED
+            try:
+                status = await job.run_async(app)
+            except Exception as e:
+                logging.error(f"Generation job crashed: {str(e)}")
+            finally:
+                self.stats.finished(status)
+
+generation_pool = GenerationPool()
+async_generation_pool = AsyncGenerationPool()
@@ -0,0 +1,223 @@
+"""
+Non-blocking, structured logging.
+
+Request threads only put records on a queue; a background listener thread
+formats them and writes them to stderr, so a slow terminal or log shipper
+never stalls a request. Records are written as one JSON object per line
+with the id of the request that produced them (``X-Request-ID``, generated
+when the client doesn't send one, and echoed on the response).
+
+Before a record is written its message is scrubbed: base64 payloads (data
+URLs and long base64 runs, e.g. images in logged request bodies) are
+replaced by their length, and messages are capped at LOG_MAX_MESSAGE_CHARS.
+High-volume debug logging can be sampled per logger (the module name for
+records of the root logger).
+
+Settings:
+
+    LOG_LEVEL               Root log level (default INFO)
+    LOG_FORMAT              json or text (default json)
+    LOG_MAX_MESSAGE_CHARS   Longer messages are truncated (default 2000)
+    LOG_SAMPLE_RATES        Fraction of DEBUG records kept per logger,
+                            e.g. "openai_helper=0.1,httpcore=0" (default: keep all)
+"""
+import os
+import re
+import sys
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import traceback
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+MAX_MESSAGE_CHARS = int(os.environ.get("LOG_MAX_MESSAGE_CHARS", "2000"))
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Data URLs, and runs of base64 long enough not to be ordinary words or ids
+BASE64_PATTERN = re.compile(r"data:[\w/+.-]+;base64,[A-Za-z0-9+/=]+|[A-Za-z0-9+/]{200,}={0,2}")
+VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# Request id of the current task, for code running outside a Flask request (the ASGI app)
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_queue_handler = None
+_listener = None
+
+def _parse_sample_rates(raw):
+    rates = {}
+    for item in (raw or "").split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            try:
+                rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError:
+                logging.warning(f"Ignoring invalid LOG_SAMPLE_RATES entry: {item}")
+    return rates
+
+def new_request_id(incoming=None):
+    """Return the client's request id if it is usable, otherwise a new one."""
+    if incoming and VALID_REQUEST_ID.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+def current_request_id():
+    if has_request_context():
+        request_id = g.get('request_id')
+        if request_id:
+            return request_id
+    return request_id_var.get()
+
+def redact(text):
+    """Replace base64 payloads by their length and cap the text at MAX_MESSAGE_CHARS."""
+    text = BASE64_PATTERN.sub(lambda match: f"<base64 {len(match.group(0))} chars>", text)
+    if len(text) > MAX_MESSAGE_CHARS:
+        text = f"{text[:MAX_MESSAGE_CHARS]}... <truncated {len(text) - MAX_MESSAGE_CHARS} chars>"
+    return text
+
+class SamplingFilter(logging.Filter):
+    """Keeps the configured fraction of DEBUG records per logger and tags records with the request id."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and self.rates:
+            name = record.module if record.name == "root" else record.name
+            rate = self.rates.get(name, self.rates.get(name.split(".")[0], 1.0))
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        record.request_id = current_request_id()
+        return True
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queues records without formatting them; the listener thread does that."""
+
+    def prepare(self, record):
+        # Only what can't cross threads is rendered here: lazy %-args and the traceback
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.module if record.name == "root" else record.name,
+            'message': redact(record.getMessage()),
+            'request_id': getattr(record, 'request_id', None),
+            'pid': record.process
+        }
+        if record.exc_text:
+            entry['exc'] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human-readable format for local runs, with the same redaction."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+
+    def format(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if not hasattr(record, 'request_id'):
+            record.request_id = None
+        return super().format(record)
+
+def _start_listener():
+    global _listener
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    _listener = QueueListener(_queue_handler.queue, handler, respect_handler_level=False)
+    _listener.start()
+
+def _restart_after_fork():
+    # The listener thread doesn't survive a fork (e.g. gunicorn --preload); the queue's lock may be held
+    if _queue_handler is not None:
+        _queue_handler.queue = queue.SimpleQueue()
+        _start_listener()
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+def configure_logging(level=None):
+    """Route root logging through the queue at the given level (default LOG_LEVEL).
+
+    Safe to call more than once; later calls only change the level.
+    """
+    global _queue_handler
+    root = logging.getLogger()
+    root.setLevel(level or LOG_LEVEL)
+    if _queue_handler is not None:
+        return
+
+    _queue_handler = _DeferredQueueHandler(queue.SimpleQueue())
+    _queue_handler.addFilter(SamplingFilter(_parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES"))))
+    _start_listener()
+    root.addHandler(_queue_handler)
+    atexit.register(_stop_listener)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+def init_app(app):
+    """Assign every request of a Flask app an id, available to log records and echoed on the response."""
+    @app.before_request
+    def assign_request_id():
+        g.request_id = new_request_id(request.headers.get(REQUEST_ID_HEADER))
+
+    @app.after_request
+    def echo_request_id(response):
+        if 'request_id' in g:
+            response.headers[REQUEST_ID_HEADER] = g.request_id
+        return response
+
+class RequestIdMiddleware:
+    """ASGI middleware assigning request ids.
+
+    Sets request_id_var for the ASGI handlers, forwards the id in the request
+    headers so a mounted WSGI app uses the same one, and echoes it on the
+    response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        header = REQUEST_ID_HEADER.lower().encode()
+        incoming = dict(scope.get("headers") or []).get(header)
+        request_id = new_request_id(incoming.decode("latin-1") if incoming else None)
+        headers = [(name, value) for name, value in scope.get("headers") or [] if name != header]
+        scope = dict(scope, headers=headers + [(header, request_id.encode())])
+        request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            # The mounted Flask app echoes the id itself
+            if message["type"] == "http.response.start" and not any(
+                name.lower() == header for name, _ in message.get("headers") or []
+            ):
+                message = dict(message, headers=list(message.get("headers") or []) + [(header, request_id.encode())])
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
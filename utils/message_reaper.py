@@ -0,0 +1,214 @@
+"""
+Instant history clearing with background deletion.
+
+Clearing a user's history doesn't delete anything in the request. It
+moves the user's ``cleared_through_message_id`` watermark to the user's
+newest finished message, and every history read only returns messages
+above the watermark, so the clear takes effect immediately and costs one
+UPDATE no matter how long the history is. A response still being
+generated stays above the watermark.
+
+The rows below the watermark are deleted by a background reaper thread in
+each worker, in batches of REAPER_BATCH_SIZE with REAPER_BATCH_PAUSE
+seconds between them, so no single statement holds locks or writes WAL for
+long. A worker locks the user it works on with ``FOR UPDATE SKIP LOCKED``,
+so reapers in other workers move on to other users instead of deleting the
+same batch. Rows a generation job may still write to are left until the
+job finishes (see utils.conversation_store). Once nothing is left below the
+watermark the user's ``purged_through_message_id`` catches up with it.
+Progress is reported by ``GET /api/messages/clear/status``.
+
+Settings:
+
+    REAPER_ENABLED         Run the reaper in this process (default true)
+    REAPER_BATCH_SIZE      Rows deleted per batch (default 500)
+    REAPER_BATCH_PAUSE     Seconds between batches (default 0.1)
+    REAPER_IDLE_INTERVAL   Seconds between checks for pending work when idle (default 30)
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import func, or_, not_
+
+REAPER_ENABLED = os.environ.get("REAPER_ENABLED", "true").lower() in ("1", "true", "yes")
+REAPER_BATCH_SIZE = int(os.environ.get("REAPER_BATCH_SIZE", "500"))
+REAPER_BATCH_PAUSE = float(os.environ.get("REAPER_BATCH_PAUSE", "0.1"))
+REAPER_IDLE_INTERVAL = float(os.environ.get("REAPER_IDLE_INTERVAL", "30"))
+
+def cleared_through(user_id):
+    """Return the id of the newest message cleared by a user (0 if never cleared)."""
+    from app import db
+    from models import User
+
+    return db.session.query(User.cleared_through_message_id).filter(User.id == user_id).scalar() or 0
+
+def visible_messages(query, user_id):
+    """Restrict a Message query to the messages written after the user's last clear."""
+    from app import db
+    from models import Message, User
+
+    watermark = db.session.query(User.cleared_through_message_id).filter(User.id == user_id).scalar_subquery()
+    return query.filter(Message.id > func.coalesce(watermark, 0))
+
+def clear_history(user_id):
+    """Logically delete all of a user's messages; the reaper removes the rows later.
+
+    Conversation summaries are few per user and are deleted right away.
+
+    Returns:
+        int: The new watermark
+    """
+    from app import db
+    from models import Message, User, ConversationSummary
+    from utils.conversation_store import generating_clause
+
+    watermark = db.session.query(func.max(Message.id)).filter(
+        Message.user_id == user_id,
+        not_(generating_clause())
+    ).scalar() or 0
+    User.query.filter(
+        User.id == user_id,
+        or_(User.cleared_through_message_id.is_(None), User.cleared_through_message_id < watermark)
+    ).update({'cleared_through_message_id': watermark, 'cleared_at': datetime.utcnow()},
+             synchronize_session=False)
+    ConversationSummary.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    message_reaper.wake()
+    return watermark
+
+def clear_status(user_id):
+    """Return how far the deletion of a user's cleared messages has progressed, or None for unknown users."""
+    from app import db
+    from models import Message, User
+
+    user = db.session.query(
+        User.cleared_at, User.cleared_through_message_id, User.purged_through_message_id
+    ).filter(User.id == user_id).first()
+    if user is None:
+        return None
+    watermark = user.cleared_through_message_id or 0
+    pending = 0
+    if watermark > (user.purged_through_message_id or 0):
+        pending = Message.query.filter(Message.user_id == user_id, Message.id <= watermark).count()
+    return {
+        'cleared_at': user.cleared_at.isoformat() if user.cleared_at else None,
+        'cleared_through_id': watermark,
+        'pending_messages': pending,
+        'complete': pending == 0
+    }
+
+class MessageReaper:
+    """Background thread deleting cleared messages in small batches."""
+
+    def __init__(self):
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.stats = {'batches': 0, 'deleted': 0, 'users_completed': 0, 'errors': 0}
+
+    def init_app(self, app):
+        """Start the reaper with the first request of each worker process."""
+        self._app = app
+
+        @app.before_request
+        def start_message_reaper():
+            self.ensure_started()
+
+    def ensure_started(self):
+        if not REAPER_ENABLED or self._app is None:
+            return
+        # Threads don't survive a fork; each worker starts its own
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="message-reaper")
+            self._thread.start()
+
+    def wake(self):
+        """Look for pending work now instead of at the next idle check."""
+        self._wake.set()
+
+    def get_stats(self):
+        """Return this worker's running totals of batches, deleted rows, completed users and errors."""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _run(self):
+        while True:
+            try:
+                with self._app.app_context():
+                    more = self.reap_batch()
+            except Exception as e:
+                self._count('errors')
+                logging.error(f"Message reaper failed: {str(e)}")
+                more = False
+            if more:
+                time.sleep(REAPER_BATCH_PAUSE)
+            else:
+                self._wake.wait(REAPER_IDLE_INTERVAL)
+                self._wake.clear()
+
+    def reap_batch(self):
+        """Delete one batch of cleared messages; return True if there may be more.
+
+        Must be called inside a Flask application context.
+        """
+        from app import db, is_database_available
+        from models import Message, User
+        from utils.conversation_store import generating_clause
+
+        if not is_database_available():
+            return False
+        try:
+            cleared = db.session.query(Message.id).filter(
+                Message.user_id == User.id,
+                Message.id <= User.cleared_through_message_id
+            )
+            deletable = not_(generating_clause())
+            # Users whose only cleared rows are still being generated have nothing to do yet.
+            # The row lock is held until the commit; other workers' reapers skip this user.
+            user = db.session.query(User.id, User.cleared_through_message_id).filter(
+                User.cleared_through_message_id > func.coalesce(User.purged_through_message_id, 0),
+                or_(cleared.filter(deletable).exists(), not_(cleared.exists()))
+            ).order_by(User.cleared_at).with_for_update(of=User, skip_locked=True).first()
+            if user is None:
+                return False
+
+            ids = [row.id for row in db.session.query(Message.id).filter(
+                Message.user_id == user.id,
+                Message.id <= user.cleared_through_message_id,
+                deletable
+            ).order_by(Message.id).limit(REAPER_BATCH_SIZE)]
+            if ids:
+                Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+                self._count('batches')
+                self._count('deleted', len(ids))
+            else:
+                User.query.filter(User.id == user.id).update(
+                    {'purged_through_message_id': user.cleared_through_message_id}, synchronize_session=False
+                )
+                self._count('users_completed')
+                logging.info(f"Deleted all cleared messages of user ID: {user.id}")
+            db.session.commit()
+            return True
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+message_reaper = MessageReaper()
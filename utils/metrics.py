@@ -0,0 +1,366 @@
+"""
+Prometheus metrics for the chat endpoints and upstream calls.
+
+Exported on ``/metrics`` in the Prometheus text format:
+
+- ``http_request_duration_seconds``: every Flask request, by route and status
+- ``chat_request_duration_seconds``: end-to-end /api/chat latency, including the
+  whole stream for streaming requests
+- ``chat_time_to_first_token_seconds``, ``chat_inter_chunk_gap_seconds`` and
+  ``chat_tokens_per_second``: streaming performance per deployment
+  (``<endpoint>/<deployment>``); each streamed delta counts as one token
+- ``upstream_request_duration_seconds`` and ``upstream_requests_total``: every
+  Azure OpenAI call attempt, by deployment and status (``ok``, ``429``,
+  ``503``, ``connection_error``, ...)
+- ``sse_frame_bytes`` and ``sse_frames_per_second``: size of the streamed SSE
+  frames and frame rate per stream, after coalescing (see utils.sse)
+- ``sse_resumes_total``: interrupted streams resumed through /api/chat/stream,
+  by where the missed frames came from (``buffer`` or ``message``)
+- ``generation_jobs_total``, ``generation_jobs_running`` and
+  ``generation_queue_wait_seconds``: streaming generation jobs by outcome
+  (``done``, ``failed`` or ``cancelled``), jobs in progress and their wait
+  for a free worker (see utils.generation)
+- ``context_budget_requests_total`` and ``context_tokens_saved_total``: chat
+  requests fitted into the model's context budget, by whether history was
+  trimmed, and the history tokens left out (see utils.context_window)
+- ``db_commit_duration_seconds``, ``db_commits_per_request`` and
+  ``db_statements_per_request``; a streaming chat request hands its counts
+  to its generation job, which records them with its own when it ends
+- ``chat_active_streams`` and ``fallback_mode`` (1 while messages are kept in
+  memory because the database is unavailable)
+
+Requires prometheus_client (``pip install .[metrics]``); without it every
+metric is a no-op and ``/metrics`` returns 503. Under gunicorn with several
+workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory so the workers'
+metrics are aggregated; gunicorn.conf.py clears it on startup and removes
+the files of exited workers.
+"""
+import os
+import time
+import logging
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 21, 34, 60)
+GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+RATE_BUCKETS = (5, 10, 20, 30, 40, 60, 80, 120, 160, 240, 320)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COMMIT_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+FRAME_BYTES_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096, 16384)
+FRAME_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+
+class _NoopMetric:
+    """Stands in for every metric when prometheus_client is not installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+def _histogram(name, documentation, labels, buckets):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Histogram(name, documentation, labels, buckets=buckets)
+
+def _counter(name, documentation, labels):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Counter(name, documentation, labels)
+
+def _gauge(name, documentation, multiprocess_mode):
+    if prometheus_client is None:
+        return _NoopMetric()
+    return prometheus_client.Gauge(name, documentation, multiprocess_mode=multiprocess_mode)
+
+HTTP_REQUEST_DURATION = _histogram(
+    "http_request_duration_seconds", "Time to produce an HTTP response (headers, for streams)",
+    ["method", "route", "status"], LATENCY_BUCKETS
+)
+CHAT_REQUEST_DURATION = _histogram(
+    "chat_request_duration_seconds", "End-to-end chat request latency, including the whole stream",
+    ["model", "streaming"], LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = _histogram(
+    "chat_time_to_first_token_seconds", "Time from the upstream call to the first streamed token",
+    ["deployment"], TTFT_BUCKETS
+)
+INTER_CHUNK_GAP = _histogram(
+    "chat_inter_chunk_gap_seconds", "Time between consecutive streamed chunks",
+    ["deployment"], GAP_BUCKETS
+)
+TOKENS_PER_SECOND = _histogram(
+    "chat_tokens_per_second", "Streamed output tokens per second after the first token",
+    ["deployment"], RATE_BUCKETS
+)
+UPSTREAM_REQUEST_DURATION = _histogram(
+    "upstream_request_duration_seconds", "Azure OpenAI call latency (response headers, for streams)",
+    ["deployment", "api"], LATENCY_BUCKETS
+)
+UPSTREAM_REQUESTS = _counter(
+    "upstream_requests_total", "Azure OpenAI call attempts by outcome",
+    ["deployment", "api", "status"]
+)
+SSE_FRAME_BYTES = _histogram(
+    "sse_frame_bytes", "Size of streamed SSE frames", [], FRAME_BYTES_BUCKETS
+)
+SSE_FRAMES_PER_SECOND = _histogram(
+    "sse_frames_per_second", "SSE frames sent per second over a whole stream", [], FRAME_RATE_BUCKETS
+)
+SSE_RESUMES = _counter(
+    "sse_resumes_total", "Streams resumed with Last-Event-ID, by source of the missed frames", ["source"]
+)
+GENERATION_JOBS = _counter(
+    "generation_jobs_total", "Finished generation jobs by status", ["status"]
+)
+GENERATION_QUEUE_WAIT = _histogram(
+    "generation_queue_wait_seconds", "Time generation jobs waited for a free worker", [], GAP_BUCKETS
+)
+CONTEXT_REQUESTS = _counter(
+    "context_budget_requests_total", "Chat requests fitted into a context budget, by whether history was trimmed",
+    ["trimmed"]
+)
+CONTEXT_TOKENS_SAVED = _counter(
+    "context_tokens_saved_total", "History tokens left out of prompts to fit context budgets", []
+)
+DB_COMMIT_DURATION = _histogram(
+    "db_commit_duration_seconds", "Database commit latency", [], DB_BUCKETS
+)
+DB_COMMITS_PER_REQUEST = _histogram(
+    "db_commits_per_request", "Database commits made while serving one request", [], COMMIT_COUNT_BUCKETS
+)
+DB_STATEMENTS_PER_REQUEST = _histogram(
+    "db_statements_per_request", "SQL statements executed while serving one request", [], COMMIT_COUNT_BUCKETS
+)
+ACTIVE_STREAMS = _gauge("chat_active_streams", "Chat responses currently streaming", "livesum")
+GENERATION_JOBS_RUNNING = _gauge("generation_jobs_running", "Generation jobs in progress", "livesum")
+FALLBACK_MODE = _gauge("fallback_mode", "1 while running on in-memory storage", "livemax")
+
+def upstream_status(error):
+    """Return the status label of a failed upstream call."""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return str(status)
+    if type(error).__name__ == "APITimeoutError":
+        return "timeout"
+    if type(error).__name__ == "APIConnectionError":
+        return "connection_error"
+    return "error"
+
+def track_upstream(deployment, api, call):
+    """Return call(), recording its latency and outcome as an upstream call attempt."""
+    started = time.perf_counter()
+    try:
+        result = call()
+    except Exception as e:
+        UPSTREAM_REQUESTS.labels(deployment, api, upstream_status(e)).inc()
+        raise
+    UPSTREAM_REQUEST_DURATION.labels(deployment, api).observe(time.perf_counter() - started)
+    UPSTREAM_REQUESTS.labels(deployment, api, "ok").inc()
+    return result
+
+async def track_upstream_async(deployment, api, call):
+    """Async counterpart of track_upstream(); call returns an awaitable."""
+    started = time.perf_counter()
+    try:
+        result = await call()
+    except Exception as e:
+        UPSTREAM_REQUESTS.labels(deployment, api, upstream_status(e)).inc()
+        raise
+    UPSTREAM_REQUEST_DURATION.labels(deployment, api).observe(time.perf_counter() - started)
+    UPSTREAM_REQUESTS.labels(deployment, api, "ok").inc()
+    return result
+
+class StreamTimer:
+    """Records time to first token, chunk gaps and token rate of one upstream stream."""
+
+    def __init__(self, deployment):
+        self.deployment = deployment
+        self.started = time.perf_counter()
+        self.first_at = None
+        self.last_at = None
+        self.chunks = 0
+
+    def chunk(self):
+        now = time.perf_counter()
+        if self.first_at is None:
+            self.first_at = now
+            TIME_TO_FIRST_TOKEN.labels(self.deployment).observe(now - self.started)
+        else:
+            INTER_CHUNK_GAP.labels(self.deployment).observe(now - self.last_at)
+        self.last_at = now
+        self.chunks += 1
+
+    def finish(self):
+        if self.chunks > 1 and self.last_at > self.first_at:
+            TOKENS_PER_SECOND.labels(self.deployment).observe((self.chunks - 1) / (self.last_at - self.first_at))
+
+def observe_chat(model, started):
+    """Record the latency of a non-streaming chat request started at perf_counter() time started."""
+    CHAT_REQUEST_DURATION.labels(model, "false").observe(time.perf_counter() - started)
+
+def track_stream(events, model, started):
+    """Pass a chat response stream through, counting it as active and timing it to its end.
+
+    Inside stream_with_context() this also records the request's database commits and statements,
+    including those made while streaming.
+    """
+    ACTIVE_STREAMS.inc()
+    try:
+        yield from events
+    finally:
+        ACTIVE_STREAMS.dec()
+        CHAT_REQUEST_DURATION.labels(model, "true").observe(time.perf_counter() - started)
+        observe_request_db()
+
+async def track_stream_async(events, model, started):
+    """Async counterpart of track_stream()."""
+    ACTIVE_STREAMS.inc()
+    try:
+        async for event in events:
+            yield event
+    finally:
+        ACTIVE_STREAMS.dec()
+        CHAT_REQUEST_DURATION.labels(model, "true").observe(time.perf_counter() - started)
+
+def set_fallback_mode(active):
+    FALLBACK_MODE.set(1 if active else 0)
+
+def render():
+    """Return (body, content_type) of the current metrics, or None if prometheus_client is missing."""
+    if prometheus_client is None:
+        return None
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+_sessions_instrumented = False
+
+def instrument_sessions():
+    """Time database commits of every SQLAlchemy session (sync and async) and count statements."""
+    global _sessions_instrumented
+    if _sessions_instrumented:
+        return
+    _sessions_instrumented = True
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+
+    def before_commit(session):
+        session.info['commit_started'] = time.perf_counter()
+
+    def after_commit(session):
+        started = session.info.pop('commit_started', None)
+        if started is not None:
+            DB_COMMIT_DURATION.observe(time.perf_counter() - started)
+        _count_request_commit()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        _count_request_statement()
+
+    event.listen(Session, "before_commit", before_commit)
+    event.listen(Session, "after_commit", after_commit)
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+
+def _count_request_commit():
+    from flask import g, has_app_context
+
+    if has_app_context():
+        g.db_commits = g.get('db_commits', 0) + 1
+
+def _count_request_statement():
+    from flask import g, has_app_context
+
+    if has_app_context():
+        g.db_statements = g.get('db_statements', 0) + 1
+
+def observe_request_db():
+    """Record the database work counted in the current app context as one request."""
+    from flask import g, has_app_context
+
+    if not has_app_context():
+        return
+    if g.pop('db_carried', False):
+        # Recorded by the job the counts were handed to
+        g.pop('db_commits', None)
+        g.pop('db_statements', None)
+        return
+    if 'db_commits' in g:
+        DB_COMMITS_PER_REQUEST.observe(g.pop('db_commits'))
+        DB_STATEMENTS_PER_REQUEST.observe(g.pop('db_statements', 0))
+
+def carry_request_db():
+    """Hand the current request's database counts to work that finishes it in another app context.
+
+    The request no longer records them itself (statements it makes afterwards are left out); the
+    receiving context passes the counts to adopt_request_db() and records the total with
+    observe_request_db().
+
+    Returns:
+        tuple: (commits, statements) so far, or None outside a request
+    """
+    from flask import g, has_request_context
+
+    if not has_request_context() or 'db_commits' not in g:
+        return None
+    g.db_carried = True
+    return g.db_commits, g.get('db_statements', 0)
+
+def adopt_request_db(counts):
+    """Continue counting a request's database work from carry_request_db() in the current app context."""
+    from flask import g
+
+    if counts is not None:
+        g.db_commits, g.db_statements = counts
+
+def instrument_app(app):
+    """Time every request of a Flask app and count its database commits and statements."""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.db_commits = 0
+        g.db_statements = 0
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_DURATION.labels(request.method, route, str(response.status_code)).observe(
+                time.perf_counter() - started
+            )
+        if response.is_streamed:
+            # Streams commit while the body is sent; track_stream() records them at the end
+            g.streaming = True
+        return response
+
+    @app.teardown_request
+    def record_request_db(error=None):
+        if not g.pop('streaming', False):
+            observe_request_db()
+
+    instrument_sessions()
+    if prometheus_client is None:
+        logging.info("prometheus_client not installed; /metrics is disabled")
@@ -1,15 +1,13 @@
 import os
 import logging
 import json
-from openai import AzureOpenAI
+from utils.response_cache import response_cache, make_key
+from utils.single_flight import single_flight, async_single_flight
+from utils.scheduler import scheduler, async_scheduler, estimate_tokens, SchedulerOverloaded
+from utils.endpoint_router import router, is_endpoint_error
+from utils import metrics
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
-# Get environment variables for Azure OpenAI
-AZURE_OPENAI_API_KEY = os.environ.get("AZURE_OPENAI_API_KEY")
-AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "2025-04-01-preview")
+# Get environment variables for Azure OpenAI (endpoints and credentials are read by utils.endpoint_router)
 AZURE_OPENAI_DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")
 
 # Models that support reasoning summary capability - currently only o3 and o4-mini
@@ -17,40 +15,102 @@ MODELS_WITH_REASONING_SUMMARY = ["o3", "o4-mini"]
 
 # Available Azure OpenAI deployment models - this would typically come from an API,
 # but we're hardcoding for demonstration. In production, you'd fetch from Azure.
+# context_budget is the number of prompt tokens (history + new turn) sent per request.
 AVAILABLE_MODELS = [
-    {"id": "gpt-4o", "name": "Azure GPT-4o", "description": "Latest and most capable Azure OpenAI model with vision support"},
-    {"id": "gpt-4.1", "name": "Azure GPT-4.1", "description": "Azure OpenAI model with advanced capabilities and strong reasoning"},
-    {"id": "gpt-4.1-mini", "name": "Azure GPT-4.1-mini", "description": "More efficient version of Azure GPT-4.1"},
-    {"id": "o4-mini", "name": "Azure O4-mini", "description": "Azure OpenAI o-series model with reasoning summary capabilities"},
-    {"id": "o3", "name": "Azure O3", "description": "Azure OpenAI model with advanced reasoning and generation capabilities"},
-    {"id": "o3-mini", "name": "Azure O3-mini", "description": "More efficient version of Azure O3"},
-    {"id": "o1", "name": "Azure O1", "description": "Fast and efficient Azure OpenAI model for scientific reasoning"},
-    {"id": "o1-mini", "name": "Azure O1-mini", "description": "More efficient version of Azure O1 for faster reasoning tasks"}
+    {"id": "gpt-4o", "name": "Azure GPT-4o", "description": "Latest and most capable Azure OpenAI model with vision support", "context_budget": 32000},
+    {"id": "gpt-4.1", "name": "Azure GPT-4.1", "description": "Azure OpenAI model with advanced capabilities and strong reasoning", "context_budget": 64000},
+    {"id": "gpt-4.1-mini", "name": "Azure GPT-4.1-mini", "description": "More efficient version of Azure GPT-4.1", "context_budget": 32000},
+    {"id": "o4-mini", "name": "Azure O4-mini", "description": "Azure OpenAI o-series model with reasoning summary capabilities", "context_budget": 32000},
+    {"id": "o3", "name": "Azure O3", "description": "Azure OpenAI model with advanced reasoning and generation capabilities", "context_budget": 64000},
+    {"id": "o3-mini", "name": "Azure O3-mini", "description": "More efficient version of Azure O3", "context_budget": 32000},
+    {"id": "o1", "name": "Azure O1", "description": "Fast and efficient Azure OpenAI model for scientific reasoning", "context_budget": 32000},
+    {"id": "o1-mini", "name": "Azure O1-mini", "description": "More efficient version of Azure O1 for faster reasoning tasks", "context_budget": 16000}
 ]
 
+DEFAULT_CONTEXT_BUDGET = 16000
+
+# Reasoning effort used when streaming a reasoning model without an explicit effort
+DEFAULT_REASONING_EFFORT = "medium"
+
+# Event types yielded by stream_ai_response()
+TEXT_EVENT = "text"
+REASONING_SUMMARY_EVENT = "reasoning_summary"
+# Internal event carrying the upstream (response_id, endpoint_name); not passed on to callers
+RESPONSE_ID_EVENT = "response_id"
+# Size of the text chunks a cached response is replayed in
+REPLAY_CHUNK_SIZE = 256
+
 def get_available_models():
     """Return the list of available models."""
     return AVAILABLE_MODELS
 
-def get_openai_client():
-    """Create and return an Azure OpenAI client."""
+def get_context_budget(deployment_name):
+    """Return the prompt token budget for a deployment from the model catalog."""
+    deployment_name = (deployment_name or AZURE_OPENAI_DEPLOYMENT_NAME).lower()
+    for model in AVAILABLE_MODELS:
+        if model["id"] == deployment_name:
+            return model["context_budget"]
+    # Custom deployment names usually embed the model id; prefer the longest match
+    matches = [model for model in AVAILABLE_MODELS if model["id"] in deployment_name]
+    if matches:
+        return max(matches, key=lambda model: len(model["id"]))["context_budget"]
+    return DEFAULT_CONTEXT_BUDGET
+
+def create_chat_completion(request, priority=None):
+    """Send a Chat Completions request to the healthiest endpoint serving its model.
+    
+    request["model"] is the model id; it is replaced with the endpoint's deployment name.
+    
+    Returns:
+        ChatCompletion: The SDK response
+    """
+    return _routed_call(request, priority, lambda client: client.chat.completions.create)[0]
+
+def _routed_call(request, priority, method, api="chat", chain=None):
+    """Make an upstream call through endpoint routing and the deployment's scheduler.
+    
+    method picks the SDK method off a client, e.g. lambda client: client.responses.create.
+    chain is the _ResponseChain of a request continuing a stored response.
+    
+    Returns:
+        tuple: (response, endpoint_name) where endpoint_name names the endpoint that served the call
+    """
+    def send(route, request):
+        routed = dict(request, model=route.deployment)
+        return scheduler.call(route.scheduler_key, estimate_tokens(routed), priority,
+                              lambda: metrics.track_upstream(route.scheduler_key, api, lambda: method(route.client)(**routed)),
+                              route.max_retries)
+    
+    def attempt(route):
+        if chain is None:
+            return send(route, request), route.endpoint.name
+        return chain.call(route, lambda chained: send(route, chained)), route.endpoint.name
+    return router.call(request["model"], attempt, prefer=chain.endpoint_name if chain else None)
+
+async def _async_routed_call(request, priority, method, api="chat", chain=None):
+    """Async counterpart of _routed_call()."""
+    def send(route, request):
+        routed = dict(request, model=route.deployment)
+        return async_scheduler.call(route.scheduler_key, estimate_tokens(routed), priority,
+                                    lambda: metrics.track_upstream_async(route.scheduler_key, api,
+                                                                         lambda: method(route.client)(**routed)),
+                                    route.max_retries)
+    
+    async def attempt(route):
+        if chain is None:
+            return await send(route, request), route.endpoint.name
+        return await chain.call_async(route, lambda chained: send(route, chained)), route.endpoint.name
+    return await router.call_async(request["model"], attempt, prefer=chain.endpoint_name if chain else None)
+
+def _load_image(image_ref):
+    """Return a stored image as base64, or None if it is missing."""
+    from utils.blob_store import get_blob_store
+    
     try:
-        if not AZURE_OPENAI_API_KEY or not AZURE_OPENAI_ENDPOINT:
-            logging.error("Azure OpenAI API key or endpoint is missing")
-            raise ValueError("Azure OpenAI API key or endpoint is missing")
-            
-        client = AzureOpenAI(
-            api_key=AZURE_OPENAI_API_KEY,
-            api_version=AZURE_OPENAI_API_VERSION,
-            azure_endpoint=AZURE_OPENAI_ENDPOINT
-        )
-        # Log successful client creation
-        logging.info(f"Successfully created Azure OpenAI client with endpoint: {AZURE_OPENAI_ENDPOINT}")
-        logging.info(f"Using API version: {AZURE_OPENAI_API_VERSION}")
-        return client
-    except Exception as e:
-        logging.error(f"Error creating OpenAI client: {str(e)}")
-        raise
+        return get_blob_store().read_base64(image_ref)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not load image {image_ref} for history: {str(e)}")
+        return None
 
 def format_conversation_history(conversation_history):
     """Format the conversation history for the OpenAI API."""
@@ -58,8 +118,13 @@ def format_conversation_history(conversation_history):
     
     for message in conversation_history:
         if message['role'] == 'user':
+            image = message.get('image')
+            if not image and message.get('image_ref'):
+                # Images in the blob store are loaded only when they are sent
+                image = _load_image(message['image_ref'])
+            
             # Check if message has image attached
-            if 'image' in message and message['image']:
+            if image:
                 # Format as a message with image content
                 formatted_messages.append({
                     "role": "user",
@@ -68,7 +133,7 @@ def format_conversation_history(conversation_history):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{message['image']}"
+                                "url": f"data:image/jpeg;base64,{image}"
                             }
                         }
                     ]
@@ -93,9 +158,257 @@ def format_conversation_history(conversation_history):
     
     return formatted_messages
 
-def generate_ai_response(message, conversation_history=None, image_data=None, reasoning_effort=None, developer_message=None, model=None):
+def _uses_responses_api(deployment_name, reasoning_effort):
+    """Return True if the request should go to the Responses API."""
+    # Check if model supports reasoning summary
+    is_reasoning_model = any(model_name in deployment_name.lower() for model_name in MODELS_WITH_REASONING_SUMMARY)
+    return bool(is_reasoning_model and reasoning_effort)
+
+def _build_responses_request(message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+                             previous_response_id=None):
+    """Build the keyword arguments for a Responses API call.
+    
+    When previous_response_id is given, the earlier turns are already stored
+    upstream, so only the new turn is sent and the history is chained.
+    """
+    # Set up reasoning parameters
+    reasoning_params = {
+        "effort": reasoning_effort,
+        "summary": "detailed"  # Can be "auto", "concise", or "detailed"
+    }
+    
+    if previous_response_id:
+        user_content = message
+        if image_data:
+            user_content = [
+                {"type": "input_text", "text": message},
+                {"type": "input_image", "image_url": f"data:image/jpeg;base64,{image_data}"}
+            ]
+        input_content = [{"role": "user", "content": user_content}]
+        if developer_message:
+            input_content.insert(0, {"role": "developer", "content": developer_message})
+        return {
+            "model": deployment_name,
+            "input": input_content,
+            "reasoning": reasoning_params,
+            "previous_response_id": previous_response_id
+        }
+    
+    # Prepare the input for the Responses API
+    if developer_message:
+        input_content = [
+            {"role": "developer", "content": developer_message},
+            {"role": "user", "content": message}
+        ]
+    else:
+        # If image provided, use multimodal content
+        if image_data:
+            input_content = {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": message},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_data}"
+                        }
+                    }
+                ]
+            }
+        else:
+            input_content = message
+    
+    # Add formatted history if we have it
+    if formatted_history:
+        input_content = formatted_history + [{"role": "user", "content": message}]
+    
+    return {
+        "model": deployment_name,
+        "input": input_content,
+        "reasoning": reasoning_params
+    }
+
+def _is_missing_response(error):
+    """Return True if an upstream error says the previous response of a chained request is gone."""
+    return getattr(error, "status_code", None) == 404
+
+class _ResponseChain:
+    """A Responses API request chained to a stored response, with its full-history fallback.
+
+    Stored responses only exist on the endpoint that created them, so the chained
+    request goes to that endpoint alone and other endpoints get the full history.
+    If the endpoint no longer has the response (404), the full history is resent
+    there without counting the 404 against the endpoint's health. An unknown
+    endpoint_name (turns stored before endpoints were recorded) allows any endpoint.
+    """
+
+    def __init__(self, chained_request, full_request, endpoint_name=None):
+        self.chained_request = chained_request
+        self.full_request = full_request
+        self.endpoint_name = endpoint_name
+
+    def requests_for(self, route):
+        """Return the requests to try on a route, in order."""
+        if self.endpoint_name in (None, route.endpoint.name):
+            return [self.chained_request, self.full_request]
+        return [self.full_request]
+
+    def missing(self, route, error):
+        """Log a chained request whose previous response is gone; return False if error is anything else."""
+        if not _is_missing_response(error):
+            return False
+        logging.warning(f"Previous response not found on endpoint {route.endpoint.name} ({str(error)}); "
+                        f"resending the full history")
+        return True
+
+    def call(self, route, send):
+        """Return send(request) for the first of the route's requests that finds its previous response."""
+        *chained, full = self.requests_for(route)
+        for request in chained:
+            try:
+                return send(request)
+            except Exception as e:
+                if not self.missing(route, e):
+                    raise
+        return send(full)
+
+    async def call_async(self, route, send):
+        """Async counterpart of call(); send(request) returns an awaitable."""
+        *chained, full = self.requests_for(route)
+        for request in chained:
+            try:
+                return await send(request)
+            except Exception as e:
+                if not self.missing(route, e):
+                    raise
+        return await send(full)
+
+def _build_chain(request, message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+                 previous_response_endpoint):
+    """Return the _ResponseChain of a Responses API request, or None if it isn't chained."""
+    if not request.get("previous_response_id"):
+        return None
+    full_request = _build_responses_request(
+        message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name
+    )
+    return _ResponseChain(request, full_request, previous_response_endpoint)
+
+def _parse_responses_output(response):
+    """Extract (response_text, reasoning_summary) from a Responses API result."""
+    response_text = ""
+    if hasattr(response, "output") and response.output:
+        for output in response.output:
+            if hasattr(output, "role") and output.role == "assistant":
+                for content in output.content:
+                    if content.type == "text":
+                        response_text = content.text
+                        break
+    
+    # Extract reasoning summary if available
+    reasoning_summary = None
+    if hasattr(response, "reasoning") and response.reasoning:
+        reasoning_summary = response.reasoning
+    
+    # If we couldn't get the text response from the expected structure,
+    # try fallback approaches
+    if not response_text and hasattr(response, "output_text"):
+        response_text = response.output_text
+    
+    return response_text, reasoning_summary
+
+def _build_chat_request(message, formatted_history, image_data, developer_message, deployment_name, stream=False):
+    """Build the keyword arguments for a Chat Completions API call."""
+    messages = list(formatted_history)
+    
+    # Handle image if provided
+    if image_data:
+        # Create a message with both text and image
+        user_message = {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": message},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{image_data}"
+                    }
+                }
+            ]
+        }
+        messages.append(user_message)
+    else:
+        # Add developer message if provided
+        if developer_message:
+            messages.insert(0, {
+                "role": "system",
+                "content": developer_message
+            })
+        
+        # Add current user message
+        messages.append({
+            "role": "user",
+            "content": message
+        })
+    
+    request = {
+        "model": deployment_name,
+        "messages": messages
+    }
+    if stream:
+        request["stream"] = True
+    
+    # For o-series models, use max_completion_tokens instead of max_tokens
+    if "o" in deployment_name.lower():
+        request["max_completion_tokens"] = 800  # o-series models use this parameter
+    else:
+        # Standard parameters for GPT models
+        request.update({
+            "temperature": 0.7,
+            "presence_penalty": 0.1,
+            "frequency_penalty": 0.1,
+            "max_tokens": 800
+        })
+    
+    return request
+
+def _parse_chat_output(response):
+    """Extract the response text from a Chat Completions result."""
+    response_text = ""
+    if response.choices and len(response.choices) > 0:
+        response_text = response.choices[0].message.content
+    
+    # If we can't parse the response properly, return a default message
+    if not response_text:
+        response_text = "I'm sorry, I couldn't generate a proper response. Please try again."
+    
+    return response_text
+
+def _call_responses_api(request, cache_key=None, priority=None, chain=None):
+    """Make a Responses API call; return (response_text, reasoning_summary, response_id, endpoint_name)."""
+    response, endpoint_name = _routed_call(request, priority, lambda client: client.responses.create, "responses", chain)
+    response_text, reasoning_summary = _parse_responses_output(response)
+    if cache_key:
+        response_cache.set(cache_key, response_text, reasoning_summary)
+    return response_text, reasoning_summary, getattr(response, "id", None), endpoint_name
+
+def _call_chat_api(request, cache_key=None, priority=None):
+    """Make a Chat Completions call; return the response text."""
+    response = create_chat_completion(request, priority)
+    response_text = _parse_chat_output(response)
+    # Don't cache the placeholder returned for an empty completion
+    if cache_key and response.choices and response.choices[0].message.content:
+        response_cache.set(cache_key, response_text)
+    return response_text
+
+def generate_ai_response(message, conversation_history=None, image_data=None, reasoning_effort=None, developer_message=None, model=None,
+                         previous_response_id=None, response_meta=None, use_cache=True, priority=None,
+                         previous_response_endpoint=None):
     """Generate an AI response using Azure OpenAI Chat Completions API or Responses API.
     
+    Identical concurrent requests share one upstream call (see utils.single_flight).
+    Upstream calls go to the healthiest endpoint serving the model (see utils.endpoint_router)
+    and are admitted by the deployment's scheduler (see utils.scheduler).
+    
     Args:
         message (str): The user's message
         conversation_history (list, optional): Previous conversation history
@@ -103,176 +416,106 @@ def generate_ai_response(message, conversation_history=None, image_data=None, re
         reasoning_effort (str, optional): Reasoning effort level (low, medium, high)
         developer_message (str, optional): Developer message to include (like system message)
         model (str, optional): The deployment model ID to use, defaults to AZURE_OPENAI_DEPLOYMENT_NAME
+        previous_response_id (str, optional): Responses API id of the previous turn, used to chain
+            the conversation instead of resending the history
+        response_meta (dict, optional): Receives metadata about the upstream response ('response_id',
+            'response_endpoint', 'cached')
+        use_cache (bool, optional): Set to False to bypass the response cache (and request
+            coalescing) for this request
+        priority (str, optional): Scheduling class, 'interactive' (default) or 'batch'
+        previous_response_endpoint (str, optional): Endpoint that stored previous_response_id; the
+            chained request only goes there (see _ResponseChain)
     
     Returns:
         tuple: (response_text, reasoning_summary) where reasoning_summary is None if not supported
+    
+    Raises:
+        SchedulerOverloaded: If the deployment could not admit the request in time
     """
     if conversation_history is None:
         conversation_history = []
     
     # Use specified model or the default
     deployment_name = model if model else AZURE_OPENAI_DEPLOYMENT_NAME
+    caching = response_cache.active(use_cache)
     
     try:
-        client = get_openai_client()
-        
         # Format conversation history for the API
         formatted_history = format_conversation_history(conversation_history)
         
-        # Check if model supports reasoning summary
-        is_reasoning_model = any(model_name in deployment_name.lower() for model_name in MODELS_WITH_REASONING_SUMMARY)
-        
         # Use the Responses API for models that support reasoning summary
-        if is_reasoning_model and reasoning_effort:
+        if _uses_responses_api(deployment_name, reasoning_effort):
             logging.info(f"Using Responses API for model {deployment_name} with reasoning effort {reasoning_effort}")
             
-            # Prepare the input for the Responses API
-            if developer_message:
-                input_content = [
-                    {"role": "developer", "content": developer_message},
-                    {"role": "user", "content": message}
-                ]
-            else:
-                # If image provided, use multimodal content
-                if image_data:
-                    input_content = {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": message},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_data}"
-                                }
-                            }
-                        ]
-                    }
-                else:
-                    input_content = message
-            
-            # Add formatted history if we have it
-            if formatted_history:
-                input_content = formatted_history + [{"role": "user", "content": message}]
-            
-            # Set up reasoning parameters
-            reasoning_params = {
-                "effort": reasoning_effort,
-                "summary": "detailed"  # Can be "auto", "concise", or "detailed"
-            }
+            request = _build_responses_request(
+                message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+                previous_response_id
+            )
+            chain = _build_chain(request, message, formatted_history, image_data, reasoning_effort, developer_message,
+                                 deployment_name, previous_response_endpoint)
+            request_key = make_key("responses", request)
+            cache_key = request_key if caching else None
+            cached = _get_cached(cache_key, response_meta)
+            if cached:
+                return cached
             
             # Make the API call to the Responses API
             try:
-                response = client.responses.create(
-                    model=deployment_name,
-                    input=input_content,
-                    reasoning=reasoning_params
+                response_text, reasoning_summary, response_id, endpoint_name = _coalesce(
+                    request_key, use_cache, lambda: _call_responses_api(request, cache_key, priority, chain)
                 )
-                
-                # Extract the response text and reasoning summary
-                response_text = ""
-                if hasattr(response, "output") and response.output:
-                    for output in response.output:
-                        if hasattr(output, "role") and output.role == "assistant":
-                            for content in output.content:
-                                if content.type == "text":
-                                    response_text = content.text
-                                    break
-                
-                # Extract reasoning summary if available
-                reasoning_summary = None
-                if hasattr(response, "reasoning") and response.reasoning:
-                    reasoning_summary = response.reasoning
-                
-                # If we couldn't get the text response from the expected structure,
-                # try fallback approaches
-                if not response_text and hasattr(response, "output_text"):
-                    response_text = response.output_text
-                
+                if response_meta is not None:
+                    response_meta['response_id'] = response_id
+                    response_meta['response_endpoint'] = endpoint_name
                 return response_text, reasoning_summary
                 
+            except SchedulerOverloaded:
+                raise
             except Exception as e:
                 logging.error(f"Error using Responses API, falling back to Chat Completions: {str(e)}")
                 # Fall back to the Chat Completions API if the Responses API fails
                 # This will be handled by the chat completions code below
         
         # Default to Chat Completions API for models without reasoning summary or if Responses API failed
-        # Handle image if provided
-        if image_data:
-            # Create a message with both text and image
-            user_message = {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": message},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_data}"
-                        }
-                    }
-                ]
-            }
-            formatted_history.append(user_message)
-        else:
-            # Add developer message if provided
-            if developer_message:
-                formatted_history.insert(0, {
-                    "role": "system",
-                    "content": developer_message
-                })
-            
-            # Add current user message
-            formatted_history.append({
-                "role": "user",
-                "content": message
-            })
+        request = _build_chat_request(message, formatted_history, image_data, developer_message, deployment_name)
+        request_key = make_key("chat", request)
+        cache_key = request_key if caching else None
+        cached = _get_cached(cache_key, response_meta)
+        if cached:
+            return cached
         
         # Log the request
         logging.debug(f"Sending request to Azure OpenAI Chat Completions using model {deployment_name}")
         
-        # For o-series models, use max_completion_tokens instead of max_tokens
-        # Only include these parameters for o-series models
-        if "o" in deployment_name.lower():
-            # Make the API call with o-series parameters
-            response = client.chat.completions.create(
-                model=deployment_name,
-                messages=formatted_history,
-                max_completion_tokens=800  # o-series models use this parameter
-            )
-            if reasoning_effort:
-                # If we're here with a reasoning effort but not using Responses API,
-                # log that reasoning summary is not available
-                logging.info(f"Using reasoning_effort={reasoning_effort} without Responses API - summary not available")
-        else:
-            # Standard parameters for GPT models
-            response = client.chat.completions.create(
-                model=deployment_name,
-                messages=formatted_history,
-                temperature=0.7,
-                presence_penalty=0.1,
-                frequency_penalty=0.1,
-                max_tokens=800
-            )
-        
-        # Extract the response text
-        response_text = ""
-        if response.choices and len(response.choices) > 0:
-            response_text = response.choices[0].message.content
+        response_text = _coalesce(request_key, use_cache, lambda: _call_chat_api(request, cache_key, priority))
+        if reasoning_effort and "o" in deployment_name.lower():
+            # If we're here with a reasoning effort but not using Responses API,
+            # log that reasoning summary is not available
+            logging.info(f"Using reasoning_effort={reasoning_effort} without Responses API - summary not available")
         
         # No reasoning summary in Chat Completions API
-        reasoning_summary = None
-        
-        # If we can't parse the response properly, return a default message
-        if not response_text:
-            response_text = "I'm sorry, I couldn't generate a proper response. Please try again."
-        
-        return response_text, reasoning_summary
+        return response_text, None
     
+    except SchedulerOverloaded:
+        raise
     except Exception as e:
         logging.error(f"Error generating AI response: {str(e)}")
         return f"Sorry, there was an error communicating with the AI service: {str(e)}", None
+
+def _coalesce(request_key, use_cache, call):
+    """Run an upstream call, sharing it with identical calls in flight unless coalescing is bypassed."""
+    if not use_cache:
+        return call()
+    return single_flight.do("call:" + request_key, call)
         
-def stream_ai_response(message, conversation_history=None, image_data=None, reasoning_effort=None, developer_message=None, model=None):
-    """Stream an AI response using Azure OpenAI Chat Completions API.
+def stream_ai_response(message, conversation_history=None, image_data=None, reasoning_effort=None, developer_message=None, model=None,
+                       previous_response_id=None, response_meta=None, use_cache=True, priority=None,
+                       previous_response_endpoint=None):
+    """Stream an AI response using the Responses API (reasoning models) or Chat Completions API.
+    
+    Identical concurrent streams share one upstream stream (see utils.single_flight).
+    Upstream calls go to the healthiest endpoint serving the model (see utils.endpoint_router)
+    and are admitted by the deployment's scheduler (see utils.scheduler).
     
     Args:
         message (str): The user's message
@@ -281,9 +524,20 @@ def stream_ai_response(message, conversation_history=None, image_data=None, reas
         reasoning_effort (str, optional): Reasoning effort level (low, medium, high)
         developer_message (str, optional): Developer message to include (like system message)
         model (str, optional): The deployment model ID to use, defaults to AZURE_OPENAI_DEPLOYMENT_NAME
+        previous_response_id (str, optional): Responses API id of the previous turn
+        response_meta (dict, optional): Receives metadata about the upstream response ('response_id',
+            'response_endpoint', 'cached')
+        use_cache (bool, optional): Set to False to bypass the response cache (and request
+            coalescing) for this request
+        priority (str, optional): Scheduling class, 'interactive' (default) or 'batch'
+        previous_response_endpoint (str, optional): Endpoint that stored previous_response_id
         
     Returns:
-        generator: A generator that yields chunks of the AI response as they become available
+        generator: Yields (event_type, delta) tuples as they arrive, where event_type is
+        TEXT_EVENT for response text or REASONING_SUMMARY_EVENT for reasoning summary text
+    
+    Raises:
+        SchedulerOverloaded: If the deployment could not admit the request in time
     """
     if conversation_history is None:
         conversation_history = []
@@ -291,109 +545,392 @@ def stream_ai_response(message, conversation_history=None, image_data=None, reas
     # Use specified model or the default
     deployment_name = model if model else AZURE_OPENAI_DEPLOYMENT_NAME
     
-    # Check if this is a model that doesn't support streaming
-    if "o3" in deployment_name.lower():
-        logging.warning(f"Model {deployment_name} does not support streaming. Using non-streaming API instead.")
-        # For o3 model, we'll use the non-streaming API and simulate streaming
-        try:
-            response_text, reasoning_summary = generate_ai_response(
-                message, 
-                conversation_history,
-                image_data,
-                reasoning_effort,
-                developer_message,
-                model
-            )
-            
-            # Simulate streaming by chunking the response
-            chunk_size = 10
-            for i in range(0, len(response_text), chunk_size):
-                yield response_text[i:i+chunk_size]
-                
-            # If we have a reasoning summary, add it as a special message at the end
-            if reasoning_summary:
-                yield f"\n\n<reasoning-summary>{reasoning_summary}</reasoning-summary>"
-                
-            return
-        except Exception as e:
-            logging.error(f"Error getting non-streaming response for o3 model: {str(e)}")
-            yield f"Sorry, there was an error communicating with the AI service: {str(e)}"
-            return
-    
     try:
-        client = get_openai_client()
-        
         # Format conversation history for the API
         formatted_history = format_conversation_history(conversation_history)
+        responses_request, chat_request, request_key, chain = _build_stream_requests(
+            message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+            previous_response_id, previous_response_endpoint
+        )
         
-        # Prepare the message content
-        message_content = message
+        # Replay a cached response as a stream
+        cache_key = request_key if response_cache.active(use_cache) else None
+        cached = _get_cached(cache_key, response_meta)
+        if cached:
+            yield from _replay_stream(*cached)
+            return
         
-        # Handle image if provided
-        if image_data:
-            # Create a message with both text and image
-            user_message = {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": message},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_data}"
-                        }
-                    }
-                ]
-            }
-            formatted_history.append(user_message)
-        else:
-            # Add developer message if provided
-            if developer_message:
-                formatted_history.insert(0, {
-                    "role": "system",
-                    "content": developer_message
-                })
-            
-            # Add current user message
-            formatted_history.append({
-                "role": "user",
-                "content": message_content
-            })
+        def start():
+            return router.stream(deployment_name, lambda route: _stream_upstream(
+                route, responses_request, chat_request, cache_key, priority, chain
+            ), prefer=chain.endpoint_name if chain else None)
         
-        # Log the streaming request
-        logging.debug(f"Sending streaming request to Azure OpenAI using model {deployment_name}")
+        events = single_flight.stream("stream:" + request_key, start) if use_cache else start()
+        try:
+            for event_type, delta in events:
+                if event_type == RESPONSE_ID_EVENT:
+                    if response_meta is not None:
+                        response_meta['response_id'], response_meta['response_endpoint'] = delta
+                    continue
+                yield event_type, delta
+        finally:
+            # A cancelled generation closes this generator; pass that on to the upstream stream
+            events.close()
+                
+    except SchedulerOverloaded:
+        raise
+    except Exception as e:
+        logging.error(f"Error streaming AI response: {str(e)}")
+        yield TEXT_EVENT, f"Sorry, there was an error communicating with the AI service: {str(e)}"
+
+def _build_stream_requests(message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+                           previous_response_id, previous_response_endpoint=None):
+    """Build the upstream requests of a streaming call.
+    
+    Returns:
+        tuple: (responses_request, chat_request, request_key, chain) where responses_request is None
+        unless the Responses API is tried first, request_key identifies the request and chain is
+        the _ResponseChain of a chained responses_request
+    """
+    responses_request = None
+    chain = None
+    if _streams_responses_api(deployment_name, reasoning_effort):
+        reasoning_effort = reasoning_effort or DEFAULT_REASONING_EFFORT
+        responses_request = _build_responses_request(
+            message, formatted_history, image_data, reasoning_effort,
+            developer_message, deployment_name, previous_response_id
+        )
+        chain = _build_chain(responses_request, message, formatted_history, image_data, reasoning_effort, developer_message,
+                             deployment_name, previous_response_endpoint)
+    chat_request = _build_chat_request(message, formatted_history, image_data, developer_message, deployment_name, stream=True)
+    if responses_request is not None:
+        return responses_request, chat_request, make_key("responses", responses_request), chain
+    return None, chat_request, make_key("chat", chat_request), None
+
+def _stream_upstream(route, responses_request, chat_request, cache_key=None, priority=None, chain=None):
+    """Yield (event_type, delta) events from one endpoint, ending with RESPONSE_ID_EVENT.
+    
+    Tries the Responses API first when responses_request is given, falling back to
+    Chat Completions if it fails before producing output. A chained responses_request
+    is sent as chain picks for the endpoint (see _ResponseChain). The complete response
+    is stored under cache_key when the stream ends.
+    
+    The response id is held back until the stream completes, so the first event is
+    the first text or reasoning delta: endpoint_router measures time to first token
+    and stops failing over from there, not from response.created.
+    """
+    parts = {TEXT_EVENT: [], REASONING_SUMMARY_EVENT: []}
+    timer = metrics.StreamTimer(route.scheduler_key)
+    if responses_request is not None:
+        logging.info(f"Streaming from Responses API for deployment {route.scheduler_key}")
+        requests = chain.requests_for(route) if chain else [responses_request]
+        for i, request in enumerate(requests):
+            request = dict(request, model=route.deployment)
+            started = False
+            response_id = None
+            try:
+                events = scheduler.stream(route.scheduler_key, estimate_tokens(request), priority,
+                                          lambda: metrics.track_upstream(
+                                              route.scheduler_key, "responses",
+                                              lambda: route.client.responses.create(**request, stream=True)
+                                          ),
+                                          route.max_retries)
+                for event in events:
+                    parsed = _parse_responses_event(event)
+                    if parsed is None:
+                        continue
+                    if parsed[0] == RESPONSE_ID_EVENT:
+                        response_id = parsed[1] or response_id
+                        continue
+                    if parsed[0] in parts:
+                        started = True
+                        parts[parsed[0]].append(parsed[1])
+                        timer.chunk()
+                    yield parsed
+                timer.finish()
+                _store_stream(cache_key, parts)
+                if response_id:
+                    yield RESPONSE_ID_EVENT, (response_id, route.endpoint.name)
+                return
+            except Exception as e:
+                if not started and i < len(requests) - 1 and chain.missing(route, e):
+                    continue
+                if started or _should_fail_over(route, e):
+                    raise
+                # Nothing was sent yet, so fall back to streaming Chat Completions
+                logging.error(f"Error streaming from Responses API, falling back to Chat Completions: {str(e)}")
+                break
+    
+    # Log the streaming request
+    logging.debug(f"Sending streaming request to Azure OpenAI using deployment {route.scheduler_key}")
+    
+    chat_request = dict(chat_request, model=route.deployment)
+    response = scheduler.stream(route.scheduler_key, estimate_tokens(chat_request), priority,
+                                lambda: metrics.track_upstream(
+                                    route.scheduler_key, "chat", lambda: route.client.chat.completions.create(**chat_request)
+                                ),
+                                route.max_retries)
+    for chunk in response:
+        if chunk.choices and len(chunk.choices) > 0:
+            content = chunk.choices[0].delta.content
+            if content is not None:
+                parts[TEXT_EVENT].append(content)
+                timer.chunk()
+                yield TEXT_EVENT, content
+    
+    # Chat Completions streams carry no reasoning summary
+    timer.finish()
+    _store_stream(cache_key, parts)
+
+def _should_fail_over(route, error):
+    """Return True if a failed Responses stream should move to another endpoint instead of
+    falling back to Chat Completions on the same one."""
+    return isinstance(error, SchedulerOverloaded) or (is_endpoint_error(error) and not route.is_last)
+
+def _store_stream(cache_key, parts):
+    """Cache a completely streamed response."""
+    if cache_key:
+        response_cache.set(cache_key, "".join(parts[TEXT_EVENT]), "".join(parts[REASONING_SUMMARY_EVENT]) or None)
+
+def _streams_responses_api(deployment_name, reasoning_effort):
+    """Return True if a streaming request should go to the Responses API.
+    
+    o3 deployments always do: their reasoning summary is only available there.
+    """
+    return _uses_responses_api(deployment_name, reasoning_effort) or "o3" in deployment_name.lower()
+
+def _parse_responses_event(event):
+    """Map a Responses API stream event to an (event_type, delta) tuple, or None for events without content."""
+    event_type = getattr(event, "type", None)
+    if event_type == "response.output_text.delta":
+        return TEXT_EVENT, event.delta
+    if event_type == "response.reasoning_summary_text.delta":
+        return REASONING_SUMMARY_EVENT, event.delta
+    if event_type == "response.reasoning_summary_part.added" and getattr(event, "summary_index", 0) > 0:
+        # Separate the paragraphs of a multi-part summary
+        return REASONING_SUMMARY_EVENT, "\n\n"
+    if event_type in ("response.created", "response.completed"):
+        return RESPONSE_ID_EVENT, getattr(event.response, "id", None)
+    if event_type == "response.failed":
+        error = getattr(event.response, "error", None)
+        raise RuntimeError(getattr(error, "message", None) or "Response failed")
+    if event_type == "error":
+        raise RuntimeError(getattr(event, "message", None) or "Response stream error")
+    return None
+
+def _get_cached(cache_key, response_meta):
+    """Return a cached (response_text, reasoning_summary) for a cache key, or None."""
+    if not cache_key:
+        return None
+    cached = response_cache.get(cache_key)
+    if cached:
+        logging.debug(f"Serving response from cache (key {cache_key[:12]})")
+        if response_meta is not None:
+            response_meta['cached'] = True
+    return cached
+
+def _replay_stream(response_text, reasoning_summary):
+    """Replay a finished (cached) response as stream events."""
+    if reasoning_summary:
+        yield REASONING_SUMMARY_EVENT, reasoning_summary
+    for i in range(0, len(response_text), REPLAY_CHUNK_SIZE):
+        yield TEXT_EVENT, response_text[i:i + REPLAY_CHUNK_SIZE]
+
+async def _async_call_responses_api(request, cache_key=None, priority=None, chain=None):
+    """Async counterpart of _call_responses_api()."""
+    response, endpoint_name = await _async_routed_call(request, priority, lambda client: client.responses.create, "responses",
+                                                       chain)
+    response_text, reasoning_summary = _parse_responses_output(response)
+    if cache_key:
+        response_cache.set(cache_key, response_text, reasoning_summary)
+    return response_text, reasoning_summary, getattr(response, "id", None), endpoint_name
+
+async def _async_call_chat_api(request, cache_key=None, priority=None):
+    """Async counterpart of _call_chat_api()."""
+    response, _ = await _async_routed_call(request, priority, lambda client: client.chat.completions.create)
+    response_text = _parse_chat_output(response)
+    if cache_key and response.choices and response.choices[0].message.content:
+        response_cache.set(cache_key, response_text)
+    return response_text
+
+async def _async_coalesce(request_key, use_cache, call):
+    """Async counterpart of _coalesce(); call returns an awaitable."""
+    if not use_cache:
+        return await call()
+    return await async_single_flight.do("call:" + request_key, call)
+
+async def async_generate_ai_response(message, conversation_history=None, image_data=None, reasoning_effort=None, developer_message=None, model=None,
+                                     previous_response_id=None, response_meta=None, use_cache=True, priority=None,
+                                     previous_response_endpoint=None):
+    """Async counterpart of generate_ai_response() for the ASGI serving mode.
+    
+    Takes the same arguments and returns the same (response_text, reasoning_summary) tuple.
+    """
+    if conversation_history is None:
+        conversation_history = []
+    
+    deployment_name = model if model else AZURE_OPENAI_DEPLOYMENT_NAME
+    caching = response_cache.active(use_cache)
+    
+    try:
+        formatted_history = format_conversation_history(conversation_history)
         
-        # For o-series models, use max_completion_tokens instead of max_tokens
-        if "o" in deployment_name.lower():
-            # Make API call with o-series parameters
-            response = client.chat.completions.create(
-                model=deployment_name,
-                messages=formatted_history,
-                stream=True,
-                max_completion_tokens=800  # o-series models use this parameter
-            )
-        else:
-            # Standard parameters for GPT models
-            response = client.chat.completions.create(
-                model=deployment_name,
-                messages=formatted_history,
-                stream=True,
-                temperature=0.7,
-                presence_penalty=0.1,
-                frequency_penalty=0.1,
-                max_tokens=800
+        if _uses_responses_api(deployment_name, reasoning_effort):
+            logging.info(f"Using Responses API for model {deployment_name} with reasoning effort {reasoning_effort}")
+            request = _build_responses_request(
+                message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+                previous_response_id
             )
+            chain = _build_chain(request, message, formatted_history, image_data, reasoning_effort, developer_message,
+                                 deployment_name, previous_response_endpoint)
+            request_key = make_key("responses", request)
+            cache_key = request_key if caching else None
+            cached = _get_cached(cache_key, response_meta)
+            if cached:
+                return cached
+            try:
+                response_text, reasoning_summary, response_id, endpoint_name = await _async_coalesce(
+                    request_key, use_cache, lambda: _async_call_responses_api(request, cache_key, priority, chain)
+                )
+                if response_meta is not None:
+                    response_meta['response_id'] = response_id
+                    response_meta['response_endpoint'] = endpoint_name
+                return response_text, reasoning_summary
+            except SchedulerOverloaded:
+                raise
+            except Exception as e:
+                logging.error(f"Error using Responses API, falling back to Chat Completions: {str(e)}")
+        
+        request = _build_chat_request(message, formatted_history, image_data, developer_message, deployment_name)
+        request_key = make_key("chat", request)
+        cache_key = request_key if caching else None
+        cached = _get_cached(cache_key, response_meta)
+        if cached:
+            return cached
+        logging.debug(f"Sending async request to Azure OpenAI Chat Completions using model {deployment_name}")
+        response_text = await _async_coalesce(request_key, use_cache, lambda: _async_call_chat_api(request, cache_key, priority))
+        return response_text, None
+    
+    except SchedulerOverloaded:
+        raise
+    except Exception as e:
+        logging.error(f"Error generating AI response: {str(e)}")
+        return f"Sorry, there was an error communicating with the AI service: {str(e)}", None
+
+async def async_stream_ai_response(message, conversation_history=None, image_data=None, reasoning_effort=None, developer_message=None, model=None,
+                                   previous_response_id=None, response_meta=None, use_cache=True, priority=None,
+                                   previous_response_endpoint=None):
+    """Async counterpart of stream_ai_response() for the ASGI serving mode.
+    
+    Takes the same arguments and yields the same (event_type, delta) tuples, as an async generator.
+    """
+    if conversation_history is None:
+        conversation_history = []
+    
+    deployment_name = model if model else AZURE_OPENAI_DEPLOYMENT_NAME
+    
+    try:
+        formatted_history = format_conversation_history(conversation_history)
+        responses_request, chat_request, request_key, chain = _build_stream_requests(
+            message, formatted_history, image_data, reasoning_effort, developer_message, deployment_name,
+            previous_response_id, previous_response_endpoint
+        )
+        
+        cache_key = request_key if response_cache.active(use_cache) else None
+        cached = _get_cached(cache_key, response_meta)
+        if cached:
+            for event in _replay_stream(*cached):
+                yield event
+            return
         
-        # Collect and yield the streamed response
-        collected_chunks = []
-        for chunk in response:
-            if chunk.choices and len(chunk.choices) > 0:
-                content = chunk.choices[0].delta.content
-                if content is not None:
-                    collected_chunks.append(content)
-                    yield content
+        def start():
+            return router.stream_async(deployment_name, lambda route: _async_stream_upstream(
+                route, responses_request, chat_request, cache_key, priority, chain
+            ), prefer=chain.endpoint_name if chain else None)
         
-        # No support for reasoning summary in the streaming implementation
-                
+        events = async_single_flight.stream("stream:" + request_key, start) if use_cache else start()
+        try:
+            async for event_type, delta in events:
+                if event_type == RESPONSE_ID_EVENT:
+                    if response_meta is not None:
+                        response_meta['response_id'], response_meta['response_endpoint'] = delta
+                    continue
+                yield event_type, delta
+        finally:
+            await events.aclose()
+    
+    except SchedulerOverloaded:
+        raise
     except Exception as e:
         logging.error(f"Error streaming AI response: {str(e)}")
-        yield f"Sorry, there was an error communicating with the AI service: {str(e)}"
+        yield TEXT_EVENT, f"Sorry, there was an error communicating with the AI service: {str(e)}"
+
+async def _async_stream_upstream(route, responses_request, chat_request, cache_key=None, priority=None, chain=None):
+    """Async counterpart of _stream_upstream()."""
+    parts = {TEXT_EVENT: [], REASONING_SUMMARY_EVENT: []}
+    timer = metrics.StreamTimer(route.scheduler_key)
+    if responses_request is not None:
+        logging.info(f"Streaming from Responses API for deployment {route.scheduler_key}")
+        requests = chain.requests_for(route) if chain else [responses_request]
+        for i, request in enumerate(requests):
+            request = dict(request, model=route.deployment)
+            started = False
+            response_id = None
+            try:
+                events = async_scheduler.stream(route.scheduler_key, estimate_tokens(request), priority,
+                                                lambda: _iterate(metrics.track_upstream_async(
+                                                    route.scheduler_key, "responses",
+                                                    lambda: route.client.responses.create(**request, stream=True)
+                                                )),
+                                                route.max_retries)
+                async for event in events:
+                    parsed = _parse_responses_event(event)
+                    if parsed is None:
+                        continue
+                    if parsed[0] == RESPONSE_ID_EVENT:
+                        response_id = parsed[1] or response_id
+                        continue
+                    if parsed[0] in parts:
+                        started = True
+                        parts[parsed[0]].append(parsed[1])
+                        timer.chunk()
+                    yield parsed
+                timer.finish()
+                _store_stream(cache_key, parts)
+                if response_id:
+                    yield RESPONSE_ID_EVENT, (response_id, route.endpoint.name)
+                return
+            except Exception as e:
+                if not started and i < len(requests) - 1 and chain.missing(route, e):
+                    continue
+                if started or _should_fail_over(route, e):
+                    raise
+                logging.error(f"Error streaming from Responses API, falling back to Chat Completions: {str(e)}")
+                break
+    
+    logging.debug(f"Sending async streaming request to Azure OpenAI using deployment {route.scheduler_key}")
+    chat_request = dict(chat_request, model=route.deployment)
+    response = async_scheduler.stream(route.scheduler_key, estimate_tokens(chat_request), priority,
+                                      lambda: _iterate(metrics.track_upstream_async(
+                                          route.scheduler_key, "chat", lambda: route.client.chat.completions.create(**chat_request)
+                                      )),
+                                      route.max_retries)
+    async for chunk in response:
+        if chunk.choices and len(chunk.choices) > 0:
+            content = chunk.choices[0].delta.content
+            if content is not None:
+                parts[TEXT_EVENT].append(content)
+                timer.chunk()
+                yield TEXT_EVENT, content
+    
+    timer.finish()
+    _store_stream(cache_key, parts)
+
+async def _iterate(stream_call):
+    """Await an SDK streaming call and iterate the stream it returns; closing it closes the stream."""
+    stream = await stream_call
+    try:
+        async for event in stream:
+            yield event
+    finally:
+        await stream.close()
@@ -0,0 +1,195 @@
+"""
+Exact-match cache of model responses.
+
+Identical requests (same deployment, developer message, history, images,
+reasoning effort and sampling parameters) are answered from the cache
+instead of calling Azure OpenAI. The key is a SHA-256 of the canonical
+JSON of the upstream request, with inline images replaced by their own
+hashes. Streaming requests share entries with non-streaming ones; hits
+are replayed as a stream.
+
+The cache is opt-in (RESPONSE_CACHE=true) since sampled models do not
+return the same text for the same prompt. Clients can skip it for one
+request with ``"cache": false``. Settings:
+
+- RESPONSE_CACHE_TTL: seconds an entry stays valid (default 3600)
+- RESPONSE_CACHE_MAX_ENTRIES / RESPONSE_CACHE_MAX_BYTES: LRU limits of the
+  in-process backend (default 1000 entries, 64 MB)
+- RESPONSE_CACHE_BACKEND: ``memory`` (per process, default) or ``redis``
+  (shared by all workers, RESPONSE_CACHE_REDIS_URL; needs the redis package)
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+CACHE_ENABLED = os.environ.get("RESPONSE_CACHE", "").lower() in ("1", "true", "yes")
+CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory").lower()
+CACHE_REDIS_URL = os.environ.get("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Request fields that only affect transport, not the generated text
+TRANSPORT_FIELDS = ("stream", "stream_options")
+
+def _canonicalize(value):
+    """Replace inline images with their hashes so keys stay small and stable."""
+    if isinstance(value, dict):
+        return {key: _canonicalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_canonicalize(item) for item in value]
+    if isinstance(value, str) and value.startswith("data:image/"):
+        return "sha256:" + hashlib.sha256(value.encode("utf-8")).hexdigest()
+    return value
+
+def make_key(api, request):
+    """Return the cache key of an upstream request.
+
+    Args:
+        api (str): Which API the request is for ('chat' or 'responses')
+        request (dict): The keyword arguments of the API call
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    fields = {key: value for key, value in request.items() if key not in TRANSPORT_FIELDS}
+    canonical = json.dumps([api, _canonicalize(fields)], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class MemoryBackend:
+    """In-process TTL cache with LRU eviction by entry count and size."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, size, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._size -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size, 'evictions': self.evictions}
+
+class RedisBackend:
+    """Cache shared by all workers, stored in Redis with native expiry."""
+
+    def __init__(self, url=CACHE_REDIS_URL, prefix="response-cache:"):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._redis.set(self.prefix + key, value, ex=ttl)
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+class ResponseCache:
+    """Response cache front end: serialization, counters and error isolation."""
+
+    def __init__(self, backend=None, ttl=CACHE_TTL, enabled=CACHE_ENABLED):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _get_backend(self):
+        if self.backend is None:
+            with self._lock:
+                if self.backend is None:
+                    self.backend = RedisBackend() if CACHE_BACKEND == "redis" else MemoryBackend()
+        return self.backend
+
+    def active(self, use_cache=True):
+        """Return True if this request should use the cache; counts bypassed requests."""
+        if not self.enabled:
+            return False
+        if not use_cache:
+            self._count('bypassed')
+            return False
+        return True
+
+    def get(self, key):
+        """Return the cached (response_text, reasoning_summary), or None on a miss."""
+        try:
+            value = self._get_backend().get(key)
+        except Exception as e:
+            logging.warning(f"Response cache lookup failed: {str(e)}")
+            self._count('errors')
+            return None
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        entry = json.loads(value)
+        return entry['text'], entry.get('reasoning_summary')
+
+    def set(self, key, response_text, reasoning_summary=None):
+        """Store a successful response."""
+        if not response_text:
+            return
+        try:
+            value = json.dumps({'text': response_text, 'reasoning_summary': reasoning_summary}, default=str)
+            self._get_backend().set(key, value, self.ttl)
+            self._count('stores')
+        except Exception as e:
+            logging.warning(f"Response cache store failed: {str(e)}")
+            self._count('errors')
+
+    def stats(self):
+        """Return hit/miss counters and backend statistics."""
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['enabled'] = self.enabled
+        if self.enabled:
+            try:
+                stats.update(self._get_backend().stats())
+            except Exception as e:
+                logging.warning(f"Could not read response cache backend stats: {str(e)}")
+        return stats
+
+response_cache = ResponseCache()
@@ -0,0 +1,468 @@
+"""
+Per-deployment admission control for Azure OpenAI calls.
+
+Every upstream call is admitted by the scheduler of its deployment, which
+enforces a concurrency limit and a tokens-per-minute budget. Requests over
+the limits wait in a priority queue (interactive before batch, FIFO within
+a class). A request that cannot be admitted before its queue deadline is
+shed with ``SchedulerOverloaded``, which non-streaming chat requests turn
+into a 503 with a Retry-After header and streaming generation jobs into an
+error on their stream (see utils.generation).
+
+Rate-limit responses (429) and transient upstream errors are retried with
+jittered exponential backoff that honors the ``retry-after-ms``,
+``retry-after`` and ``x-ratelimit-reset-*`` headers. A 429 also pauses
+admissions for the whole deployment until the indicated time, so queued
+requests don't pile onto a throttled deployment. The pause applies even
+when the call isn't retried, e.g. when the router fails over to another
+endpoint instead.
+
+Queues are keyed by ``<endpoint>/<deployment>`` (see utils.endpoint_router),
+so each regional deployment has its own limits.
+
+Settings (limits are per worker process):
+
+    SCHEDULER_MAX_CONCURRENCY       Concurrent calls per deployment (default 16)
+    SCHEDULER_TPM                   Tokens-per-minute budget per deployment (default 0 = unlimited)
+    SCHEDULER_DEPLOYMENT_LIMITS     JSON overrides by deployment or endpoint/deployment,
+                                    e.g. {"o3": {"concurrency": 4, "tpm": 200000}}
+    SCHEDULER_QUEUE_TIMEOUT         Seconds an interactive request may wait (default 30)
+    SCHEDULER_BATCH_QUEUE_TIMEOUT   Seconds a batch request may wait (default 300)
+    SCHEDULER_MAX_QUEUE             Queued requests per deployment before shedding (default 200)
+    SCHEDULER_MAX_RETRIES           Retries of throttled or failed calls (default 3)
+"""
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", "16"))
+TOKENS_PER_MINUTE = int(os.environ.get("SCHEDULER_TPM", "0"))
+QUEUE_TIMEOUTS = {
+    PRIORITY_INTERACTIVE: float(os.environ.get("SCHEDULER_QUEUE_TIMEOUT", "30")),
+    PRIORITY_BATCH: float(os.environ.get("SCHEDULER_BATCH_QUEUE_TIMEOUT", "300"))
+}
+MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "200"))
+MAX_RETRIES = int(os.environ.get("SCHEDULER_MAX_RETRIES", "3"))
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# Upstream statuses worth retrying besides 429
+RETRYABLE_STATUSES = (408, 500, 502, 503, 504)
+
+def _load_deployment_limits():
+    raw = os.environ.get("SCHEDULER_DEPLOYMENT_LIMITS")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        logging.error(f"Ignoring invalid SCHEDULER_DEPLOYMENT_LIMITS: {str(e)}")
+        return {}
+
+DEPLOYMENT_LIMITS = _load_deployment_limits()
+
+class SchedulerOverloaded(Exception):
+    """A request could not be admitted before its queue deadline."""
+
+    def __init__(self, deployment_name, retry_after):
+        super().__init__(f"Deployment {deployment_name} is overloaded; retry in {retry_after:.0f}s")
+        self.deployment_name = deployment_name
+        self.retry_after = retry_after
+
+def normalize_priority(priority):
+    """Map a client-supplied priority to a known class (interactive by default)."""
+    return priority if priority in PRIORITIES else PRIORITY_INTERACTIVE
+
+def _header_seconds(headers, name, scale=1.0):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value) * scale)
+    except ValueError:
+        return None
+
+def retry_delay(error, attempt):
+    """Return how long to wait before retrying a failed call, or None if it should not be retried.
+
+    Args:
+        error (Exception): The exception raised by the OpenAI SDK
+        attempt (int): Number of retries already made
+
+    Returns:
+        float: Delay in seconds, or None
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        # Connection errors and timeouts carry no status but are transient
+        if type(error).__name__ not in ("APIConnectionError", "APITimeoutError"):
+            return None
+    elif status != 429 and status not in RETRYABLE_STATUSES:
+        return None
+
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    hinted = (
+        _header_seconds(headers, "retry-after-ms", 0.001)
+        or _header_seconds(headers, "retry-after")
+        or _header_seconds(headers, "x-ratelimit-reset-requests")
+        or _header_seconds(headers, "x-ratelimit-reset-tokens")
+    )
+    backoff = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** attempt))
+    if hinted is not None:
+        # Wait at least as long as the server asked, plus jitter so retries don't align
+        return min(MAX_BACKOFF, hinted) + random.uniform(0, backoff / 2)
+    return random.uniform(backoff / 2, backoff)
+
+def estimate_tokens(request):
+    """Rough token cost of an upstream request (prompt plus output allowance) for the TPM budget."""
+    from utils.context_window import IMAGE_TOKEN_ESTIMATE
+
+    prompt_chars = 0
+    images = 0
+    pending = [request.get("messages") or request.get("input")]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+        elif isinstance(value, str):
+            if value.startswith("data:image/"):
+                images += 1
+            else:
+                prompt_chars += len(value)
+    output = request.get("max_completion_tokens") or request.get("max_tokens") or request.get("max_output_tokens") or 1000
+    return prompt_chars // 4 + images * IMAGE_TOKEN_ESTIMATE + output
+
+class _DeploymentState:
+    """Admission state and counters of one deployment."""
+
+    def __init__(self, name):
+        limits = DEPLOYMENT_LIMITS.get(name) or DEPLOYMENT_LIMITS.get(name.rsplit("/", 1)[-1], {})
+        self.name = name
+        self.max_concurrency = int(limits.get("concurrency", MAX_CONCURRENCY))
+        self.tpm = int(limits.get("tpm", TOKENS_PER_MINUTE))
+        self.in_flight = 0
+        self.tokens = float(self.tpm)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.queue = []
+        self.stats = {
+            'admitted': 0, 'shed': 0, 'retries': 0, 'throttled': 0,
+            'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0
+        }
+
+    def _refill(self, now):
+        if self.tpm:
+            self.tokens = min(float(self.tpm), self.tokens + (now - self.refilled_at) * self.tpm / 60.0)
+        self.refilled_at = now
+
+    def admission_delay(self, tokens, now):
+        """Seconds until a request of this size could start (0 if it can start now)."""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= self.max_concurrency:
+            return None  # Wait for a release
+        if self.tpm:
+            # A request larger than the whole budget is admitted once the bucket is full
+            needed = min(tokens, self.tpm)
+            if self.tokens < needed:
+                return (needed - self.tokens) * 60.0 / self.tpm
+        return 0.0
+
+    def admit(self, tokens, waited):
+        self.in_flight += 1
+        if self.tpm:
+            self.tokens -= tokens
+        self.stats['admitted'] += 1
+        self.stats['wait_seconds_total'] += waited
+        self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.stats['throttled'] += 1
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats.update({
+            'queue_depth': len(self.queue),
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'tpm': self.tpm,
+            'tokens_available': int(self.tokens) if self.tpm else None,
+            'paused_for': max(0.0, self.paused_until - time.monotonic())
+        })
+        return stats
+
+class Scheduler:
+    """Admission control for threaded (WSGI) workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._deployments = {}
+        self._sequence = itertools.count()
+
+    def _state(self, deployment_name):
+        state = self._deployments.get(deployment_name)
+        if state is None:
+            state = self._deployments[deployment_name] = _DeploymentState(deployment_name)
+        return state
+
+    @contextmanager
+    def slot(self, deployment_name, tokens, priority=PRIORITY_INTERACTIVE):
+        """Hold one admission slot of a deployment for the duration of a call.
+
+        Raises:
+            SchedulerOverloaded: If the request could not be admitted before its deadline
+        """
+        priority = normalize_priority(priority)
+        started = time.monotonic()
+        deadline = started + QUEUE_TIMEOUTS[priority]
+        with self._condition:
+            state = self._state(deployment_name)
+            if len(state.queue) >= MAX_QUEUE:
+                state.stats['shed'] += 1
+                raise SchedulerOverloaded(deployment_name, QUEUE_TIMEOUTS[priority])
+            entry = (PRIORITIES[priority], next(self._sequence))
+            heapq.heappush(state.queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = state.admission_delay(tokens, now) if state.queue[0] == entry else None
+                    if delay == 0.0:
+                        break
+                    if now >= deadline:
+                        state.stats['shed'] += 1
+                        raise SchedulerOverloaded(deployment_name, delay or QUEUE_TIMEOUTS[priority])
+                    self._condition.wait(min(deadline - now, delay if delay is not None else deadline - now))
+            finally:
+                state.queue.remove(entry)
+                heapq.heapify(state.queue)
+                # Let the next request in line re-check
+                self._condition.notify_all()
+            state.admit(tokens, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            with self._condition:
+                state.in_flight -= 1
+                self._condition.notify_all()
+
+    def pause(self, deployment_name, seconds):
+        """Stop admitting requests to a deployment for a while (after a 429)."""
+        with self._condition:
+            self._state(deployment_name).pause(seconds)
+
+    def call(self, deployment_name, tokens, priority, fn, max_retries=None):
+        """Run fn() inside an admission slot, retrying throttled and transient failures.
+
+        max_retries defaults to SCHEDULER_MAX_RETRIES; pass 0 when the caller can fail over instead.
+        """
+        max_retries = MAX_RETRIES if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            try:
+                with self.slot(deployment_name, tokens, priority):
+                    return fn()
+            except SchedulerOverloaded:
+                raise
+            except Exception as e:
+                delay = self._record_failure(deployment_name, e, attempt)
+                if delay is None or attempt >= max_retries:
+                    raise
+                self._record_retry(deployment_name, e, delay)
+                attempt += 1
+                time.sleep(delay)
+
+    def stream(self, deployment_name, tokens, priority, start, max_retries=None):
+        """Iterate start()'s events inside an admission slot.
+
+        The call is retried like call() as long as no event has been produced yet.
+        """
+        max_retries = MAX_RETRIES if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            started = False
+            try:
+                with self.slot(deployment_name, tokens, priority):
+                    events = start()
+                    try:
+                        for event in events:
+                            started = True
+                            yield event
+                    finally:
+                        # Closing the SDK stream ends the upstream HTTP response, e.g. when
+                        # the caller stops reading because the generation was cancelled
+                        close = getattr(events, "close", None)
+                        if close is not None:
+                            close()
+                    return
+            except SchedulerOverloaded:
+                raise
+            except Exception as e:
+                delay = self._record_failure(deployment_name, e, attempt)
+                if delay is None or attempt >= max_retries or started:
+                    raise
+                self._record_retry(deployment_name, e, delay)
+                attempt += 1
+                time.sleep(delay)
+
+    def _record_failure(self, deployment_name, error, attempt):
+        """Return retry_delay() for a failed call; a 429 pauses the deployment even if it won't be retried."""
+        delay = retry_delay(error, attempt)
+        if getattr(error, "status_code", None) == 429:
+            self.pause(deployment_name, delay)
+        return delay
+
+    def _record_retry(self, deployment_name, error, delay):
+        with self._condition:
+            self._state(deployment_name).stats['retries'] += 1
+        logging.warning(f"Upstream call to {deployment_name} failed ({str(error)}); retrying in {delay:.1f}s")
+
+    def stats(self):
+        """Return queue depth, wait time and admission counters per deployment."""
+        with self._condition:
+            return {name: state.snapshot() for name, state in self._deployments.items()}
+
+class AsyncScheduler:
+    """Admission control for the ASGI event loop."""
+
+    def __init__(self):
+        self._condition = None
+        self._deployments = {}
+        self._sequence = itertools.count()
+
+    def _get_condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _state(self, deployment_name):
+        state = self._deployments.get(deployment_name)
+        if state is None:
+            state = self._deployments[deployment_name] = _DeploymentState(deployment_name)
+        return state
+
+    @asynccontextmanager
+    async def slot(self, deployment_name, tokens, priority=PRIORITY_INTERACTIVE):
+        """Async counterpart of Scheduler.slot()."""
+        priority = normalize_priority(priority)
+        condition = self._get_condition()
+        started = time.monotonic()
+        deadline = started + QUEUE_TIMEOUTS[priority]
+        async with condition:
+            state = self._state(deployment_name)
+            if len(state.queue) >= MAX_QUEUE:
+                state.stats['shed'] += 1
+                raise SchedulerOverloaded(deployment_name, QUEUE_TIMEOUTS[priority])
+            entry = (PRIORITIES[priority], next(self._sequence))
+            heapq.heappush(state.queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = state.admission_delay(tokens, now) if state.queue[0] == entry else None
+                    if delay == 0.0:
+                        break
+                    if now >= deadline:
+                        state.stats['shed'] += 1
+                        raise SchedulerOverloaded(deployment_name, delay or QUEUE_TIMEOUTS[priority])
+                    timeout = min(deadline - now, delay if delay is not None else deadline - now)
+                    try:
+                        await asyncio.wait_for(condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                state.queue.remove(entry)
+                heapq.heapify(state.queue)
+                condition.notify_all()
+            state.admit(tokens, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            async with condition:
+                state.in_flight -= 1
+                condition.notify_all()
+
+    async def call(self, deployment_name, tokens, priority, fn, max_retries=None):
+        """Async counterpart of Scheduler.call(); fn returns an awaitable."""
+        max_retries = MAX_RETRIES if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            try:
+                async with self.slot(deployment_name, tokens, priority):
+                    return await fn()
+            except SchedulerOverloaded:
+                raise
+            except Exception as e:
+                delay = self._record_failure(deployment_name, e, attempt)
+                if delay is None or attempt >= max_retries:
+                    raise
+                self._record_retry(deployment_name, e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def stream(self, deployment_name, tokens, priority, start, max_retries=None):
+        """Async counterpart of Scheduler.stream(); start() returns an async iterator."""
+        max_retries = MAX_RETRIES if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async with self.slot(deployment_name, tokens, priority):
+                    events = start()
+                    try:
+                        async for event in events:
+                            started = True
+                            yield event
+                    finally:
+                        aclose = getattr(events, "aclose", None)
+                        if aclose is not None:
+                            await aclose()
+                    return
+            except SchedulerOverloaded:
+                raise
+            except Exception as e:
+                delay = self._record_failure(deployment_name, e, attempt)
+                if delay is None or attempt >= max_retries or started:
+                    raise
+                self._record_retry(deployment_name, e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def _record_failure(self, deployment_name, error, attempt):
+        """Async counterpart of Scheduler._record_failure()."""
+        delay = retry_delay(error, attempt)
+        if getattr(error, "status_code", None) == 429:
+            self._state(deployment_name).pause(delay)
+        return delay
+
+    def _record_retry(self, deployment_name, error, delay):
+        self._state(deployment_name).stats['retries'] += 1
+        logging.warning(f"Upstream call to {deployment_name} failed ({str(error)}); retrying in {delay:.1f}s")
+
+    def stats(self):
+        """Return queue depth, wait time and admission counters per deployment."""
+        return {name: state.snapshot() for name, state in self._deployments.items()}
+
+scheduler = Scheduler()
+async_scheduler = AsyncScheduler()
+
+def get_stats():
+    """Return per-deployment scheduler statistics of the threaded and async paths."""
+    return {
+        'sync': scheduler.stats(),
+        'async': async_scheduler.stats()
+    }
@@ -0,0 +1,66 @@
+"""
+Additive schema upgrades for existing databases.
+
+``db.create_all()`` only creates missing tables; it never touches tables
+that already exist. This module adds columns and indexes that were
+introduced after a table was first created, so deployments pick up new
+model fields without a separate migration tool. Only additive,
+backwards-compatible changes are handled (nullable columns, indexes).
+"""
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+def _column_ddl(column, dialect):
+    """Render the type and default part of an ADD COLUMN statement."""
+    ddl = column.type.compile(dialect=dialect)
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = default.arg
+        if isinstance(value, bool):
+            value = "TRUE" if value else "FALSE"
+            if dialect.name == "sqlite":
+                value = "1" if default.arg else "0"
+        elif isinstance(value, str):
+            value = "'" + value.replace("'", "''") + "'"
+        ddl += f" DEFAULT {value}"
+    return ddl
+
+def upgrade_schema(db):
+    """Add missing columns and indexes to tables that already exist.
+
+    Args:
+        db (SQLAlchemy): The Flask-SQLAlchemy extension whose metadata describes the target schema
+
+    Returns:
+        list: Human-readable descriptions of the changes that were applied
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    applied = []
+
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = _column_ddl(column, engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {ddl}'))
+                applied.append(f"added column {table.name}.{column.name}")
+
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                connection.execute(CreateIndex(index))
+                applied.append(f"created index {index.name}")
+
+    for change in applied:
+        logging.info(f"Schema upgrade: {change}")
+    return applied
@@ -0,0 +1,280 @@
+"""
+Single-flight coalescing of identical in-flight upstream requests.
+
+When several callers send the same request at the same time (client
+retries, duplicate tabs, shared prompt templates), only the first one -
+the leader - calls Azure OpenAI; the others wait for and share its result.
+Streams are fanned out: the leader's upstream stream is consumed by a
+background task that buffers every event, and each subscriber replays the
+buffer from the start, so late joiners get the prefix they missed and then
+follow live. A flight ends when its upstream call does; later callers start
+a new one. A stream flight whose subscribers have all gone away (their
+generations were cancelled) is abandoned: the pump closes the upstream
+stream at its next event and the response isn't cached.
+
+Requests are keyed by the same canonical hash as the response cache.
+Coalescing is on by default; set SINGLE_FLIGHT=false to disable it.
+Requests that bypass the response cache also bypass coalescing.
+"""
+import os
+import asyncio
+import logging
+import threading
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT", "true").lower() in ("1", "true", "yes")
+
+class _Flight:
+    """State shared by the leader and followers of one in-flight request."""
+
+    def __init__(self, condition):
+        self.events = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.condition = condition
+        # Stream subscribers still reading; a flight without any is abandoned
+        self.subscribers = 0
+        self.abandoned = False
+
+class _FlightRegistry:
+    """Tracks in-flight requests by key and counts leaders and followers."""
+
+    def __init__(self, enabled, condition_factory):
+        self.enabled = enabled
+        # threading.Condition or asyncio.Condition, for waiting on a flight
+        self._condition_factory = condition_factory
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'followers': 0, 'abandoned': 0}
+
+    def _join(self, key, subscribe=False):
+        """Return (flight, is_leader) for a request key; subscribe counts the caller as a stream subscriber."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(self._condition_factory())
+                self._stats['leaders'] += 1
+            else:
+                self._stats['followers'] += 1
+                logging.debug(f"Joined in-flight request {key[:12]}")
+            if subscribe:
+                flight.subscribers += 1
+            return flight, leader
+
+    def _leave(self, key, flight):
+        """Stop counting a stream subscriber; abandon the flight when it was the last one."""
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers > 0 or flight.done or flight.abandoned:
+                return
+            # Retired under the same lock as _join(), so nobody joins an abandoned flight
+            flight.abandoned = True
+            self._stats['abandoned'] += 1
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        logging.info(f"Abandoned shared upstream stream {key[:12]}: no subscribers left")
+
+    def _retire(self, key, flight):
+        """Stop new callers from joining a finished flight."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        """Return the number of leader, follower (coalesced) and abandoned requests and flights in progress."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._flights)
+        stats['enabled'] = self.enabled
+        return stats
+
+class SingleFlight(_FlightRegistry):
+    """Single-flight coalescing for threaded (WSGI) workers."""
+
+    def __init__(self, enabled=SINGLE_FLIGHT_ENABLED):
+        super().__init__(enabled, threading.Condition)
+
+    def _finish(self, key, flight, result=None, error=None):
+        self._retire(key, flight)
+        with flight.condition:
+            flight.result = result
+            flight.error = error
+            flight.done = True
+            flight.condition.notify_all()
+
+    def do(self, key, fn):
+        """Call fn(), or wait for and return the result of an identical call already in flight."""
+        if not self.enabled:
+            return fn()
+
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(key, flight, error=e)
+                raise
+            self._finish(key, flight, result=result)
+            return result
+
+        with flight.condition:
+            while not flight.done:
+                flight.condition.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stream(self, key, start):
+        """Iterate start()'s events, sharing one upstream iteration among identical concurrent streams.
+
+        Args:
+            key (str): Canonical request hash
+            start (callable): Returns the upstream event iterator; only called by the leader
+
+        Returns:
+            iterator: All events of the stream, from the first one
+        """
+        if not self.enabled:
+            return start()
+
+        flight, leader = self._join(key, subscribe=True)
+        if leader:
+            # Consume upstream in the background so every subscriber, including the
+            # leader's client, can go away without cutting the stream short for the others
+            threading.Thread(target=self._pump, args=(key, flight, start), daemon=True,
+                             name=f"single-flight-{key[:12]}").start()
+        return self._subscribe(key, flight)
+
+    def _pump(self, key, flight, start):
+        events = start()
+        try:
+            for event in events:
+                with flight.condition:
+                    flight.events.append(event)
+                    flight.condition.notify_all()
+                if flight.abandoned:
+                    break
+        except BaseException as e:
+            logging.error(f"Shared upstream stream {key[:12]} failed: {str(e)}")
+            self._finish(key, flight, error=e)
+            return
+        finally:
+            # Ends the upstream HTTP response when the flight was abandoned
+            close = getattr(events, 'close', None)
+            if close is not None:
+                close()
+        self._finish(key, flight)
+
+    def _subscribe(self, key, flight):
+        index = 0
+        try:
+            while True:
+                with flight.condition:
+                    while index >= len(flight.events) and not flight.done:
+                        flight.condition.wait()
+                    events = flight.events[index:]
+                    index += len(events)
+                    done, error = flight.done, flight.error
+                yield from events
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self._leave(key, flight)
+
+class AsyncSingleFlight(_FlightRegistry):
+    """Single-flight coalescing for the ASGI event loop."""
+
+    def __init__(self, enabled=SINGLE_FLIGHT_ENABLED):
+        super().__init__(enabled, asyncio.Condition)
+        self._tasks = set()
+
+    async def _finish(self, key, flight, result=None, error=None):
+        self._retire(key, flight)
+        async with flight.condition:
+            flight.result = result
+            flight.error = error
+            flight.done = True
+            flight.condition.notify_all()
+
+    async def do(self, key, fn):
+        """Await fn(), or the result of an identical call already in flight."""
+        if not self.enabled:
+            return await fn()
+
+        flight, leader = self._join(key)
+        if leader:
+            try:
+                result = await fn()
+            except BaseException as e:
+                await self._finish(key, flight, error=e)
+                raise
+            await self._finish(key, flight, result=result)
+            return result
+
+        async with flight.condition:
+            await flight.condition.wait_for(lambda: flight.done)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    async def stream(self, key, start):
+        """Async counterpart of SingleFlight.stream(); start() returns an async iterator."""
+        if not self.enabled:
+            async for event in start():
+                yield event
+            return
+
+        flight, leader = self._join(key, subscribe=True)
+        if leader:
+            task = asyncio.create_task(self._pump(key, flight, start))
+            # Keep a reference so the task is not garbage collected mid-stream
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        index = 0
+        try:
+            while True:
+                async with flight.condition:
+                    await flight.condition.wait_for(lambda: index < len(flight.events) or flight.done)
+                    events = flight.events[index:]
+                    index += len(events)
+                    done, error = flight.done, flight.error
+                for event in events:
+                    yield event
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self._leave(key, flight)
+
+    async def _pump(self, key, flight, start):
+        events = start()
+        try:
+            async for event in events:
+                async with flight.condition:
+                    flight.events.append(event)
+                    flight.condition.notify_all()
+                if flight.abandoned:
+                    break
+        except BaseException as e:
+            logging.error(f"Shared upstream stream {key[:12]} failed: {str(e)}")
+            await self._finish(key, flight, error=e)
+            return
+        finally:
+            # Ends the upstream HTTP response when the flight was abandoned
+            await events.aclose()
+        await self._finish(key, flight)
+
+single_flight = SingleFlight()
+async_single_flight = AsyncSingleFlight()
+
+def get_stats():
+    """Return coalescing counters of the threaded and async paths."""
+    return {
+        'sync': single_flight.stats(),
+        'async': async_single_flight.stats()
+    }
@@ -0,0 +1,175 @@
+"""
+Server-sent event framing with delta coalescing.
+
+Upstream streams deliver a token or two per delta. Sending each one as its
+own SSE frame costs a JSON encode, a WSGI/ASGI write and usually a TCP
+push for a few bytes, so consecutive deltas of the same kind are coalesced
+into one frame. Buffered text is sent once the oldest delta has waited
+SSE_COALESCE_MS, once SSE_COALESCE_MAX_BYTES are buffered, when the kind of
+delta changes and at the end of the stream. The first delta of each kind
+(reasoning summary and answer text) is always sent right away, so neither
+the first reasoning nor the first answer token is held back.
+
+In the async app a timer flushes the buffer even while upstream is quiet.
+The sync app can only flush when the next delta arrives or the stream
+ends, so a long upstream pause can hold back up to one window's worth of
+text.
+
+When the writer is given a ``StreamBuffer`` (see utils.stream_buffer), every
+frame carries an SSE id and is kept for clients that reconnect.
+
+Frames are encoded with orjson when it is installed, otherwise with the
+stdlib encoder. Frame sizes and per-stream frame rates are exported as
+metrics.
+
+Settings:
+
+    SSE_COALESCE_MS          Longest time a delta is held back (default 30; 0 disables coalescing)
+    SSE_COALESCE_MAX_BYTES   Buffered bytes that trigger a frame (default 1024)
+"""
+import os
+import json
+import time
+import asyncio
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from utils import metrics
+from utils.openai_helper import REASONING_SUMMARY_EVENT
+
+SSE_COALESCE_MS = int(os.environ.get("SSE_COALESCE_MS", "30"))
+SSE_COALESCE_MAX_BYTES = int(os.environ.get("SSE_COALESCE_MAX_BYTES", "1024"))
+
+def encode_json(value):
+    """Encode a value as compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(value).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def format_event(data, event=None, event_id=None):
+    """Return one SSE frame with a JSON payload."""
+    prefix = f"id: {event_id}\n" if event_id else ""
+    if event:
+        prefix += f"event: {event}\n"
+    return f"{prefix}data: {encode_json(data)}\n\n"
+
+def chat_frame(kind, text):
+    """Frame of a /api/chat stream: text as chunks, reasoning summary deltas as their own event type."""
+    if kind == REASONING_SUMMARY_EVENT:
+        return {'delta': text}, 'reasoning_summary'
+    return {'chunk': text, 'is_final': False}, None
+
+def chat_final(full_response, reasoning_summary=None, is_truncated=False):
+    """Payload of the last frame of a /api/chat stream."""
+    payload = {'chunk': '', 'is_final': True, 'full_response': full_response}
+    if reasoning_summary:
+        payload['reasoning_summary'] = reasoning_summary
+    if is_truncated:
+        payload['is_truncated'] = True
+    return payload
+
+class SSEWriter:
+    """Turns a stream of (kind, delta) pairs into coalesced SSE frames.
+
+    ``frame_for`` maps a kind and the joined text to (payload, event name).
+    Text of any kind but reasoning summaries advances the stream's text
+    offset, which is part of the event ids when a ``buffer`` is given.
+    """
+
+    def __init__(self, frame_for=chat_frame, coalesce_ms=SSE_COALESCE_MS, max_bytes=SSE_COALESCE_MAX_BYTES,
+                 buffer=None):
+        self.frame_for = frame_for
+        self.buffer = buffer
+        self.window = coalesce_ms / 1000.0
+        self.max_bytes = max_bytes
+        self.started = time.perf_counter()
+        self.frames = 0
+        self.bytes = 0
+        self._kind = None
+        self._parts = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._sent_kinds = set()
+
+    def add(self, kind, delta):
+        """Buffer a delta; return the frames (possibly none) to send now."""
+        frames = []
+        if self._parts and kind != self._kind:
+            frames.extend(self.flush())
+        if not self._parts:
+            self._pending_since = time.perf_counter()
+        self._kind = kind
+        self._parts.append(delta)
+        self._pending_bytes += len(delta)
+        if (kind not in self._sent_kinds or self.window <= 0 or self._pending_bytes >= self.max_bytes
+                or time.perf_counter() - self._pending_since >= self.window):
+            frames.extend(self.flush())
+        return frames
+
+    def flush(self):
+        """Return the buffered text as a frame (or nothing if the buffer is empty)."""
+        if not self._parts:
+            return []
+        text = "".join(self._parts)
+        payload, event = self.frame_for(self._kind, text)
+        advance = 0 if self._kind == REASONING_SUMMARY_EVENT else len(text)
+        self._parts = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._sent_kinds.add(self._kind)
+        return [self.frame(payload, event, advance)]
+
+    def frame(self, payload, event=None, advance=0):
+        """Encode a frame right away, counting it in the stream's metrics.
+
+        ``advance`` is the number of answer characters the frame carries.
+        """
+        if self.buffer is not None:
+            frame = self.buffer.append(payload, event, advance)
+        else:
+            frame = format_event(payload, event)
+        self.frames += 1
+        self.bytes += len(frame)
+        metrics.SSE_FRAME_BYTES.observe(len(frame))
+        return frame
+
+    def time_to_flush(self):
+        """Seconds until buffered text is due, or None if nothing is buffered."""
+        if not self._parts:
+            return None
+        return max(0.0, self.window - (time.perf_counter() - self._pending_since))
+
+    def close(self):
+        """Record the stream's frame rate and end its buffer; call once the stream has ended."""
+        if self.buffer is not None:
+            self.buffer.finish()
+        elapsed = time.perf_counter() - self.started
+        if self.frames and elapsed > 0:
+            metrics.SSE_FRAMES_PER_SECOND.observe(self.frames / elapsed)
+
+    async def paced(self, events):
+        """Iterate an async iterator, yielding None whenever buffered text is due to be flushed."""
+        iterator = events.__aiter__()
+        next_event = None
+        try:
+            while True:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(iterator.__anext__())
+                timeout = self.time_to_flush()
+                if timeout is not None:
+                    done, _ = await asyncio.wait({next_event}, timeout=timeout)
+                    if not done:
+                        yield None
+                        continue
+                try:
+                    event = await next_event
+                except StopAsyncIteration:
+                    return
+                next_event = None
+                yield event
+        finally:
+            if next_event is not None and not next_event.done():
+                next_event.cancel()
@@ -0,0 +1,484 @@
+"""
+Resumable chat streams and the bus that fans them out.
+
+Every streamed /api/chat response gets a random stream id, announced in a
+first ``stream`` event together with the id of the assistant message. Each
+frame carries an SSE id of the form ``<seq>.<offset>``: ``seq`` numbers the
+frames of the stream and ``offset`` is the number of answer characters sent
+up to and including the frame.
+
+Generation jobs (see utils.generation) publish the frames of a stream to
+the stream bus, and every client reading the stream is a subscriber: the
+POST request that started it, a client resuming after a dropped connection
+and any other tab watching the same answer. The in-process bus keeps the
+frames of each stream in a ring buffer of STREAM_BUFFER_FRAMES frames and
+wakes subscribers as frames arrive. It can be replaced with a shared
+backend with ``set_stream_bus()``; a bus provides ``open()``, ``has()``,
+``cancel()``, ``attached()``, ``subscribe()``, ``asubscribe()`` and
+``get_stats()`` like ``InProcessStreamBus``.
+
+A client that lost its connection calls ``GET /api/chat/stream?stream_id=...``
+with the ``Last-Event-ID`` header (or a ``last_event_id`` query parameter)
+and receives the frames it missed:
+
+- from the bus when the stream is on it and the frames after the client's
+  are still buffered; a stream that is still running is then followed live
+- otherwise from the assistant ``Message`` row (matched by its
+  ``stream_id``), which holds the text persisted so far; the row is polled
+  every STREAM_RESUME_POLL_INTERVAL seconds until the stream ends
+
+Either way the model is never called again. A stream whose row makes no
+progress for STREAM_RESUME_IDLE_TIMEOUT seconds ends with a ``timeout``
+status, one whose producer died with ``interrupted`` and a failed one with
+``error``.
+
+While a subscriber waits for frames it sends an SSE comment every
+STREAM_HEARTBEAT_INTERVAL seconds. Writing to a closed connection fails,
+so a client that went away is noticed even while the model is quiet. The
+bus counts the subscribers attached to each stream, and a generation job
+whose stream has had none for a grace period is cancelled (see
+utils.generation).
+
+Finished streams stay buffered for STREAM_BUFFER_TTL seconds, and at most
+STREAM_BUFFER_STREAMS streams are kept per process, oldest evicted first.
+
+Settings:
+
+    STREAM_BUFFER_FRAMES          Frames kept per stream (default 512)
+    STREAM_BUFFER_STREAMS         Streams kept per process (default 1000)
+    STREAM_BUFFER_TTL             Seconds a finished stream stays buffered (default 300)
+    STREAM_RESUME_POLL_INTERVAL   Seconds between reads of the message row (default 0.5)
+    STREAM_RESUME_IDLE_TIMEOUT    Seconds without progress before a resume gives up (default 120)
+    STREAM_HEARTBEAT_INTERVAL     Seconds of silence before a subscriber sends a heartbeat (default 15)
+"""
+import os
+import time
+import asyncio
+import secrets
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque, namedtuple
+
+from utils import metrics
+from utils.sse import chat_frame, chat_final, format_event
+
+STREAM_BUFFER_FRAMES = int(os.environ.get("STREAM_BUFFER_FRAMES", "512"))
+STREAM_BUFFER_STREAMS = int(os.environ.get("STREAM_BUFFER_STREAMS", "1000"))
+STREAM_BUFFER_TTL = float(os.environ.get("STREAM_BUFFER_TTL", "300"))
+STREAM_RESUME_POLL_INTERVAL = float(os.environ.get("STREAM_RESUME_POLL_INTERVAL", "0.5"))
+STREAM_RESUME_IDLE_TIMEOUT = float(os.environ.get("STREAM_RESUME_IDLE_TIMEOUT", "120"))
+STREAM_HEARTBEAT_INTERVAL = float(os.environ.get("STREAM_HEARTBEAT_INTERVAL", "15"))
+
+HEARTBEAT_FRAME = ": heartbeat\n\n"
+
+TEXT_EVENT = "text"
+
+Frame = namedtuple("Frame", ["seq", "offset", "text"])
+# What a resume needs from an assistant Message row; error is None unless generation failed
+MessageSnapshot = namedtuple("MessageSnapshot", ["content", "reasoning_summary", "is_streaming", "is_truncated",
+                                                 "error"])
+
+class StreamUnavailable(Exception):
+    """The bus can't serve a stream from the requested frame (unknown, or no longer buffered)."""
+
+def new_stream_id():
+    return secrets.token_urlsafe(16)
+
+def parse_event_id(value):
+    """Parse a ``<seq>.<offset>`` event id; a missing id means the start of the stream.
+
+    Raises:
+        ValueError: If the id is malformed
+    """
+    if not value:
+        return 0, 0
+    seq, _, offset = value.strip().partition(".")
+    seq, offset = int(seq), int(offset or 0)
+    if seq < 0 or offset < 0:
+        raise ValueError(f"Invalid event id: {value}")
+    return seq, offset
+
+def status_frame(status, message):
+    return format_event({'status': status, 'message': message})
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class StreamBuffer:
+    """Ring buffer of the frames of one stream, with waiting for new frames."""
+
+    def __init__(self, stream_id, message_id=None, max_frames=STREAM_BUFFER_FRAMES):
+        self.stream_id = stream_id
+        self.message_id = message_id
+        self.frames = deque(maxlen=max_frames)
+        self.seq = 0
+        self.offset = 0
+        self.done = False
+        self.interrupted = False
+        self.error = None
+        self.finished_at = None
+        self._condition = threading.Condition()
+        # (loop, future) of subscribers waiting on an event loop
+        self._async_waiters = set()
+        # Set to ask the generation job to stop
+        self.cancel_event = threading.Event()
+        self.cancel_reason = None
+        self.subscribers = 0
+        self.detached_at = time.monotonic()
+
+    def cancel(self, reason):
+        """Ask the generation job to stop; return False if the stream has already ended."""
+        if self.done:
+            return False
+        if not self.cancel_event.is_set():
+            self.cancel_reason = reason
+            self.cancel_event.set()
+        return True
+
+    def attach(self):
+        with self._condition:
+            self.subscribers += 1
+
+    def detach(self):
+        with self._condition:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.detached_at = time.monotonic()
+
+    def unwatched_for(self):
+        """Seconds since the last subscriber went away, or 0 while someone is attached."""
+        with self._condition:
+            return 0 if self.subscribers else time.monotonic() - self.detached_at
+
+    def append(self, payload, event=None, advance=0):
+        """Number, encode and keep a frame; return its text."""
+        with self._condition:
+            self.seq += 1
+            self.offset += advance
+            text = format_event(payload, event, f"{self.seq}.{self.offset}")
+            self.frames.append(Frame(self.seq, self.offset, text))
+            self._notify()
+        return text
+
+    def finish(self, interrupted=False, error=None):
+        """Mark the stream as ended; has no effect once it has ended."""
+        with self._condition:
+            if self.done:
+                return
+            self.done = True
+            self.interrupted = interrupted or error is not None
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def _notify(self):
+        self._condition.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, future)
+        self._async_waiters.clear()
+
+    def end_frame(self):
+        """The status frame telling subscribers why the stream ended early, or None."""
+        if self.error is not None:
+            return status_frame('error', self.error)
+        if self.interrupted:
+            return status_frame('interrupted', 'The response was interrupted')
+        return None
+
+    def frames_after(self, seq, offset):
+        """Return the frames after the client's last one, or None if they're no longer all buffered.
+
+        ``offset`` must match the one this buffer gave frame ``seq``, so ids
+        handed out by a resume from the message row are never mistaken for
+        this buffer's.
+        """
+        with self._condition:
+            if seq == self.seq:
+                return [] if offset == self.offset else None
+            if not self.frames or seq > self.seq:
+                return None
+            first = self.frames[0].seq
+            if seq == 0:
+                return list(self.frames) if first == 1 and offset == 0 else None
+            index = seq - first
+            if index < 0 or self.frames[index].offset != offset:
+                return None
+            return list(self.frames)[index + 1:]
+
+    def wait(self, seq, timeout):
+        """Block until there are frames after ``seq`` or the stream ends."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.seq > seq or self.done, timeout)
+
+    async def wait_async(self, seq, timeout):
+        """``wait()`` for the event loop."""
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if self.seq > seq or self.done:
+                return
+            waiter = (loop, loop.create_future())
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+    def expired(self, now):
+        return self.done and now - self.finished_at > STREAM_BUFFER_TTL
+
+class InProcessStreamBus:
+    """Stream bus of a single process: publishers and subscribers must share it."""
+
+    def __init__(self, max_streams=STREAM_BUFFER_STREAMS):
+        self.max_streams = max_streams
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'evicted': 0, 'resumed_from_buffer': 0, 'resumed_from_message': 0}
+
+    def open(self, message_id=None):
+        """Start a new stream; return the StreamBuffer its frames are published to."""
+        buffer = StreamBuffer(new_stream_id(), message_id)
+        with self._lock:
+            self._purge(time.monotonic())
+            while len(self._streams) >= self.max_streams:
+                self._evict_one()
+            self._streams[buffer.stream_id] = buffer
+            self.stats['opened'] += 1
+        return buffer
+
+    def get(self, stream_id):
+        with self._lock:
+            self._purge(time.monotonic())
+            return self._streams.get(stream_id)
+
+    def has(self, stream_id):
+        return self.get(stream_id) is not None
+
+    def cancel(self, stream_id, reason):
+        """Ask the job producing a stream to stop; return False unless it is running here."""
+        buffer = self.get(stream_id)
+        return buffer.cancel(reason) if buffer is not None else False
+
+    @contextmanager
+    def attached(self, stream_id):
+        """Count a client as watching a stream for as long as the block runs."""
+        buffer = self.get(stream_id)
+        if buffer is not None:
+            buffer.attach()
+        try:
+            yield
+        finally:
+            if buffer is not None:
+                buffer.detach()
+
+    def _purge(self, now):
+        for stream_id in [stream_id for stream_id, buffer in self._streams.items() if buffer.expired(now)]:
+            del self._streams[stream_id]
+
+    def _evict_one(self):
+        # Prefer the oldest finished stream; live ones can still resume from their message row
+        victim = next((stream_id for stream_id, buffer in self._streams.items() if buffer.done),
+                      next(iter(self._streams)))
+        del self._streams[victim]
+        self.stats['evicted'] += 1
+
+    def subscribe(self, stream_id, seq=0, offset=0):
+        """Yield the Frames of a stream after (seq, offset), following it until it ends.
+
+        Yields None whenever a wait for new frames times out, so the caller can
+        send heartbeats.
+
+        Raises:
+            StreamUnavailable: If the stream isn't on the bus, or the subscriber fell behind its buffer
+        """
+        buffer = self.get(stream_id)
+        if buffer is None:
+            raise StreamUnavailable(stream_id)
+        while True:
+            done = buffer.done
+            frames = buffer.frames_after(seq, offset)
+            if frames is None:
+                raise StreamUnavailable(stream_id)
+            for frame in frames:
+                yield frame
+                seq, offset = frame.seq, frame.offset
+            if done:
+                end_frame = buffer.end_frame()
+                if end_frame:
+                    yield Frame(seq, offset, end_frame)
+                return
+            if not frames:
+                yield None
+            buffer.wait(seq, STREAM_RESUME_POLL_INTERVAL)
+
+    async def asubscribe(self, stream_id, seq=0, offset=0):
+        """``subscribe()`` for the event loop."""
+        buffer = self.get(stream_id)
+        if buffer is None:
+            raise StreamUnavailable(stream_id)
+        while True:
+            done = buffer.done
+            frames = buffer.frames_after(seq, offset)
+            if frames is None:
+                raise StreamUnavailable(stream_id)
+            for frame in frames:
+                yield frame
+                seq, offset = frame.seq, frame.offset
+            if done:
+                end_frame = buffer.end_frame()
+                if end_frame:
+                    yield Frame(seq, offset, end_frame)
+                return
+            if not frames:
+                yield None
+            await buffer.wait_async(seq, STREAM_RESUME_POLL_INTERVAL)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, streams=len(self._streams), max_streams=self.max_streams)
+
+_bus = InProcessStreamBus()
+
+def get_stream_bus():
+    """Return the process-wide stream bus."""
+    return _bus
+
+def set_stream_bus(bus):
+    """Replace the stream bus, e.g. with one shared by all workers."""
+    global _bus
+    _bus = bus
+
+def _count_resume(source):
+    stats = get_stream_bus().stats
+    stats[f'resumed_from_{source}'] = stats.get(f'resumed_from_{source}', 0) + 1
+    metrics.SSE_RESUMES.labels(source).inc()
+
+def _message_frames(snapshot, seq, offset):
+    """Frames bringing a client at ``offset`` up to date with a message row.
+
+    Returns:
+        tuple: (frames, seq, offset)
+    """
+    frames = []
+    if len(snapshot.content) > offset:
+        payload, event = chat_frame(TEXT_EVENT, snapshot.content[offset:])
+        seq, offset = seq + 1, len(snapshot.content)
+        frames.append(format_event(payload, event, f"{seq}.{offset}"))
+    if snapshot.error is not None:
+        frames.append(status_frame('error', snapshot.error))
+    elif not snapshot.is_streaming:
+        seq += 1
+        frames.append(format_event(chat_final(snapshot.content, snapshot.reasoning_summary, snapshot.is_truncated),
+                                   None, f"{seq}.{offset}"))
+    return frames, seq, offset
+
+def follow_stream(stream_id, last_event_id, load_message, resumed=True):
+    """Yield a stream's frames after Last-Event-ID, then the rest of the stream as it arrives.
+
+    Args:
+        stream_id (str): The stream to follow
+        last_event_id (str): The id of the last frame the client received, or None for the whole stream
+        load_message (callable): Returns the stream's MessageSnapshot, or None if there is no row
+        resumed (bool): Count the subscription as a resume
+    """
+    seq, offset = parse_event_id(last_event_id)
+    bus = get_stream_bus()
+    last_write = time.monotonic()
+    with bus.attached(stream_id):
+        try:
+            counted = False
+            for frame in bus.subscribe(stream_id, seq, offset):
+                if frame is None:
+                    if time.monotonic() - last_write >= STREAM_HEARTBEAT_INTERVAL:
+                        last_write = time.monotonic()
+                        yield HEARTBEAT_FRAME
+                    continue
+                if resumed and not counted:
+                    _count_resume('buffer')
+                    counted = True
+                last_write = time.monotonic()
+                yield frame.text
+                seq, offset = frame.seq, frame.offset
+            return
+        except StreamUnavailable:
+            pass
+
+        if resumed:
+            _count_resume('message')
+        progressed_at = time.monotonic()
+        while True:
+            snapshot = load_message()
+            if snapshot is None:
+                yield status_frame('interrupted', 'The response is no longer available')
+                return
+            frames, seq, new_offset = _message_frames(snapshot, seq, offset)
+            for frame in frames:
+                yield frame
+            if not snapshot.is_streaming:
+                return
+            now = time.monotonic()
+            if frames:
+                last_write = now
+            elif now - last_write >= STREAM_HEARTBEAT_INTERVAL:
+                last_write = now
+                yield HEARTBEAT_FRAME
+            if new_offset > offset:
+                offset, progressed_at = new_offset, now
+            elif now - progressed_at > STREAM_RESUME_IDLE_TIMEOUT:
+                yield status_frame('timeout', 'The response stopped making progress')
+                return
+            time.sleep(STREAM_RESUME_POLL_INTERVAL)
+
+async def async_follow_stream(stream_id, last_event_id, load_message, resumed=True):
+    """``follow_stream`` for the event loop; ``load_message`` is a coroutine function."""
+    seq, offset = parse_event_id(last_event_id)
+    bus = get_stream_bus()
+    last_write = time.monotonic()
+    with bus.attached(stream_id):
+        try:
+            counted = False
+            async for frame in bus.asubscribe(stream_id, seq, offset):
+                if frame is None:
+                    if time.monotonic() - last_write >= STREAM_HEARTBEAT_INTERVAL:
+                        last_write = time.monotonic()
+                        yield HEARTBEAT_FRAME
+                    continue
+                if resumed and not counted:
+                    _count_resume('buffer')
+                    counted = True
+                last_write = time.monotonic()
+                yield frame.text
+                seq, offset = frame.seq, frame.offset
+            return
+        except StreamUnavailable:
+            pass
+
+        if resumed:
+            _count_resume('message')
+        progressed_at = time.monotonic()
+        while True:
+            snapshot = await load_message()
+            if snapshot is None:
+                yield status_frame('interrupted', 'The response is no longer available')
+                return
+            frames, seq, new_offset = _message_frames(snapshot, seq, offset)
+            for frame in frames:
+                yield frame
+            if not snapshot.is_streaming:
+                return
+            now = time.monotonic()
+            if frames:
+                last_write = now
+            elif now - last_write >= STREAM_HEARTBEAT_INTERVAL:
+                last_write = now
+                yield HEARTBEAT_FRAME
+            if new_offset > offset:
+                offset, progressed_at = new_offset, now
+            elif now - progressed_at > STREAM_RESUME_IDLE_TIMEOUT:
+                yield status_frame('timeout', 'The response stopped making progress')
+                return
+            await asyncio.sleep(STREAM_RESUME_POLL_INTERVAL)
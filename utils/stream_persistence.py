@@ -0,0 +1,140 @@
+"""
+Coalesced persistence of streamed assistant messages.
+
+Writing the partial message on every delta costs one UPDATE (carrying the
+whole text so far) per token. ``StreamingMessageWriter`` buffers deltas and
+only writes the partial message once a time or size threshold is crossed,
+with a final write when the stream ends.
+
+The message keeps ``is_streaming=True`` until ``finish()`` is called, so a
+row left in that state after a crash still marks an interrupted response
+holding the text from the last flush.
+"""
+import time
+import logging
+
+DEFAULT_FLUSH_INTERVAL_MS = 500
+DEFAULT_FLUSH_MAX_BYTES = 4096
+
+class StreamingMessageWriter:
+    """Buffer streamed deltas and flush them to a ``Message`` row in batches."""
+
+    def __init__(self, message=None, session=None, flush_interval_ms=DEFAULT_FLUSH_INTERVAL_MS,
+                 flush_max_bytes=DEFAULT_FLUSH_MAX_BYTES):
+        """
+        Args:
+            message (Message, optional): The streaming message row, or None to only collect text
+            session (Session, optional): SQLAlchemy session used to commit the row
+            flush_interval_ms (int): Flush at most this often while deltas are arriving
+            flush_max_bytes (int): Flush early once this many unflushed bytes are buffered
+        """
+        self.message = message
+        self.session = session
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_max_bytes = flush_max_bytes
+        self.parts = []
+        self.summary_parts = []
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        self.flush_count = 0
+
+    @property
+    def text(self):
+        """The full text received so far."""
+        return "".join(self.parts)
+
+    @property
+    def reasoning_summary(self):
+        """The reasoning summary received so far, or None."""
+        return "".join(self.summary_parts) or None
+
+    def append(self, delta):
+        """Add a streamed delta, flushing if a threshold has been crossed."""
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.pending_bytes += len(delta.encode("utf-8"))
+        if self._should_flush():
+            self.flush()
+
+    def append_reasoning_summary(self, delta):
+        """Add a streamed reasoning-summary delta, flushing if a threshold has been crossed."""
+        if not delta:
+            return
+        self.summary_parts.append(delta)
+        self.pending_bytes += len(delta.encode("utf-8"))
+        if self._should_flush():
+            self.flush()
+
+    def _should_flush(self):
+        if self.message is None or not self.pending_bytes:
+            return False
+        if self.pending_bytes >= self.flush_max_bytes:
+            return True
+        return (time.monotonic() - self.last_flush) >= self.flush_interval
+
+    def _prepare_flush(self):
+        """Copy buffered state onto the message; return False if nothing to write."""
+        if self.message is None:
+            return False
+        # Collapse the parts so repeated joins stay linear in response length
+        text = self.text
+        self.parts = [text]
+        self.message.content = text
+        if self.summary_parts:
+            summary = self.reasoning_summary
+            self.summary_parts = [summary]
+            self.message.reasoning_summary = summary
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        self.flush_count += 1
+        return True
+
+    def flush(self):
+        """Write the partial message to the database."""
+        if self._prepare_flush():
+            self.session.commit()
+
+    def finish(self):
+        """Write the complete message and clear its streaming flag."""
+        if self.message is None:
+            return self.text
+        self.message.is_streaming = False
+        self.flush()
+        logging.debug(f"Persisted streamed message {self.message.id} with {self.flush_count} flushes")
+        return self.text
+
+class AsyncStreamingMessageWriter(StreamingMessageWriter):
+    """``StreamingMessageWriter`` for an SQLAlchemy ``AsyncSession``."""
+
+    async def append(self, delta):
+        """Add a streamed delta, flushing if a threshold has been crossed."""
+        if not delta:
+            return
+        self.parts.append(delta)
+        self.pending_bytes += len(delta.encode("utf-8"))
+        if self._should_flush():
+            await self.flush()
+
+    async def append_reasoning_summary(self, delta):
+        """Add a streamed reasoning-summary delta, flushing if a threshold has been crossed."""
+        if not delta:
+            return
+        self.summary_parts.append(delta)
+        self.pending_bytes += len(delta.encode("utf-8"))
+        if self._should_flush():
+            await self.flush()
+
+    async def flush(self):
+        """Write the partial message to the database."""
+        if self._prepare_flush():
+            await self.session.commit()
+
+    async def finish(self):
+        """Write the complete message and clear its streaming flag."""
+        if self.message is None:
+            return self.text
+        self.message.is_streaming = False
+        await self.flush()
+        logging.debug(f"Persisted streamed message {self.message.id} with {self.flush_count} flushes")
+        return self.text
@@ -0,0 +1,88 @@
+"""
+Server-generated thumbnails for chat history images.
+
+History views show images as small JPEG thumbnails so a page of messages
+with many images loads in one request; the full-size image is fetched only
+when the user opens it. Thumbnails are generated once per image and cached
+in the blob store next to the original.
+
+Requires Pillow (``pip install .[thumbnails]``); without it no thumbnails
+are produced and clients fall back to the full-size image URL.
+"""
+import io
+import os
+import logging
+
+THUMBNAIL_VARIANT = "thumb.jpg"
+THUMBNAIL_MAX_SIZE = int(os.environ.get("THUMBNAIL_MAX_SIZE", "320"))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "75"))
+
+_pillow = None
+
+def _get_pillow():
+    """Return the (Image, ImageOps) modules from Pillow, or False if it is not installed."""
+    global _pillow
+    if _pillow is None:
+        try:
+            from PIL import Image, ImageOps
+            _pillow = (Image, ImageOps)
+        except ImportError:
+            logging.info("Pillow not installed; image thumbnails are disabled")
+            _pillow = False
+    return _pillow
+
+def make_thumbnail(data, max_size=THUMBNAIL_MAX_SIZE):
+    """Downscale image bytes to a JPEG that fits in a max_size square.
+
+    Args:
+        data (bytes): The original image
+        max_size (int): Maximum width and height in pixels
+
+    Returns:
+        bytes: The JPEG thumbnail, or None if it could not be generated
+    """
+    pillow = _get_pillow()
+    if not pillow:
+        return None
+    Image, ImageOps = pillow
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_size, max_size))
+            if image.mode in ("RGBA", "LA", "P"):
+                # JPEG has no alpha channel; flatten transparent images onto white
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            return output.getvalue()
+    except Exception as e:
+        logging.warning(f"Could not generate thumbnail: {str(e)}")
+        return None
+
+def get_thumbnail(store, blob_id):
+    """Return the cached thumbnail of a blob, generating it on first use.
+
+    Args:
+        store (LocalBlobStore): The blob store holding the original image
+        blob_id (str): Id of the original image
+
+    Returns:
+        bytes: The JPEG thumbnail, or None if thumbnails are unavailable
+    """
+    thumbnail = store.read_variant(blob_id, THUMBNAIL_VARIANT)
+    if thumbnail is not None:
+        return thumbnail
+
+    thumbnail = make_thumbnail(store.read(blob_id))
+    if thumbnail is None:
+        return None
+    store.put_variant(blob_id, THUMBNAIL_VARIANT, thumbnail)
+    logging.debug(f"Generated thumbnail for blob {blob_id} ({len(thumbnail)} bytes)")
+    return thumbnail
@@ -0,0 +1,160 @@
+"""
+Cache of authenticated user identities for Flask-Login.
+
+Flask-Login calls the user loader on every request that carries a session,
+including each streamed chat turn and each image fetched by the history
+view. Without a cache that is one primary-key query per request. The
+loader is served from a per-worker TTL/LRU cache of (id, username)
+instead, so a user costs one query per worker per USER_CACHE_TTL. The
+same entries map usernames to ids, so logging in as a known user doesn't
+touch the database either.
+
+Entries are dropped when a User row is updated or deleted in this worker;
+changes made by other workers are picked up when the entry expires. While
+the database is marked unavailable, users are looked up in the in-memory
+fallback store. If the database fails during a lookup, an expired entry is
+served rather than logging the user out.
+
+Settings:
+
+    USER_CACHE_TTL    Seconds an identity is served from the cache (default 300)
+    USER_CACHE_SIZE   Identities kept per worker (default 10000)
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from flask_login import UserMixin
+
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "300"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+
+class CachedUser(UserMixin):
+    """The identity Flask-Login needs for current_user, detached from any session."""
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def __repr__(self):
+        return f"<CachedUser {self.id} {self.username}>"
+
+class UserCache:
+    """TTL/LRU cache of CachedUser by id, also indexed by username."""
+
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._ids_by_username = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def put(self, user_id, username):
+        """Cache an identity and return it as a CachedUser."""
+        user = CachedUser(user_id, username)
+        with self._lock:
+            self._remove(user_id)
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._ids_by_username[username] = user_id
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        return user
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None and self._ids_by_username.get(entry[1].username) == user_id:
+            del self._ids_by_username[entry[1].username]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ids_by_username.clear()
+
+    def get_by_username(self, username):
+        """Return the cached, unexpired CachedUser with a username, or None."""
+        with self._lock:
+            user_id = self._ids_by_username.get(username)
+        if user_id is None:
+            self.misses += 1
+            return None
+        user, fresh = self._lookup(user_id)
+        if user is None or not fresh or user.username != username:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user
+
+    def _lookup(self, user_id):
+        """Return (user, fresh) from the cache, or (None, False)."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None, False
+            self._entries.move_to_end(user_id)
+            return entry[1], entry[0] > time.monotonic()
+
+    def load(self, user_id):
+        """Return the CachedUser with an id, or None if there is no such user.
+
+        Must be called inside a Flask application context.
+        """
+        from app import db, is_database_available
+
+        cached, fresh = self._lookup(user_id)
+        if fresh:
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        if not is_database_available():
+            from utils.db_fallback import get_user
+            user = get_user(user_id)
+            return self.put(user['id'], user['username']) if user else None
+
+        from models import User
+        try:
+            row = db.session.query(User.id, User.username).filter(User.id == user_id).first()
+        except Exception as e:
+            db.session.rollback()
+            if cached is None:
+                raise
+            # Keep the user signed in through a database hiccup
+            self.stale_hits += 1
+            logging.warning(f"User lookup failed, serving cached identity for user ID {user_id}: {str(e)}")
+            return cached
+        if row is None:
+            self.invalidate(user_id)
+            return None
+        return self.put(row.id, row.username)
+
+    def _invalidate_changed_row(self, mapper, connection, target):
+        self.invalidate(target.id)
+
+    def watch(self, user_model):
+        """Invalidate cached identities when rows of the User model change in this process."""
+        from sqlalchemy import event
+
+        for event_name in ("after_update", "after_delete"):
+            if not event.contains(user_model, event_name, self._invalidate_changed_row):
+                event.listen(user_model, event_name, self._invalidate_changed_row)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits
+        }
+
+user_cache = UserCache()
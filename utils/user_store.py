@@ -0,0 +1,127 @@
+"""
+Race-free user registration.
+
+Users are created with ``INSERT ... ON CONFLICT (username) DO NOTHING
+RETURNING id`` (PostgreSQL and SQLite), so concurrent logins with the same
+new username can't fail on the unique constraint: one insert wins and the
+others read its row. Rows that already existed are read back with one
+``SELECT ... WHERE username IN (...)`` per chunk. Other databases fall back
+to select-then-insert with a savepoint per missing user.
+
+Many users can be provisioned in one transaction; rows are inserted in
+chunks of INSERT_CHUNK_SIZE to stay under driver parameter limits.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+INSERT_CHUNK_SIZE = 1000
+MAX_USERNAME_LENGTH = 64
+
+def _insert_ignoring_conflicts(dialect_name):
+    """Return the dialect's insert() supporting on_conflict_do_nothing, or None."""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+def _select_ids(session, usernames):
+    from models import User
+
+    rows = session.query(User.id, User.username).filter(User.username.in_(usernames)).all()
+    return {row.username: row.id for row in rows}
+
+def _upsert_chunk(session, insert, usernames, created_at):
+    from models import User
+
+    statement = insert(User).values([
+        {'username': username, 'created_at': created_at} for username in usernames
+    ]).on_conflict_do_nothing(index_elements=['username']).returning(User.id, User.username)
+    inserted = {row.username: row.id for row in session.execute(statement)}
+    existing = [username for username in usernames if username not in inserted]
+    ids = dict(inserted)
+    if existing:
+        ids.update(_select_ids(session, existing))
+    return ids, len(inserted)
+
+def _get_or_create_chunk(session, usernames, created_at):
+    from models import User
+
+    ids = _select_ids(session, usernames)
+    created = 0
+    for username in usernames:
+        if username in ids:
+            continue
+        try:
+            with session.begin_nested():
+                user = User(username=username, created_at=created_at)
+                session.add(user)
+            ids[username] = user.id
+            created += 1
+        except IntegrityError:
+            # Created concurrently by another request
+            ids.update(_select_ids(session, [username]))
+    return ids, created
+
+def upsert_users(usernames):
+    """Create the users that don't exist yet and return everyone's id, in one transaction.
+
+    Must be called inside a Flask application context.
+
+    Args:
+        usernames (list): Validated, distinct usernames
+
+    Returns:
+        tuple: ({username: user_id}, number of users created)
+    """
+    from app import db
+
+    session = db.session
+    insert = _insert_ignoring_conflicts(db.engine.dialect.name)
+    created_at = datetime.utcnow()
+    ids = {}
+    created = 0
+    try:
+        for start in range(0, len(usernames), INSERT_CHUNK_SIZE):
+            chunk = usernames[start:start + INSERT_CHUNK_SIZE]
+            if insert is not None:
+                chunk_ids, chunk_created = _upsert_chunk(session, insert, chunk, created_at)
+            else:
+                chunk_ids, chunk_created = _get_or_create_chunk(session, chunk, created_at)
+            ids.update(chunk_ids)
+            created += chunk_created
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    if created:
+        logging.info(f"Created {created} of {len(usernames)} users")
+    return ids, created
+
+def upsert_user(username):
+    """Return (user_id, created) for a username, creating the user if needed."""
+    ids, created = upsert_users([username])
+    return ids[username], bool(created)
+
+def normalize_usernames(values):
+    """Strip and de-duplicate usernames, keeping their order.
+
+    Raises:
+        ValueError: If a username is empty, too long or not a string
+    """
+    usernames = []
+    seen = set()
+    for value in values:
+        username = value.strip() if isinstance(value, str) else None
+        if not username:
+            raise ValueError("Usernames must be non-empty strings")
+        if len(username) > MAX_USERNAME_LENGTH:
+            raise ValueError(f"Usernames must be at most {MAX_USERNAME_LENGTH} characters: {username[:MAX_USERNAME_LENGTH]}...")
+        if username not in seen:
+            seen.add(username)
+            usernames.append(username)
+    return usernames
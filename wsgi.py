@@ -0,0 +1,22 @@
+"""
+WSGI entry point: builds the Flask app and warms it up.
+
+Run with:
+    flask --app app:create_app migrate    # create or upgrade the schema first
+    gunicorn --preload --bind 0.0.0.0:5000 wsgi:app
+
+With ``--preload`` the gunicorn master imports this module once, loading
+the SDKs and checking the database, and the workers fork warm; without it
+every worker warms itself up before taking requests. Import ``create_app``
+from ``app`` instead to build an app without touching the database.
+"""
+import time
+import logging
+
+_started = time.perf_counter()
+
+from app import create_app, warm_up  # noqa: E402
+
+app = create_app()
+warm_up(app)
+logging.info(f"App ready {(time.perf_counter() - _started) * 1000:.0f}ms after import")